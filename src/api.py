@@ -1,16 +1,35 @@
 # src/api.py
 import os
 import time
-import json
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ReadTimeoutError
 from urllib.parse import quote
 
+from . import codec, metrics
+from .breaker import CircuitBreaker, CircuitOpenError
+from .latency import LatencyTracker
+from .ingest import InboundRecord, ListParser, STREAM_CHUNK, apply_transform
+from .tracing import tracer, payload_size
+
+# Statuses a GET is retried on, in both engines
+RETRY_STATUSES = (502, 503, 504)
+
+
 class APIManager:
     """
     APIManager main responsibilities:
     - Manages persistent sessions with TTL-based reuse
-    - Handles request timeouts
+    - Mounts a pooled, keep-alive HTTP adapter per base_url (sized by connect_pool_size)
+    - Retries idempotent GETs with backoff
+    - Adapts request timeouts per server and endpoint to observed latency (see latency.LatencyTracker)
+    - Fails fast for panels whose circuit breaker is open (see breaker.CircuitBreaker)
+    - Streams inbound lists through an incremental parser (see ingest.ListParser)
+    - Encodes/decodes JSON through codec (orjson when installed), asks for compressed
+      responses and serializes a client or inbound pushed to many nodes only once
     - URL-encodes sensitive fields like email and client_id
     """
 
@@ -18,11 +37,31 @@ class APIManager:
         self.sessions = {}  # Maps base_url to requests.Session
         self.net_opts = net_opts or {}
         self.timeout = int(self.net_opts.get("request_timeout", 10))
+        self.pool_size = max(1, int(self.net_opts.get("connect_pool_size", 50)))
+        self.retries = max(0, int(self.net_opts.get("retries", 2)))
+        self.retry_backoff = float(self.net_opts.get("retry_backoff", 0.3))
+        self.add_clients_chunk_size = max(1, int(self.net_opts.get("add_clients_chunk_size", 100)))
+        self.stream_lists = bool(self.net_opts.get("stream_lists", True))
+        self.payloads = codec.PayloadCache()
+        self.adapters = {}  # Maps base_url to HTTPAdapter
+        self._sessions_lock = threading.Lock()  # sessions are shared by the inbound and traffic loops
         # Tracks last successful validation timestamp for each base_url
         self._last_valid = {}  # base_url -> timestamp
+        self._login_locks = {}  # base_url -> threading.Lock (one /login at a time per panel)
         self._validate_ttl = int(
             os.getenv("NET_VALIDATE_TTL_SECONDS", str(self.net_opts.get("validate_ttl_seconds", 60)))
         )
+        self.breaker = CircuitBreaker(
+            failure_threshold=self.net_opts.get("breaker_failures", 3),
+            reset_seconds=self.net_opts.get("breaker_reset_seconds", 30),
+            max_reset_seconds=self.net_opts.get("breaker_max_reset_seconds", 300),
+        )
+        self.latency = LatencyTracker(
+            self.timeout,
+            min_timeout=self.net_opts.get("timeout_min_seconds", 2),
+            max_timeout=self.net_opts.get("timeout_max_seconds", 60),
+            enabled=self.net_opts.get("adaptive_timeouts", True),
+        )
 
     # ---------------------- Session Management ----------------------
     def _get_session(self, base_url: str) -> requests.Session:
@@ -32,39 +71,189 @@ class APIManager:
         """
         base_url = base_url.rstrip("/")
         s = self.sessions.get(base_url)
-        if s is None:
+        if s is not None:
+            return s
+        with self._sessions_lock:
+            s = self.sessions.get(base_url)
+            if s is not None:
+                return s
             s = requests.Session()
             s.headers.update({
                 "User-Agent": "dds-sync-worker/0.1",
                 "Accept": "application/json, text/plain, */*",
+                "Accept-Encoding": codec.ACCEPT_ENCODING,
+                "Connection": "keep-alive",
+                # Lets 3x-ui answer expired sessions with 401 instead of a login redirect
+                "X-Requested-With": "XMLHttpRequest",
             })
+            adapter = self._make_adapter()
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            self.adapters[base_url] = adapter
             self.sessions[base_url] = s
-        return s
+            return s
+
+    def _make_adapter(self) -> HTTPAdapter:
+        """
+        Builds a pooled adapter for one panel.
+        Only idempotent GETs are retried; POSTs are never replayed.
+        """
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=self.retry_backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        return HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+            pool_block=False,
+        )
+
+    def connection_stats(self) -> dict:
+        """
+        Returns base_url -> {"requests", "new_connections", "reused"} from the adapters' pools.
+        """
+        stats = {}
+        for base, adapter in list(self.adapters.items()):
+            reqs, conns = 0, 0
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                reqs += int(getattr(pool, "num_requests", 0) or 0)
+                conns += int(getattr(pool, "num_connections", 0) or 0)
+            stats[base] = {"requests": reqs, "new_connections": conns, "reused": max(0, reqs - conns)}
+        return stats
 
     def _validate_session(self, base: str, s: requests.Session) -> bool:
         """
-        Validates the session for the given base_url using TTL:
-        - If last validation was within TTL, returns True.
-        - Otherwise, performs a GET request to /panel/api/inbounds/list and checks for success.
+        Validates the session for the given base_url using TTL only:
+        - If the session was logged in or used successfully within TTL, returns True.
+        - No probe request is sent; an expired session is detected lazily by the
+          next real call (see _request), which logs in again and retries once.
         """
-        now = time.time()
         ts = self._last_valid.get(base)
-        if ts and (now - ts) < self._validate_ttl:
+        return bool(ts) and (time.time() - ts) < self._validate_ttl and bool(s.cookies)
+
+    @staticmethod
+    def _is_auth_failure(r: requests.Response) -> bool:
+        """401/403, or a redirect (to the login page) instead of an API response."""
+        if r.status_code in (401, 403):
             return True
+        if r.history and any(h.is_redirect for h in r.history):
+            return True
+        return r.is_redirect
+
+    def circuit_open(self, server: dict) -> bool:
+        """True while calls to this server fail fast because its circuit breaker is open."""
+        return self.breaker.is_open(server["url"].rstrip("/"))
+
+    def latency_profile(self) -> dict:
+        """base_url -> endpoint -> {"count", "ewma", "p_high", "timeout"} in seconds."""
+        return self.latency.profile()
 
+    def clear_payloads(self) -> None:
+        """Drops the request bodies cached for the reconciliation pass that just ended."""
+        self.payloads.clear()
+
+    @staticmethod
+    def _timed_out(e: Exception) -> bool:
+        """Read timeout, also when urllib3 gave up retrying a GET after one."""
+        if isinstance(e, requests.exceptions.ReadTimeout):
+            return True
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, ReadTimeoutError)
+
+    def _send(self, base: str, s: requests.Session, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        One timed HTTP call (GET retries included), recorded in the metrics registry,
+        in base's circuit breaker (no response or a 5xx counts as a failure) and in the
+        latency profile that sets the timeout of the endpoint's next call. A json= body
+        is encoded with codec.dumps rather than the client's stdlib encoder.
+        """
+        self.breaker.before_call(base)
+        endpoint = metrics.endpoint_label(url)
+        kwargs.setdefault("timeout", self.latency.timeout(base, endpoint))
+        if kwargs.get("json") is not None:
+            kwargs["data"] = codec.dumps(kwargs.pop("json"))
+            kwargs["headers"] = codec.JSON_HEADERS
+        start = time.perf_counter()
+        status = "error"
+        r = None
         try:
-            r = s.get(f"{base}/panel/api/inbounds/list", timeout=self.timeout)
-            if r.status_code != 200:
-                return False
-            jr = r.json()
-            ok = bool(jr.get("success"))
-            if ok:
-                self._last_valid[base] = now
-            return ok
-        except Exception:
-            return False
+            r = s.request(method, url, **kwargs)
+            status = str(r.status_code)
+            return r
+        except requests.RequestException as e:
+            if self._timed_out(e):
+                self.latency.observe(base, endpoint, kwargs["timeout"], timed_out=True)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            if r is not None and r.status_code < 500:
+                self.breaker.record_success(base)
+                self.latency.observe(base, endpoint, elapsed)
+            else:
+                self.breaker.record_failure(base, f"{method} {endpoint}: {status}")
+            metrics.observe_request(url, method, status, elapsed)
+            if tracer.is_slow(elapsed):
+                # A streamed body has not been read yet (and must not be read here)
+                tracer.slow_call(url, method, status, elapsed, payload_size(kwargs),
+                                 len(r.content) if r is not None and not kwargs.get("stream") else None)
+
+    @staticmethod
+    def _json(r: requests.Response):
+        return codec.loads(r.content)
+
+    def _login_lock(self, base: str) -> threading.Lock:
+        lock = self._login_locks.get(base)
+        if lock is None:
+            with self._sessions_lock:
+                lock = self._login_locks.setdefault(base, threading.Lock())
+        return lock
+
+    def _request(self, server: dict, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends an authenticated request through the persistent session.
+        If the panel answers as if the session expired, logs in once and retries;
+        a thread that finds another one already logged in meanwhile just retries.
+        Only a 2xx answer extends the session's validity.
+        """
+        base = server["url"].rstrip("/")
+        s = self._get_session(base)
+        sent_at = time.time()
+        r = self._send(base, s, method, url, **kwargs)
+        if self._is_auth_failure(r):
+            r.close()
+            with self._login_lock(base):
+                if self._last_valid.get(base, 0) <= sent_at:
+                    logging.info(f"Session expired for {base}; logging in again")
+                    self._last_valid.pop(base, None)
+                    self._do_login(server, s)
+            r = self._send(base, s, method, url, **kwargs)
+        if 200 <= r.status_code < 300 and not self._is_auth_failure(r):
+            self._last_valid[base] = time.time()
+        return r
 
     # ---------------------- Authentication ----------------------
+    def _do_login(self, server: dict, s: requests.Session) -> None:
+        base = server["url"].rstrip("/")
+        payload = {"username": server.get("username", ""), "password": server.get("password", "")}
+        r = self._send(base, s, "POST", f"{base}/login", json=payload)
+        r.raise_for_status()
+        jr = self._json(r)
+        if not jr.get("success"):
+            raise RuntimeError(f"Login failed: {jr.get('msg', 'unknown error')}")
+        self._last_valid[base] = time.time()
+
     def login(self, server: dict) -> requests.Session:
         """
         Logs in to the server and returns a session.
@@ -74,89 +263,119 @@ class APIManager:
         base = server["url"].rstrip("/")
         s = self._get_session(base)
 
-        # Reuse session if still valid (no need to call /login)
-        if self._validate_session(base, s):
-            logging.info(f"Reusing session for {base}")
-            return s
+        with self._login_lock(base):
+            # Reuse session if still valid (no need to call /login)
+            if self._validate_session(base, s):
+                logging.info(f"Reusing session for {base}")
+                return s
 
-        payload = {"username": server.get("username", ""), "password": server.get("password", "")}
-        try:
-            r = s.post(f"{base}/login", json=payload, timeout=self.timeout)
-            r.raise_for_status()
-            jr = r.json()
-            if jr.get("success"):
-                self._last_valid[base] = time.time()
+            try:
+                self._do_login(server, s)
                 logging.info(f"Logged in via /login for {base}")
                 return s
-            raise RuntimeError(f"Login failed: {jr.get('msg', 'unknown error')}")
-        except Exception as e:
-            logging.error(f"Login request error for {base}: {e}")
-            raise
+            except Exception as e:
+                logging.error(f"Login request error for {base}: {e}")
+                raise
+
+    def _get_list(self, server: dict, url: str, transform=None) -> dict:
+        """
+        GETs a panel list endpoint and returns the parsed envelope, with transform applied
+        to each element of "obj". With stream_lists the body is parsed as it arrives.
+        """
+        if not self.stream_lists:
+            r = self._request(server, "GET", url)
+            r.raise_for_status()
+            return apply_transform(self._json(r), transform)
+        r = self._request(server, "GET", url, stream=True)
+        try:
+            r.raise_for_status()
+            parser = ListParser(transform)
+            for chunk in r.iter_content(chunk_size=STREAM_CHUNK):
+                parser.feed(chunk)
+            return parser.close()
+        finally:
+            r.close()
 
     # ---------------------- Inbounds Management ----------------------
-    def get_inbounds(self, server: dict, session: requests.Session):
+    def get_inbounds(self, server: dict, session: requests.Session, client_stats: bool = True):
         """
-        Retrieves the list of inbounds from the server.
-        Returns an empty list on error.
+        Retrieves the list of inbounds from the server as InboundRecords.
+        client_stats=False drops the per-client traffic rows (not needed for planning).
+        Returns an empty list on error; raises CircuitOpenError while the breaker is open.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
+        drop = () if client_stats else ("clientStats",)
         try:
-            r = s.get(f"{base}/panel/api/inbounds/list", timeout=self.timeout)
-            r.raise_for_status()
-            jr = r.json()
+            jr = self._get_list(server, f"{base}/panel/api/inbounds/list",
+                                lambda ib: InboundRecord.from_panel(ib, drop))
             return jr.get("obj") or []
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error fetching inbounds from {base}: {e}")
             return []
 
-    def add_inbound(self, server: dict, session: requests.Session, inbound: dict) -> None:
+    def add_inbound(self, server: dict, session: requests.Session, inbound: dict) -> bool:
         """
         Adds a new inbound to the server.
-        Logs an error if the operation fails.
+        Logs an error if the operation fails; returns True only if the panel accepted it.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
         try:
-            r = s.post(f"{base}/panel/api/inbounds/add", json=inbound, timeout=self.timeout)
+            r = self._request(server, "POST", f"{base}/panel/api/inbounds/add",
+                              data=self.payloads.inbound_body(inbound), headers=codec.JSON_HEADERS)
             r.raise_for_status()
-            jr = r.json()
+            jr = self._json(r)
             if not jr.get("success"):
                 logging.error(f"Failed to add inbound {inbound.get('id')} on {base}: {jr.get('msg', 'No message')}")
+                return False
+            return True
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error adding inbound {inbound.get('id')} on {base}: {e}")
+        return False
 
-    def update_inbound(self, server: dict, session: requests.Session, inbound_id: int, inbound: dict) -> None:
+    def update_inbound(self, server: dict, session: requests.Session, inbound_id: int, inbound: dict) -> bool:
         """
         Updates an existing inbound on the server.
-        Logs an error if the operation fails.
+        Logs an error if the operation fails; returns True only if the panel accepted it.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
         try:
-            r = s.post(f"{base}/panel/api/inbounds/update/{inbound_id}", json=inbound, timeout=self.timeout)
+            r = self._request(server, "POST", f"{base}/panel/api/inbounds/update/{inbound_id}",
+                              data=self.payloads.inbound_body(inbound), headers=codec.JSON_HEADERS)
             r.raise_for_status()
-            jr = r.json()
+            jr = self._json(r)
             if not jr.get("success"):
                 logging.error(f"Failed to update inbound {inbound_id} on {base}: {jr.get('msg', 'No message')}")
+                return False
+            return True
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error updating inbound {inbound_id} on {base}: {e}")
+        return False
 
-    def delete_inbound(self, server: dict, session: requests.Session, inbound_id: int) -> None:
+    def delete_inbound(self, server: dict, session: requests.Session, inbound_id: int) -> bool:
         """
         Deletes an inbound from the server.
-        Logs an error if the operation fails.
+        Logs an error if the operation fails; returns True only if the panel accepted it.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
         try:
-            r = s.post(f"{base}/panel/api/inbounds/del/{inbound_id}", timeout=self.timeout)
+            r = self._request(server, "POST", f"{base}/panel/api/inbounds/del/{inbound_id}")
             r.raise_for_status()
-            jr = r.json()
+            jr = self._json(r)
             if not jr.get("success"):
                 logging.error(f"Failed to delete inbound {inbound_id} on {base}: {jr.get('msg', 'No message')}")
+                return False
+            return True
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error deleting inbound {inbound_id} on {base}: {e}")
+        return False
 
     # ---------------------- Client Management ----------------------
     def add_client(self, server: dict, session: requests.Session, inbound_id: int, client: dict) -> None:
@@ -164,17 +383,55 @@ class APIManager:
         Adds a new client to the specified inbound.
         Logs an error if the operation fails.
         """
+        self._add_client_ok(server, inbound_id, client)
+
+    def add_clients(self, server: dict, session: requests.Session, inbound_id: int, clients: list, chunk_size: int = None) -> int:
+        """
+        Adds many clients to the specified inbound, up to chunk_size per addClient request.
+        A chunk the panel rejects is retried client by client, so one bad client does not
+        block the rest. Returns the number of clients added.
+        """
+        base = server["url"].rstrip("/")
+        chunk_size = max(1, int(chunk_size or self.add_clients_chunk_size))
+        added = 0
+        for i in range(0, len(clients), chunk_size):
+            chunk = clients[i:i + chunk_size]
+            if len(chunk) == 1:
+                added += self._add_client_ok(server, inbound_id, chunk[0])
+                continue
+            try:
+                jr = self._post_add_clients(server, inbound_id, chunk)
+                if jr.get("success"):
+                    added += len(chunk)
+                    continue
+                logging.warning(f"Batch add of {len(chunk)} clients failed on {base}: {jr.get('msg', 'No message')}; adding one by one")
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                logging.warning(f"Batch add of {len(chunk)} clients failed on {base}: {e}; adding one by one")
+            for client in chunk:
+                added += self._add_client_ok(server, inbound_id, client)
+        return added
+
+    def _post_add_clients(self, server: dict, inbound_id: int, clients: list) -> dict:
+        base = server["url"].rstrip("/")
+        r = self._request(server, "POST", f"{base}/panel/api/inbounds/addClient",
+                          data=self.payloads.clients_body(inbound_id, clients), headers=codec.JSON_HEADERS)
+        r.raise_for_status()
+        return self._json(r)
+
+    def _add_client_ok(self, server: dict, inbound_id: int, client: dict) -> bool:
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
-        payload = {"id": inbound_id, "settings": json.dumps({"clients": [client]})}
         try:
-            r = s.post(f"{base}/panel/api/inbounds/addClient", json=payload, timeout=self.timeout)
-            r.raise_for_status()
-            jr = r.json()
-            if not jr.get("success"):
-                logging.error(f"Failed to add client {client.get('email')} on {base}: {jr.get('msg', 'No message')}")
+            jr = self._post_add_clients(server, inbound_id, [client])
+            if jr.get("success"):
+                return True
+            logging.error(f"Failed to add client {client.get('email')} on {base}: {jr.get('msg', 'No message')}")
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error adding client {client.get('email')} on {base}: {e}")
+        return False
 
     def update_client(self, server: dict, session: requests.Session, client_id, inbound_id: int, client: dict) -> None:
         """
@@ -182,16 +439,17 @@ class APIManager:
         Logs an error if the operation fails.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
         safe_id = quote(str(client_id), safe="")
         url = f"{base}/panel/api/inbounds/updateClient/{safe_id}"
-        payload = {"id": inbound_id, "settings": json.dumps({"clients": [client]})}
         try:
-            r = s.post(url, json=payload, timeout=self.timeout)
+            r = self._request(server, "POST", url,
+                              data=self.payloads.clients_body(inbound_id, [client]), headers=codec.JSON_HEADERS)
             r.raise_for_status()
-            jr = r.json()
+            jr = self._json(r)
             if not jr.get("success"):
                 logging.error(f"Failed to update client {client_id} on {base}: {jr.get('msg', 'No message')}")
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error updating client {client_id} on {base}: {e}")
 
@@ -201,15 +459,16 @@ class APIManager:
         Logs an error if the operation fails.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
         safe_id = quote(str(client_id), safe="")
         url = f"{base}/panel/api/inbounds/{inbound_id}/delClient/{safe_id}"
         try:
-            r = s.post(url, timeout=self.timeout)
+            r = self._request(server, "POST", url)
             r.raise_for_status()
-            jr = r.json()
+            jr = self._json(r)
             if not jr.get("success"):
                 logging.error(f"Failed to delete client {client_id} on {base}: {jr.get('msg', 'No message')}")
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error deleting client {client_id} on {base}: {e}")
 
@@ -217,41 +476,83 @@ class APIManager:
     def get_client_traffic(self, server: dict, session: requests.Session, email: str):
         """
         Retrieves upload and download traffic statistics for the specified client email.
-        Returns (0, 0) on error.
+        Returns (0, 0) on error; raises CircuitOpenError so callers treat the read as failed.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
         safe_email = quote(email, safe="")
         url = f"{base}/panel/api/inbounds/getClientTraffics/{safe_email}"
         try:
-            r = s.get(url, timeout=self.timeout)
+            r = self._request(server, "GET", url)
             r.raise_for_status()
-            jr = r.json()
+            jr = self._json(r)
             if jr.get("success"):
                 obj = jr.get("obj") or {}
                 up = int(obj.get("up", 0) or 0)
                 down = int(obj.get("down", 0) or 0)
                 return up, down
             return (0, 0)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error fetching traffic for {email} on {base}: {e}")
             return (0, 0)
 
-    def update_client_traffic(self, server: dict, session: requests.Session, email: str, up: int, down: int) -> None:
+    @staticmethod
+    def traffic_map_from_inbounds(inbounds) -> dict:
+        """
+        Builds an email -> (up, down) map from the clientStats of the given inbounds.
+        """
+        traffic = {}
+        for inbound in inbounds or []:
+            for st in inbound.get('clientStats') or []:
+                if not st or not st.get('email'):
+                    continue
+                try:
+                    up = int(st.get('up', 0) or 0)
+                    down = int(st.get('down', 0) or 0)
+                except Exception:
+                    continue
+                traffic[st['email']] = (up, down)
+        return traffic
+
+    def get_traffic_map(self, server: dict, session: requests.Session):
+        """
+        Retrieves traffic for every client on the server with a single inbounds/list call.
+        Only the clientStats counters are kept; each inbound is dropped once read.
+        Returns None on error so callers can fall back to per-email reads.
+        """
+        base = server["url"].rstrip("/")
+        traffic = {}
+        try:
+            jr = self._get_list(server, f"{base}/panel/api/inbounds/list",
+                                lambda ib: traffic.update(self.traffic_map_from_inbounds((ib,))))
+            if not jr.get("success"):
+                logging.error(f"Failed to fetch traffic map from {base}: {jr.get('msg', 'No message')}")
+                return None
+            return traffic
+        except Exception as e:
+            logging.error(f"Error fetching traffic map from {base}: {e}")
+            return None
+
+    def update_client_traffic(self, server: dict, session: requests.Session, email: str, up: int, down: int) -> bool:
         """
         Updates the traffic statistics for the specified client email.
         This endpoint may not be supported by all panels; errors are logged.
+        Returns True only if the panel accepted the write.
         """
         base = server["url"].rstrip("/")
-        s = self._get_session(base)
         safe_email = quote(email, safe="")
         url = f"{base}/panel/api/inbounds/updateClientTraffic/{safe_email}"
         payload = {"upload": int(up), "download": int(down)}
         try:
-            r = s.post(url, json=payload, timeout=self.timeout)
+            r = self._request(server, "POST", url, json=payload)
             r.raise_for_status()
-            jr = r.json()
-            if not jr.get("success"):
-                logging.error(f"Failed to update traffic for {email} on {base}: {jr.get('msg', 'No message')}")
+            jr = self._json(r)
+            if jr.get("success"):
+                return True
+            logging.error(f"Failed to update traffic for {email} on {base}: {jr.get('msg', 'No message')}")
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logging.error(f"Error updating traffic for {email} on {base}: {e}")
+        return False
@@ -0,0 +1,399 @@
+# src/async_api.py
+import os
+import time
+import json
+import asyncio
+import logging
+from urllib.parse import quote
+
+import aiohttp
+
+from .api import APIManager, RETRY_STATUSES
+from .breaker import CircuitBreaker, CircuitOpenError
+from .latency import LatencyTracker
+from .ingest import InboundRecord, ListParser, STREAM_CHUNK, apply_transform
+from . import codec, metrics
+from .tracing import tracer, payload_size
+
+
+class AsyncAPIManager:
+    """
+    asyncio counterpart of APIManager (same method names, as coroutines):
+    - One aiohttp.ClientSession per base_url, with a per-host connection limit
+    - TTL-based session reuse with lazy re-login on 401/redirect
+    - GET retries with backoff; POSTs are never replayed
+    - Per-base-URL circuit breaker (see breaker.CircuitBreaker)
+    - Per-server, per-endpoint adaptive timeouts (see latency.LatencyTracker)
+    - Inbound lists streamed through an incremental parser (see ingest.ListParser)
+    - JSON through codec (orjson when installed), compressed responses and one
+      serialization per client or inbound pushed to many nodes
+    All calls run on the caller's event loop, so hundreds of requests can be in
+    flight on a single thread.
+    """
+
+    def __init__(self, net_opts=None):
+        self.sessions = {}  # Maps base_url to aiohttp.ClientSession
+        self.net_opts = net_opts or {}
+        self.timeout = int(self.net_opts.get("request_timeout", 10))
+        self.pool_size = max(1, int(self.net_opts.get("connect_pool_size", 50)))
+        self.retries = max(0, int(self.net_opts.get("retries", 2)))
+        self.retry_backoff = float(self.net_opts.get("retry_backoff", 0.3))
+        self.add_clients_chunk_size = max(1, int(self.net_opts.get("add_clients_chunk_size", 100)))
+        self.stream_lists = bool(self.net_opts.get("stream_lists", True))
+        self.payloads = codec.PayloadCache()
+        self._last_valid = {}  # base_url -> timestamp
+        self._validate_ttl = int(
+            os.getenv("NET_VALIDATE_TTL_SECONDS", str(self.net_opts.get("validate_ttl_seconds", 60)))
+        )
+        self._login_locks = {}  # base_url -> asyncio.Lock
+        self.breaker = CircuitBreaker(
+            failure_threshold=self.net_opts.get("breaker_failures", 3),
+            reset_seconds=self.net_opts.get("breaker_reset_seconds", 30),
+            max_reset_seconds=self.net_opts.get("breaker_max_reset_seconds", 300),
+        )
+        self.latency = LatencyTracker(
+            self.timeout,
+            min_timeout=self.net_opts.get("timeout_min_seconds", 2),
+            max_timeout=self.net_opts.get("timeout_max_seconds", 60),
+            enabled=self.net_opts.get("adaptive_timeouts", True),
+        )
+
+    traffic_map_from_inbounds = staticmethod(APIManager.traffic_map_from_inbounds)
+
+    # ---------------------- Session Management ----------------------
+    def _get_session(self, base_url: str) -> aiohttp.ClientSession:
+        base_url = base_url.rstrip("/")
+        s = self.sessions.get(base_url)
+        if s is None or s.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+            s = aiohttp.ClientSession(
+                connector=connector,
+                # Panels are often addressed by IP; the default jar drops IP cookies
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    "User-Agent": "dds-sync-worker/0.1",
+                    "Accept": "application/json, text/plain, */*",
+                    "Accept-Encoding": codec.ACCEPT_ENCODING,
+                    "X-Requested-With": "XMLHttpRequest",
+                },
+            )
+            self.sessions[base_url] = s
+        return s
+
+    async def close(self):
+        for s in list(self.sessions.values()):
+            if not s.closed:
+                await s.close()
+        self.sessions.clear()
+
+    def _validate_session(self, base: str, s: aiohttp.ClientSession) -> bool:
+        ts = self._last_valid.get(base)
+        return bool(ts) and (time.time() - ts) < self._validate_ttl and len(s.cookie_jar) > 0
+
+    @staticmethod
+    def _is_auth_failure(status: int, history) -> bool:
+        return status in (401, 403) or bool(history)
+
+    def circuit_open(self, server: dict) -> bool:
+        return self.breaker.is_open(server["url"].rstrip("/"))
+
+    def latency_profile(self) -> dict:
+        return self.latency.profile()
+
+    def clear_payloads(self) -> None:
+        self.payloads.clear()
+
+    async def _send(self, base, s, method, url, **kwargs):
+        """
+        Returns (status, history, parsed JSON or None). No response or a 5xx (after
+        retries) counts as a failure in base's circuit breaker; the call's latency
+        sets the endpoint's next timeout. A json= body is encoded with codec.dumps.
+        """
+        self.breaker.before_call(base)
+        endpoint = metrics.endpoint_label(url)
+        timeout = self.latency.timeout(base, endpoint)
+        kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=timeout))
+        if kwargs.get("json") is not None:
+            kwargs["data"] = codec.dumps(kwargs.pop("json"))
+            kwargs["headers"] = codec.JSON_HEADERS
+        start = time.perf_counter()
+        try:
+            result = await self._send_attempts(s, method, url, **kwargs)
+        except asyncio.TimeoutError:
+            self.latency.observe(base, endpoint, timeout, timed_out=True)
+            self.breaker.record_failure(base, f"{method} {endpoint}: timeout")
+            raise
+        except Exception as e:
+            status = getattr(e, "status", None)
+            if status is not None and status < 500:
+                self.breaker.record_success(base)
+                self.latency.observe(base, endpoint, time.perf_counter() - start)
+            else:
+                self.breaker.record_failure(base, f"{method} {endpoint}: {status or type(e).__name__}")
+            raise
+        self.breaker.record_success(base)
+        self.latency.observe(base, endpoint, time.perf_counter() - start)
+        return result
+
+    async def _send_attempts(self, s, method, url, reader=None, **kwargs):
+        """
+        Returns (status, history, parsed JSON or None); retries GETs with backoff.
+        reader(response) replaces the default whole-body JSON parse.
+        """
+        attempts = self.retries + 1 if method == "GET" else 1
+        for attempt in range(attempts):
+            start = time.perf_counter()
+            code = "error"
+            resp_len = None
+            try:
+                async with s.request(method, url, **kwargs) as r:
+                    code = str(r.status)
+                    resp_len = r.content_length
+                    if method == "GET" and r.status in RETRY_STATUSES and attempt + 1 < attempts:
+                        raise aiohttp.ClientResponseError(r.request_info, r.history, status=r.status)
+                    r.raise_for_status()
+                    try:
+                        body = await (reader(r) if reader else self._json(r))
+                    except (json.JSONDecodeError, ValueError):
+                        body = None
+                self._observe(url, method, code, start, kwargs, resp_len)
+                return r.status, r.history, body
+            except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+                self._observe(url, method, code, start, kwargs, resp_len)
+                status = getattr(e, "status", None)
+                if status in (401, 403):
+                    return status, (), None
+                if (status is not None and status not in RETRY_STATUSES) or attempt + 1 >= attempts:
+                    raise
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    @staticmethod
+    async def _json(r):
+        return codec.loads(await r.read())
+
+    @staticmethod
+    def _observe(url, method, code, start, kwargs, resp_len=None):
+        elapsed = time.perf_counter() - start
+        metrics.observe_request(url, method, code, elapsed)
+        if tracer.is_slow(elapsed):
+            tracer.slow_call(url, method, code, elapsed, payload_size(kwargs), resp_len)
+
+    async def _request(self, server: dict, method: str, url: str, **kwargs):
+        """
+        Sends an authenticated request; logs in once and retries if the session expired.
+        Returns the parsed JSON body.
+        """
+        base = server["url"].rstrip("/")
+        s = self._get_session(base)
+        sent_at = time.time()
+        status, history, body = await self._send(base, s, method, url, **kwargs)
+        if self._is_auth_failure(status, history):
+            async with self._login_locks.setdefault(base, asyncio.Lock()):
+                if self._last_valid.get(base, 0) <= sent_at:
+                    logging.info(f"Session expired for {base}; logging in again")
+                    self._last_valid.pop(base, None)
+                    await self._do_login(server, s)
+            status, history, body = await self._send(base, s, method, url, **kwargs)
+        if self._is_auth_failure(status, history):
+            raise RuntimeError(f"Not authorized on {base} (status {status})")
+        # _send raises on error statuses, so this is a 2xx answer
+        self._last_valid[base] = time.time()
+        return body if isinstance(body, dict) else {}
+
+    # ---------------------- Authentication ----------------------
+    async def _do_login(self, server: dict, s: aiohttp.ClientSession) -> None:
+        base = server["url"].rstrip("/")
+        body = codec.dumps({"username": server.get("username", ""), "password": server.get("password", "")})
+        self.breaker.before_call(base)
+        timeout = self.latency.timeout(base, "login")
+        start = time.perf_counter()
+        code = "error"
+        try:
+            async with s.post(f"{base}/login", data=body, headers=codec.JSON_HEADERS,
+                              timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                code = str(r.status)
+                r.raise_for_status()
+                jr = await self._json(r)
+        except asyncio.TimeoutError:
+            self.latency.observe(base, "login", timeout, timed_out=True)
+            raise
+        finally:
+            self._observe(f"{base}/login", "POST", code, start, {"data": body})
+            if code != "error" and int(code) < 500:
+                self.breaker.record_success(base)
+                self.latency.observe(base, "login", time.perf_counter() - start)
+            else:
+                self.breaker.record_failure(base, f"POST login: {code}")
+        if not jr.get("success"):
+            raise RuntimeError(f"Login failed: {jr.get('msg', 'unknown error')}")
+        self._last_valid[base] = time.time()
+
+    async def login(self, server: dict) -> aiohttp.ClientSession:
+        """
+        Logs in to the server and returns a session.
+        If a valid session exists (within TTL), it is reused.
+        """
+        base = server["url"].rstrip("/")
+        s = self._get_session(base)
+        lock = self._login_locks.setdefault(base, asyncio.Lock())
+        async with lock:
+            if self._validate_session(base, s):
+                logging.info(f"Reusing session for {base}")
+                return s
+            try:
+                await self._do_login(server, s)
+                logging.info(f"Logged in via /login for {base}")
+                return s
+            except Exception as e:
+                logging.error(f"Login request error for {base}: {e}")
+                raise
+
+    def _list_reader(self, transform):
+        """Response reader for list endpoints: streamed through ListParser unless stream_lists is off."""
+        async def read(r):
+            if not self.stream_lists:
+                body = await self._json(r)
+                return apply_transform(body, transform) if isinstance(body, dict) else body
+            parser = ListParser(transform)
+            async for chunk in r.content.iter_chunked(STREAM_CHUNK):
+                parser.feed(chunk)
+            return parser.close()
+        return read
+
+    # ---------------------- Inbounds Management ----------------------
+    async def get_inbounds(self, server: dict, session=None, client_stats: bool = True):
+        base = server["url"].rstrip("/")
+        drop = () if client_stats else ("clientStats",)
+        try:
+            jr = await self._request(server, "GET", f"{base}/panel/api/inbounds/list",
+                                     reader=self._list_reader(lambda ib: InboundRecord.from_panel(ib, drop)))
+            return jr.get("obj") or []
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logging.error(f"Error fetching inbounds from {base}: {e}")
+            return []
+
+    async def _post(self, server: dict, url: str, what: str, payload=None, body: bytes = None) -> bool:
+        """POSTs to the panel; True if it answered success, errors are logged."""
+        base = server["url"].rstrip("/")
+        kwargs = {"json": payload} if body is None else {"data": body, "headers": codec.JSON_HEADERS}
+        try:
+            jr = await self._request(server, "POST", url, **kwargs)
+            if jr.get("success"):
+                return True
+            logging.error(f"Failed to {what} on {base}: {jr.get('msg', 'No message')}")
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logging.error(f"Error trying to {what} on {base}: {e}")
+        return False
+
+    async def add_inbound(self, server: dict, session, inbound: dict) -> bool:
+        base = server["url"].rstrip("/")
+        return await self._post(server, f"{base}/panel/api/inbounds/add", f"add inbound {inbound.get('id')}",
+                                body=self.payloads.inbound_body(inbound))
+
+    async def update_inbound(self, server: dict, session, inbound_id: int, inbound: dict) -> bool:
+        base = server["url"].rstrip("/")
+        return await self._post(server, f"{base}/panel/api/inbounds/update/{inbound_id}", f"update inbound {inbound_id}",
+                                body=self.payloads.inbound_body(inbound))
+
+    async def delete_inbound(self, server: dict, session, inbound_id: int) -> bool:
+        base = server["url"].rstrip("/")
+        return await self._post(server, f"{base}/panel/api/inbounds/del/{inbound_id}", f"delete inbound {inbound_id}")
+
+    # ---------------------- Client Management ----------------------
+    async def add_client(self, server: dict, session, inbound_id: int, client: dict) -> None:
+        await self._add_client_ok(server, inbound_id, client)
+
+    async def add_clients(self, server: dict, session, inbound_id: int, clients: list, chunk_size: int = None) -> int:
+        base = server["url"].rstrip("/")
+        chunk_size = max(1, int(chunk_size or self.add_clients_chunk_size))
+        added = 0
+        for i in range(0, len(clients), chunk_size):
+            chunk = clients[i:i + chunk_size]
+            if len(chunk) == 1:
+                added += await self._add_client_ok(server, inbound_id, chunk[0])
+                continue
+            try:
+                jr = await self._post_add_clients(server, inbound_id, chunk)
+                if jr.get("success"):
+                    added += len(chunk)
+                    continue
+                logging.warning(f"Batch add of {len(chunk)} clients failed on {base}: {jr.get('msg', 'No message')}; adding one by one")
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                logging.warning(f"Batch add of {len(chunk)} clients failed on {base}: {e}; adding one by one")
+            for client in chunk:
+                added += await self._add_client_ok(server, inbound_id, client)
+        return added
+
+    async def _post_add_clients(self, server: dict, inbound_id: int, clients: list) -> dict:
+        base = server["url"].rstrip("/")
+        return await self._request(server, "POST", f"{base}/panel/api/inbounds/addClient",
+                                   data=self.payloads.clients_body(inbound_id, clients), headers=codec.JSON_HEADERS)
+
+    async def _add_client_ok(self, server: dict, inbound_id: int, client: dict) -> bool:
+        base = server["url"].rstrip("/")
+        try:
+            jr = await self._post_add_clients(server, inbound_id, [client])
+            if jr.get("success"):
+                return True
+            logging.error(f"Failed to add client {client.get('email')} on {base}: {jr.get('msg', 'No message')}")
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logging.error(f"Error adding client {client.get('email')} on {base}: {e}")
+        return False
+
+    async def update_client(self, server: dict, session, client_id, inbound_id: int, client: dict) -> None:
+        base = server["url"].rstrip("/")
+        safe_id = quote(str(client_id), safe="")
+        await self._post(server, f"{base}/panel/api/inbounds/updateClient/{safe_id}", f"update client {client_id}",
+                         body=self.payloads.clients_body(inbound_id, [client]))
+
+    async def delete_client(self, server: dict, session, inbound_id: int, client_id) -> None:
+        base = server["url"].rstrip("/")
+        safe_id = quote(str(client_id), safe="")
+        await self._post(server, f"{base}/panel/api/inbounds/{inbound_id}/delClient/{safe_id}", f"delete client {client_id}")
+
+    # ---------------------- Traffic Management ----------------------
+    async def get_client_traffic(self, server: dict, session, email: str):
+        base = server["url"].rstrip("/")
+        safe_email = quote(email, safe="")
+        try:
+            jr = await self._request(server, "GET", f"{base}/panel/api/inbounds/getClientTraffics/{safe_email}")
+            if jr.get("success"):
+                obj = jr.get("obj") or {}
+                return int(obj.get("up", 0) or 0), int(obj.get("down", 0) or 0)
+            return (0, 0)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logging.error(f"Error fetching traffic for {email} on {base}: {e}")
+            return (0, 0)
+
+    async def get_traffic_map(self, server: dict, session=None):
+        base = server["url"].rstrip("/")
+        traffic = {}
+        try:
+            jr = await self._request(server, "GET", f"{base}/panel/api/inbounds/list",
+                                     reader=self._list_reader(
+                                         lambda ib: traffic.update(self.traffic_map_from_inbounds((ib,)))))
+            if not jr.get("success"):
+                logging.error(f"Failed to fetch traffic map from {base}: {jr.get('msg', 'No message')}")
+                return None
+            return traffic
+        except Exception as e:
+            logging.error(f"Error fetching traffic map from {base}: {e}")
+            return None
+
+    async def update_client_traffic(self, server: dict, session, email: str, up: int, down: int) -> bool:
+        base = server["url"].rstrip("/")
+        safe_email = quote(email, safe="")
+        payload = {"upload": int(up), "download": int(down)}
+        return await self._post(server, f"{base}/panel/api/inbounds/updateClientTraffic/{safe_email}",
+                         f"update traffic for {email}", payload)
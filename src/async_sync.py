@@ -0,0 +1,328 @@
+import time
+import asyncio
+import logging
+
+from .sync import SyncManager
+from .breaker import CircuitOpenError
+from .snapshot import CentralSnapshot
+from .reconcile import config_hash, fingerprints
+from . import metrics
+from .tracing import tracer
+
+
+class AsyncSyncManager(SyncManager):
+    """
+    SyncManager driver for AsyncAPIManager (net.engine = "asyncio").
+    Reconciliation planning and the traffic delta engine are inherited unchanged;
+    only the panel I/O runs as coroutines on one event loop owned by this object.
+    """
+
+    def __init__(self, api_manager, config_manager, traffic_state_manager):
+        super().__init__(api_manager, config_manager, traffic_state_manager)
+        self._loop = asyncio.new_event_loop()
+        self._central_write_lock = None  # asyncio.Lock, created on the loop
+
+    def _run(self, coro):
+        return self._loop.run_until_complete(coro)
+
+    def _limits(self):
+        net_opts = self.config_manager.net()
+        global_limit = max(1, int(net_opts.get('async_max_inflight', 100) or 1))
+        per_server_limit = max(1, int(net_opts.get('per_server_max_inflight', 4) or 1))
+        return global_limit, per_server_limit
+
+    def close(self):
+        try:
+            self._run(self.api_manager.close())
+        finally:
+            self._loop.close()
+        super().close()
+
+    # -------------------------------
+    # Central snapshot
+    # -------------------------------
+    def fetch_central_snapshot(self):
+        return self._run(self._fetch_central_snapshot())
+
+    async def _fetch_central_snapshot(self):
+        central = self.config_manager.get_central_server()
+        try:
+            central_session = await self.api_manager.login(central)
+            central_inbounds = await self.api_manager.get_inbounds(central, central_session)
+        except Exception as e:
+            logging.error(f"Failed to connect to central server: {e}")
+            return None
+        if not central_inbounds:
+            logging.error("No inbounds retrieved from central server")
+            return None
+        return CentralSnapshot(
+            central_inbounds,
+            session=central_session,
+            traffic=self.api_manager.traffic_map_from_inbounds(central_inbounds),
+        )
+
+    # -------------------------------
+    # Inbounds & Clients synchronization
+    # -------------------------------
+    def sync_inbounds_and_clients(self, snapshot=None):
+        self._run(self._sync_inbounds_and_clients(snapshot))
+
+    async def _sync_inbounds_and_clients(self, snapshot):
+        central = self.config_manager.get_central_server()
+        nodes = self.config_manager.get_nodes()
+
+        if snapshot is None:
+            snapshot = await self._fetch_central_snapshot()
+        if not snapshot:
+            logging.error("No central snapshot available, skipping sync")
+            return
+        # Central keeps counting while nodes are reconciled
+        snapshot.traffic_stale = True
+
+        if self._central_write_lock is None:
+            self._central_write_lock = asyncio.Lock()
+        snapshot.index_clients(self._client_map, self._is_safu_fresh)
+        force = self._next_reconcile_forced()
+        try:
+            await asyncio.gather(*(self._sync_node_async(node, central, snapshot, force) for node in nodes))
+        finally:
+            self.api_manager.clear_payloads()
+
+    async def _sync_node_async(self, node, central, snapshot, force=True):
+        api = self.api_manager
+        node_label = metrics.server_label(node['url'])
+        if api.circuit_open(node):
+            logging.warning(f"[BREAKER] {node['url']}: circuit open, skipping node this cycle")
+            metrics.NODES_SKIPPED.inc(node=node_label, reason='circuit_open')
+            return
+        try:
+            with tracer.span('node_fetch', node=node_label) as sp:
+                node_session = await api.login(node)
+                node_inbounds = await api.get_inbounds(node, node_session, client_stats=False)
+                sp['inbounds'] = len(node_inbounds)
+            node_fps = fingerprints(node_inbounds)
+            if self._node_unchanged(node, snapshot, config_hash(node_fps), force):
+                logging.info(f"[PLAN] {node['url']}: unchanged since last sync, skipped")
+                metrics.NODES_SKIPPED.inc(node=node_label, reason='unchanged')
+                return
+            full_replace = self._full_replace(node)
+            with tracer.span('node_plan', node=node_label) as sp:
+                visit = self._inbounds_to_visit(node, snapshot, node_fps, force)
+                plan, promotions = self._plan_node(node['url'], snapshot, node_inbounds,
+                                                   full_replace=full_replace, visit=visit)
+                self._record_node_state(node['url'], snapshot, node_fps, plan, promotions, visit)
+                sp.update(visited=len(visit) if visit is not None else len(snapshot.inbounds),
+                          inbound_ops=len(plan.inbound_ops), client_ops=len(plan.client_ops),
+                          promotions=len(promotions))
+
+            # Central writes from all nodes are serialized
+            if promotions:
+                with tracer.span('node_safu_promotions', node=node_label, ops=len(promotions)):
+                    for cid, k, client_id, ccl, central_exp, merged in promotions:
+                        async with self._central_write_lock:
+                            await api.update_client(central, snapshot.session, client_id, cid, ccl)
+                        logging.info(f"[SAFU-MERGE] expiryTime merged to central for client {k} (inbound {cid}): {central_exp} -> {merged}")
+
+            inbounds_ok = True
+            with tracer.span('node_inbound_sync', node=node_label, ops=len(plan.inbound_ops)):
+                for op, inbound_id, inbound in plan.inbound_ops:
+                    if op == 'add':
+                        ok = await api.add_inbound(node, node_session, inbound)
+                    elif op == 'update':
+                        ok = await api.update_inbound(node, node_session, inbound_id, inbound)
+                    else:
+                        ok = await api.delete_inbound(node, node_session, inbound_id)
+                    inbounds_ok = inbounds_ok and bool(ok)
+
+            with tracer.span('node_client_sync', node=node_label, ops=len(plan.client_ops)):
+                for op, inbound_id, k, client_id, client in plan.batched_client_ops():
+                    try:
+                        if op == 'add':
+                            await api.add_clients(node, node_session, inbound_id, client)
+                        elif op == 'update':
+                            await api.update_client(node, node_session, client_id, inbound_id, client)
+                        else:
+                            await api.delete_client(node, node_session, inbound_id, client_id)
+                    except CircuitOpenError:
+                        raise
+                    except Exception as _e:
+                        logging.error(f"Failed to {op} client {k} on node: {_e}")
+
+            logging.info(f"[PLAN] {node['url']}: {plan.summary()}")
+            self._full_replace_applied(node, full_replace, inbounds_ok)
+
+        except CircuitOpenError as e:
+            logging.warning(f"[BREAKER] {node['url']}: {e}; skipping rest of node sync")
+            metrics.NODES_SKIPPED.inc(node=node_label, reason='circuit_open')
+        except Exception as e:
+            logging.error(f"Error syncing with node {node['url']}: {e}")
+
+    # -------------------------------
+    # Traffic synchronization
+    # -------------------------------
+    def sync_traffic(self, snapshot=None, bulk_only=False):
+        self._run(self._sync_traffic(snapshot, bulk_only))
+
+    async def _login_nodes(self, nodes):
+        async def one(node):
+            if self.api_manager.circuit_open(node):
+                logging.warning(f"[BREAKER] {node['url']}: circuit open, skipping node this run")
+                return node['url'], None
+            try:
+                return node['url'], await self.api_manager.login(node)
+            except Exception as e:
+                logging.error(f"Failed to login node {node['url']}: {e}")
+                return node['url'], None
+        results = await asyncio.gather(*(one(node) for node in nodes))
+        return {url: sess for url, sess in results if sess is not None}
+
+    async def _fetch_traffic_maps_async(self, nodes_by_url, node_sessions):
+        async def one(srv_url, sess):
+            try:
+                return srv_url, await self.api_manager.get_traffic_map(nodes_by_url[srv_url], sess)
+            except Exception as e:
+                logging.error(f"Bulk traffic fetch failed on {srv_url}: {e}")
+                return srv_url, None
+        results = await asyncio.gather(*(one(u, s) for u, s in node_sessions.items() if u in nodes_by_url))
+        return dict(results)
+
+    async def _stream_node_traffic_async(self, nodes_by_url, node_sessions, emails):
+        """Async version of _stream_node_traffic: yields (email, {srv_url: pair or None})."""
+        global_limit, per_server_limit = self._limits()
+        global_sem = asyncio.Semaphore(global_limit)
+        server_sems = {srv_url: asyncio.Semaphore(per_server_limit) for srv_url in node_sessions}
+
+        async def read(srv_url, sess, email):
+            async with global_sem, server_sems[srv_url]:
+                try:
+                    return srv_url, await self.api_manager.get_client_traffic(nodes_by_url[srv_url], sess, email)
+                except Exception as e:
+                    logging.error(f"Traffic fetch failed for {email} on {srv_url}: {e}")
+                    return srv_url, None
+
+        # A fixed pool of workers pulls emails from one iterator and hands results over a
+        # bounded queue, so only about global_limit emails are in flight or buffered at a time
+        pending = iter(emails)
+        results = asyncio.Queue(maxsize=global_limit)
+        done = object()
+
+        async def worker():
+            for email in pending:  # read() never raises, so each worker ends with `done`
+                fetched = await asyncio.gather(*(read(u, s, email) for u, s in node_sessions.items()))
+                await results.put((email, dict(fetched)))
+            await results.put(done)
+
+        workers = [asyncio.create_task(worker()) for _ in range(max(1, global_limit))]
+        try:
+            running = len(workers)
+            while running:
+                item = await results.get()
+                if item is done:
+                    running -= 1
+                else:
+                    yield item
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _sync_traffic(self, snapshot, bulk_only=False):
+        central = self.config_manager.get_central_server()
+        nodes = self.config_manager.get_nodes()
+        net_opts = self.config_manager.net()
+        delta_cap = int(net_opts.get('delta_max_bytes_per_interval', 0) or 0)
+
+        if snapshot is None:
+            snapshot = await self._fetch_central_snapshot()
+        if not snapshot:
+            logging.error("No central snapshot available, skipping traffic sync")
+            return
+        central_sess = snapshot.session
+        client_emails = snapshot.emails
+
+        nodes_by_url = {node['url']: node for node in nodes}
+        with tracer.span('traffic_reads', nodes=len(nodes)) as sp:
+            if snapshot.traffic_stale:
+                # Reconciliation ran since the snapshot was taken: re-read central's counters
+                traffic = await self.api_manager.get_traffic_map(central, central_sess)
+                if traffic is None:
+                    logging.error("Failed to refresh central traffic counters, skipping traffic sync")
+                    return
+                snapshot.traffic, snapshot.traffic_stale = traffic, False
+            node_sessions = await self._login_nodes(nodes)
+            node_traffic = await self._fetch_traffic_maps_async(nodes_by_url, node_sessions)
+            fallback_sessions = {srv_url: sess for srv_url, sess in node_sessions.items()
+                                 if node_traffic.get(srv_url) is None}
+            sp['fallback_nodes'] = len(fallback_sessions)
+        if fallback_sessions:
+            logging.warning(f"Bulk traffic read failed for {len(fallback_sessions)} node(s); "
+                            f"{'skipping them this run' if bulk_only else 'using per-email fallback'}.")
+        # In bulk-only runs a node whose bulk read failed is left out of write-backs too
+        # (it is most likely down), so its baselines stay untouched until it answers again
+        write_sessions = node_sessions
+        if bulk_only and fallback_sessions:
+            write_sessions = {u: sess for u, sess in node_sessions.items() if u not in fallback_sessions}
+
+        self.traffic_write_stats = {}
+        self._pending_writes = []
+        self.traffic_state_manager.begin_batch()
+        try:
+            loop_start = time.perf_counter()
+            delta_engine = self._delta_engine()
+            if (not fallback_sessions or bulk_only) and delta_engine != 'per_email':
+                self._sync_traffic_batch(client_emails, central, central_sess, snapshot.traffic, node_traffic,
+                                         nodes_by_url, write_sessions, delta_cap, delta_engine == 'numpy')
+            elif not fallback_sessions or bulk_only:
+                currents_iter = self._iter_traffic_currents(
+                    client_emails, central['url'], snapshot.traffic, node_traffic,
+                    nodes_by_url, fallback_sessions, False, bulk_only=True
+                )
+                for email, currents_by_server in currents_iter:
+                    self._sync_email_traffic(email, currents_by_server, central, central_sess,
+                                             nodes_by_url, write_sessions, delta_cap)
+            else:
+                async for email, fetched in self._stream_node_traffic_async(nodes_by_url, fallback_sessions, client_emails):
+                    currents_by_server = {central['url']: snapshot.traffic.get(email, (0, 0))}
+                    for srv_url, tmap in node_traffic.items():
+                        if tmap is not None:
+                            currents_by_server[srv_url] = tmap.get(email, (0, 0))
+                    currents_by_server.update(fetched)
+                    self._sync_email_traffic(email, currents_by_server, central, central_sess,
+                                             nodes_by_url, write_sessions, delta_cap)
+            tracer.record('traffic_deltas', time.perf_counter() - loop_start,
+                          emails=len(client_emails), fallback_nodes=len(fallback_sessions))
+            with tracer.span('traffic_write_back', writes=len(self._pending_writes)):
+                await self._flush_pending_writes_async()
+        finally:
+            self._pending_writes = None
+            with tracer.span('db_flush'):
+                self.traffic_state_manager.commit_batch()
+        self.traffic_state_manager.evict_inactive(client_emails)
+        self._log_write_stats()
+
+    async def _flush_pending_writes_async(self):
+        """Async _flush_pending_writes: the queued writes go out concurrently."""
+        global_limit, per_server_limit = self._limits()
+        global_sem = asyncio.Semaphore(global_limit)
+        server_sems = {}
+
+        async def write(server, sess, email, total_up, total_down, prev, tag, label):
+            srv_url = server['url']
+            sem = server_sems.setdefault(srv_url, asyncio.Semaphore(per_server_limit))
+            async with global_sem, sem:
+                try:
+                    ok = bool(await self.api_manager.update_client_traffic(server, sess, email, total_up, total_down))
+                except Exception as e:
+                    ok = False
+                    logging.error(f"[{tag}] Failed to write total to {label} for {email}: {e}")
+            self._record_write(email, srv_url, total_up, total_down, prev, ok)
+
+        pending, self._pending_writes = self._pending_writes, []
+        if pending:
+            # Totals and the baselines these writes leave behind are stored before any goes out
+            self.traffic_state_manager.flush()
+        # Central first, as in the threads engine: an unwritten central counter below its
+        # stored baseline would read as a central reset after a crash
+        central_url = self.config_manager.get_central_server()['url']
+        await asyncio.gather(*(write(*w) for w in pending if w[0]['url'] == central_url))
+        await asyncio.gather(*(write(*w) for w in pending if w[0]['url'] != central_url))
@@ -0,0 +1,110 @@
+# src/breaker.py
+import time
+import logging
+import threading
+
+from . import metrics
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a panel whose circuit breaker is open."""
+
+
+class _Circuit:
+    __slots__ = ("failures", "opened_at", "backoff", "probing")
+
+    def __init__(self):
+        self.failures = 0       # consecutive failures
+        self.opened_at = None   # monotonic time the circuit (re)opened; None = closed
+        self.backoff = 0.0      # seconds until the next half-open probe
+        self.probing = False    # a half-open probe call is in flight
+
+
+class CircuitBreaker:
+    """
+    Per-base-URL circuit breaker for panel calls:
+    - closed: calls go through; failure_threshold consecutive failures (no response,
+      timeout or 5xx) open the circuit
+    - open: calls fail fast with CircuitOpenError for `backoff` seconds
+    - half-open: once the backoff has passed, one call is let through as a probe;
+      success closes the circuit, failure reopens it with the backoff doubled
+      (up to max_reset_seconds)
+    failure_threshold <= 0 disables the breaker. State changes are logged with [BREAKER].
+    """
+
+    def __init__(self, failure_threshold=3, reset_seconds=30, max_reset_seconds=300, clock=time.monotonic):
+        self.failure_threshold = int(failure_threshold or 0)
+        self.reset_seconds = max(1.0, float(reset_seconds or 1))
+        self.max_reset_seconds = max(self.reset_seconds, float(max_reset_seconds or 0))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._circuits = {}  # base_url -> _Circuit
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def _circuit(self, base) -> _Circuit:
+        c = self._circuits.get(base)
+        if c is None:
+            c = self._circuits[base] = _Circuit()
+        return c
+
+    def before_call(self, base) -> None:
+        """Raises CircuitOpenError unless a call to base may go out now."""
+        if not self.enabled:
+            return
+        with self._lock:
+            c = self._circuits.get(base)
+            if c is None or c.opened_at is None:
+                return
+            wait = c.opened_at + c.backoff - self._clock()
+            if wait > 0 or c.probing:
+                raise CircuitOpenError(f"circuit open for {base} (next probe in {max(0.0, wait):.0f}s)")
+            c.probing = True
+        logging.info(f"[BREAKER] {base}: half-open, sending probe")
+
+    def is_open(self, base) -> bool:
+        """True while calls to base would fail fast (open and not yet due for a probe)."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            c = self._circuits.get(base)
+            if c is None or c.opened_at is None:
+                return False
+            return c.probing or self._clock() < c.opened_at + c.backoff
+
+    def record_success(self, base) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            c = self._circuits.get(base)
+            if c is None:
+                return
+            was_open = c.opened_at is not None
+            c.failures, c.opened_at, c.backoff, c.probing = 0, None, 0.0, False
+        if was_open:
+            metrics.BREAKER_OPEN.set(0, server=metrics.server_label(base))
+            logging.info(f"[BREAKER] {base}: closed, probe succeeded")
+
+    def record_failure(self, base, reason="") -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            c = self._circuit(base)
+            c.failures += 1
+            if c.probing:
+                # Failed probe: reopen with a longer backoff
+                c.probing = False
+                c.opened_at = self._clock()
+                c.backoff = min(self.max_reset_seconds, c.backoff * 2)
+                msg = f"[BREAKER] {base}: probe failed ({reason}); open for {c.backoff:.0f}s"
+            elif c.opened_at is None and c.failures >= self.failure_threshold:
+                c.opened_at = self._clock()
+                c.backoff = self.reset_seconds
+                msg = f"[BREAKER] {base}: open after {c.failures} consecutive failures ({reason}); open for {c.backoff:.0f}s"
+            else:
+                return
+        metrics.BREAKER_OPEN.set(1, server=metrics.server_label(base))
+        metrics.BREAKER_TRIPS.inc(server=metrics.server_label(base))
+        logging.warning(msg)
@@ -0,0 +1,126 @@
+# src/codec.py
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json produces equivalent documents, only slower
+    orjson = None
+
+from . import metrics
+
+# Request headers for bodies encoded with dumps()
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Compressed responses; both HTTP clients decompress them transparently (also while streaming)
+ACCEPT_ENCODING = "gzip, deflate"
+
+_use_orjson = orjson is not None
+
+
+def orjson_available() -> bool:
+    return orjson is not None
+
+
+def configure(codec="auto") -> str:
+    """
+    Selects the JSON backend: 'auto' (orjson when installed), 'orjson' or 'json'.
+    Returns the backend in use.
+    """
+    global _use_orjson
+    codec = str(codec or "auto").lower()
+    if codec == "orjson" and orjson is None:
+        logging.warning("json_codec=orjson but orjson is not installed; using stdlib json")
+    _use_orjson = orjson is not None and codec in ("auto", "orjson")
+    return backend()
+
+
+def backend() -> str:
+    return "orjson" if _use_orjson else "json"
+
+
+def dumps(obj) -> bytes:
+    """Compact UTF-8 JSON document."""
+    if _use_orjson:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # e.g. non-str keys or integers beyond 64 bits
+            pass
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def dumps_str(obj) -> str:
+    """dumps() as text, for JSON documents embedded in string fields (settings)."""
+    return dumps(obj).decode("utf-8")
+
+
+def loads(data):
+    """Parses a JSON document from str or bytes."""
+    if _use_orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # re-raised below with stdlib's message (or parsed, e.g. integers beyond 64 bits)
+    return json.loads(data)
+
+
+class PayloadCache:
+    """
+    Request bodies serialized once and reused across nodes within a cycle: the same
+    central client (or inbound) pushed to ten nodes is encoded once, not ten times.
+    Entries are keyed by the identity of the source objects and kept only while each
+    of them still has the same fields (shallow comparison), so an object changed in
+    place (e.g. a SAFU promotion) is encoded again. The cache holds references to its
+    objects, which keeps their ids from being reused; it is bounded by max_bytes and
+    emptied with clear() after each reconciliation pass, so neither the objects nor
+    their bodies outlive the cycle they were built in.
+    """
+
+    def __init__(self, max_bytes=8 * 2**20):
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (objs, fields, body)
+        self._bytes = 0
+
+    def body(self, key, objs, build) -> bytes:
+        """
+        Body for key (a tuple that identifies the request) built from objs (dicts);
+        build() encodes it on a miss.
+        """
+        key = key + tuple(map(id, objs))
+        fields = [tuple(o.items()) for o in objs]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == fields:
+                self._entries.move_to_end(key)
+                metrics.PAYLOAD_CACHE.inc(result="hit")
+                return entry[2]
+        data = build()
+        metrics.PAYLOAD_CACHE.inc(result="miss")
+        if len(data) > self.max_bytes:
+            return data
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[2])
+            self._entries[key] = (tuple(objs), fields, data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+        return data
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def clients_body(self, inbound_id, clients) -> bytes:
+        """addClient/updateClient body: {"id": inbound_id, "settings": '{"clients": [...]}'}."""
+        return self.body(("clients", inbound_id), clients,
+                         lambda: dumps({"id": inbound_id, "settings": dumps_str({"clients": list(clients)})}))
+
+    def inbound_body(self, inbound) -> bytes:
+        """inbounds/add or inbounds/update body for one inbound."""
+        return self.body(("inbound",), (inbound,), lambda: dumps(inbound))
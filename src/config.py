@@ -9,6 +9,14 @@ def _parse_bool(val, default=False):
     v = str(val).strip().lower()
     return v in ("1", "true", "yes", "on")
 
+def _parse_float(val, default):
+    if val is None:
+        return default
+    try:
+        return float(str(val).strip())
+    except Exception:
+        return default
+
 def _parse_int(val, default):
     if val is None:
         return default
@@ -32,12 +40,42 @@ class ConfigManager:
 
                 # --- Set default values if missing ---
                 config.setdefault('sync_interval_minutes', 1)
+                # Traffic sync in its own loop every N seconds (0 = together with inbounds, every sync_interval_minutes)
+                config.setdefault('traffic_interval_seconds', 0)
+                # Random delay (0..N seconds) added to each scheduled run
+                config.setdefault('schedule_jitter_seconds', 0)
+                # Full reconciliation of unchanged nodes every N cycles (0 = only when something changed)
+                config.setdefault('force_resync_cycles', 10)
+                # Per-node full replace (SYNC_FULL_REPLACE sets it for nodes that do not say otherwise)
+                full_replace = _parse_bool(os.getenv("SYNC_FULL_REPLACE"), False)
+                for node in config['nodes']:
+                    node.setdefault('full_replace', full_replace)
                 config.setdefault('net', {})
                 config.setdefault('db', {})
+                config.setdefault('metrics', {})
+                config.setdefault('trace', {})
                 config['net'].setdefault('parallel_node_calls', True)
                 config['net'].setdefault('max_workers', 8)
                 config['net'].setdefault('request_timeout', 10)
                 config['net'].setdefault('connect_pool_size', 50)
+                config['net'].setdefault('per_server_max_inflight', 4)
+                config['net'].setdefault('retries', 2)
+                config['net'].setdefault('retry_backoff', 0.3)
+                config['net'].setdefault('engine', 'threads')  # threads | asyncio
+                config['net'].setdefault('async_max_inflight', 100)
+                config['net'].setdefault('add_clients_chunk_size', 100)
+                config['net'].setdefault('delta_engine', 'auto')  # auto | numpy | python | per_email
+                # Per-panel circuit breaker (breaker_failures 0 = disabled)
+                config['net'].setdefault('breaker_failures', 3)
+                config['net'].setdefault('breaker_reset_seconds', 30)
+                config['net'].setdefault('breaker_max_reset_seconds', 300)
+                # Per-server, per-endpoint timeouts from observed latency, within these bounds
+                config['net'].setdefault('adaptive_timeouts', True)
+                config['net'].setdefault('timeout_min_seconds', 2)
+                config['net'].setdefault('timeout_max_seconds', 60)
+                # Parse inbound lists incrementally as they download (lower peak memory, more CPU)
+                config['net'].setdefault('stream_lists', True)
+                config['net'].setdefault('json_codec', 'auto')  # auto | orjson | json (auto = orjson when installed)
                 # NEW: TTL for session validation
                 config['net'].setdefault('validate_ttl_seconds', 60)
 
@@ -45,12 +83,33 @@ class ConfigManager:
                 config['db'].setdefault('synchronous', 'NORMAL')  # Options: FULL/NORMAL/OFF
                 config['db'].setdefault('cache_size_mb', 20)
 
+                config['metrics'].setdefault('enabled', False)
+                config['metrics'].setdefault('host', '127.0.0.1')
+                config['metrics'].setdefault('port', 9108)
+
+                config['trace'].setdefault('enabled', False)       # JSON span records in DATA_DIR/trace.jsonl
+                config['trace'].setdefault('slow_call_ms', 2000)   # 0 disables slow-call logging
+                config['trace'].setdefault('profile', False)       # cProfile dump per cycle
+                config['trace'].setdefault('profile_keep', 5)
+
                 # --- Override config values with environment variables ---
                 # sync interval
                 config['sync_interval_minutes'] = _parse_int(
                     os.getenv("SYNC_INTERVAL_MINUTES"),
                     config['sync_interval_minutes']
                 )
+                config['traffic_interval_seconds'] = _parse_int(
+                    os.getenv("SYNC_TRAFFIC_INTERVAL_SECONDS"),
+                    config['traffic_interval_seconds']
+                )
+                config['schedule_jitter_seconds'] = _parse_float(
+                    os.getenv("SYNC_JITTER_SECONDS"),
+                    config['schedule_jitter_seconds']
+                )
+                config['force_resync_cycles'] = _parse_int(
+                    os.getenv("SYNC_FORCE_RESYNC_CYCLES"),
+                    config['force_resync_cycles']
+                )
 
                 # network settings
                 config['net']['parallel_node_calls'] = _parse_bool(
@@ -69,6 +128,75 @@ class ConfigManager:
                     os.getenv("NET_CONNECT_POOL_SIZE"),
                     config['net']['connect_pool_size']
                 )
+                config['net']['per_server_max_inflight'] = _parse_int(
+                    os.getenv("NET_PER_SERVER_MAX_INFLIGHT"),
+                    config['net']['per_server_max_inflight']
+                )
+                config['net']['retries'] = _parse_int(
+                    os.getenv("NET_RETRIES"),
+                    config['net']['retries']
+                )
+                config['net']['retry_backoff'] = _parse_float(
+                    os.getenv("NET_RETRY_BACKOFF"),
+                    config['net']['retry_backoff']
+                )
+                engine_env = os.getenv("NET_ENGINE")
+                if engine_env is not None:
+                    engine = str(engine_env).strip().lower()
+                    if engine in ("threads", "asyncio"):
+                        config['net']['engine'] = engine
+                    else:
+                        logging.warning(f"Invalid NET_ENGINE='{engine_env}', keeping '{config['net']['engine']}'")
+                delta_engine_env = os.getenv("NET_DELTA_ENGINE")
+                if delta_engine_env is not None:
+                    delta_engine = str(delta_engine_env).strip().lower()
+                    if delta_engine in ("auto", "numpy", "python", "per_email"):
+                        config['net']['delta_engine'] = delta_engine
+                    else:
+                        logging.warning(f"Invalid NET_DELTA_ENGINE='{delta_engine_env}', keeping '{config['net']['delta_engine']}'")
+                config['net']['async_max_inflight'] = _parse_int(
+                    os.getenv("NET_ASYNC_MAX_INFLIGHT"),
+                    config['net']['async_max_inflight']
+                )
+                config['net']['add_clients_chunk_size'] = _parse_int(
+                    os.getenv("NET_ADD_CLIENTS_CHUNK_SIZE"),
+                    config['net']['add_clients_chunk_size']
+                )
+                config['net']['breaker_failures'] = _parse_int(
+                    os.getenv("NET_BREAKER_FAILURES"),
+                    config['net']['breaker_failures']
+                )
+                config['net']['breaker_reset_seconds'] = _parse_int(
+                    os.getenv("NET_BREAKER_RESET_SECONDS"),
+                    config['net']['breaker_reset_seconds']
+                )
+                config['net']['breaker_max_reset_seconds'] = _parse_int(
+                    os.getenv("NET_BREAKER_MAX_RESET_SECONDS"),
+                    config['net']['breaker_max_reset_seconds']
+                )
+                config['net']['adaptive_timeouts'] = _parse_bool(
+                    os.getenv("NET_ADAPTIVE_TIMEOUTS"),
+                    config['net']['adaptive_timeouts']
+                )
+                config['net']['timeout_min_seconds'] = _parse_float(
+                    os.getenv("NET_TIMEOUT_MIN_SECONDS"),
+                    config['net']['timeout_min_seconds']
+                )
+                config['net']['timeout_max_seconds'] = _parse_float(
+                    os.getenv("NET_TIMEOUT_MAX_SECONDS"),
+                    config['net']['timeout_max_seconds']
+                )
+                config['net']['stream_lists'] = _parse_bool(
+                    os.getenv("NET_STREAM_LISTS"),
+                    config['net']['stream_lists']
+                )
+                json_codec_env = os.getenv("NET_JSON_CODEC")
+                if json_codec_env is not None:
+                    json_codec = str(json_codec_env).strip().lower()
+                    if json_codec in ("auto", "orjson", "json"):
+                        config['net']['json_codec'] = json_codec
+                    else:
+                        logging.warning(f"Invalid NET_JSON_CODEC='{json_codec_env}', keeping '{config['net']['json_codec']}'")
                 # NEW: TTL override from ENV
                 config['net']['validate_ttl_seconds'] = _parse_int(
                     os.getenv("NET_VALIDATE_TTL_SECONDS"),
@@ -93,6 +221,32 @@ class ConfigManager:
                     config['db']['cache_size_mb']
                 )
 
+                # metrics endpoint
+                metrics_enabled_env = os.getenv("METRICS_ENABLED")
+                if metrics_enabled_env is not None:
+                    config['metrics']['enabled'] = _parse_bool(metrics_enabled_env, config['metrics']['enabled'])
+                config['metrics']['host'] = os.getenv("METRICS_HOST", config['metrics']['host'])
+                config['metrics']['port'] = _parse_int(
+                    os.getenv("METRICS_PORT"),
+                    config['metrics']['port']
+                )
+
+                # tracing / profiling
+                trace_enabled_env = os.getenv("TRACE_ENABLED")
+                if trace_enabled_env is not None:
+                    config['trace']['enabled'] = _parse_bool(trace_enabled_env, config['trace']['enabled'])
+                config['trace']['slow_call_ms'] = _parse_int(
+                    os.getenv("TRACE_SLOW_CALL_MS"),
+                    config['trace']['slow_call_ms']
+                )
+                profile_env = os.getenv("PROFILE_CYCLES")
+                if profile_env is not None:
+                    config['trace']['profile'] = _parse_bool(profile_env, config['trace']['profile'])
+                config['trace']['profile_keep'] = _parse_int(
+                    os.getenv("PROFILE_KEEP"),
+                    config['trace']['profile_keep']
+                )
+
                 return config
 
         except FileNotFoundError:
@@ -114,8 +268,23 @@ class ConfigManager:
     def get_interval(self):
         return self.config.get('sync_interval_minutes', 1)
 
+    def get_traffic_interval_seconds(self):
+        return self.config.get('traffic_interval_seconds', 0)
+
+    def get_schedule_jitter_seconds(self):
+        return self.config.get('schedule_jitter_seconds', 0)
+
+    def get_force_resync_cycles(self):
+        return self.config.get('force_resync_cycles', 10)
+
     def net(self):
         return self.config.get('net', {})
 
     def db(self):
         return self.config.get('db', {})
+
+    def metrics(self):
+        return self.config.get('metrics', {})
+
+    def trace(self):
+        return self.config.get('trace', {})
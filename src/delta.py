@@ -0,0 +1,166 @@
+# src/delta.py
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:  # optional: the pure-Python engine gives identical results
+    np = None
+
+# int64 headroom: larger counters (never seen in practice) fall back to the Python engine
+_NUMPY_MAX = 1 << 62
+
+
+class DeltaChanges:
+    """
+    Compact result of one batch delta run over an emails x servers matrix (column 0
+    is central). Indices refer to the rows/columns of the input matrix.
+    - resets:      rows that need a cycle reset (first observation, central reset or
+                   unreadable central counter); they go through the per-email path
+    - baselines:   (row, col, up, down) baselines that change to the current counter
+    - node_deltas: (row, col, du, dd) positive per-server deltas to accumulate
+    - totals:      (row, up, down, added_up, added_down) rows whose total changed
+    - skipped:     (row, col) failed reads, baseline kept
+    - dropped:     (row, col, last_up, last_down, cur_up, cur_down) counter drops (delta 0)
+    - clamped:     (row, col, du + dd) deltas dropped by the cap
+    """
+
+    __slots__ = ("resets", "baselines", "node_deltas", "totals", "skipped", "dropped", "clamped")
+
+    def __init__(self):
+        self.resets = []
+        self.baselines = []
+        self.node_deltas = []
+        self.totals = []
+        self.skipped = []
+        self.dropped = []
+        self.clamped = []
+
+
+def numpy_available() -> bool:
+    return np is not None
+
+
+def compute_deltas(currents, lasts, totals, delta_cap=0, use_numpy=None) -> DeltaChanges:
+    """
+    Delta step of the traffic sync for every (email, server) pair at once, with the
+    same rules as SyncManager._sync_email_traffic:
+    - a pair is skipped when its read failed (current None)
+    - a pair seen for the first time only gets its baseline set
+    - both directions below the baseline is a counter reset: delta 0
+    - otherwise delta = max(0, current - baseline) per direction, dropped entirely
+      when delta_cap > 0 and up + down exceeds it
+    - every pair read gets baseline = current; deltas are added to the email's total
+    currents / lasts: rows of per-server (up, down) or None; totals: rows of (up, down).
+    use_numpy: None = NumPy when installed.
+    """
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy and np is not None and currents:
+        ch = _compute_numpy(currents, lasts, totals, delta_cap)
+        if ch is not None:
+            return ch
+    return _compute_python(currents, lasts, totals, delta_cap)
+
+
+def _is_reset(cur, last) -> bool:
+    # Central (column 0): unreadable, never seen, or both directions dropped
+    return cur is None or last is None or (cur[0] < last[0] and cur[1] < last[1])
+
+
+def _compute_python(currents, lasts, totals, delta_cap) -> DeltaChanges:
+    ch = DeltaChanges()
+    for r, (row_cur, row_last) in enumerate(zip(currents, lasts)):
+        if _is_reset(row_cur[0], row_last[0]):
+            ch.resets.append(r)
+            continue
+        added_up = added_down = 0
+        for c, (cur, last) in enumerate(zip(row_cur, row_last)):
+            if cur is None:
+                ch.skipped.append((r, c))
+                continue
+            cur_up, cur_down = cur
+            if last is None:
+                ch.baselines.append((r, c, cur_up, cur_down))
+                continue
+            last_up, last_down = last
+            if cur_up < last_up and cur_down < last_down:
+                du = dd = 0
+                ch.dropped.append((r, c, last_up, last_down, cur_up, cur_down))
+            else:
+                du = max(0, cur_up - last_up)
+                dd = max(0, cur_down - last_down)
+            if delta_cap > 0 and (du + dd) > delta_cap:
+                ch.clamped.append((r, c, du + dd))
+                du = dd = 0
+            if (cur_up, cur_down) != (last_up, last_down):
+                ch.baselines.append((r, c, cur_up, cur_down))
+            if du > 0 or dd > 0:
+                added_up += du
+                added_down += dd
+                ch.node_deltas.append((r, c, du, dd))
+        if added_up or added_down:
+            tot_up, tot_down = totals[r]
+            ch.totals.append((r, tot_up + added_up, tot_down + added_down, added_up, added_down))
+    return ch
+
+
+def _matrix(rows):
+    """(up, down, present) int64/bool arrays from rows of (up, down) or None."""
+    shape = (len(rows), len(rows[0]))
+    flat = [p for row in rows for p in row]
+    present = np.fromiter((p is not None for p in flat), dtype=bool, count=len(flat)).reshape(shape)
+    pairs = np.fromiter(chain.from_iterable([p if p is not None else (0, 0) for p in flat]),
+                        dtype=np.int64, count=2 * len(flat)).reshape(shape + (2,))
+    return pairs[..., 0], pairs[..., 1], present
+
+
+def _compute_numpy(currents, lasts, totals, delta_cap):
+    """NumPy engine; returns None when a counter does not fit int64 with headroom."""
+    try:
+        cu, cd, valid = _matrix(currents)
+        lu, ld, has_last = _matrix(lasts)
+        tot = np.fromiter(chain.from_iterable(totals), dtype=np.int64, count=2 * len(totals)).reshape(-1, 2)
+    except OverflowError:
+        return None
+    if max(int(a.max()) for a in (cu, cd, lu, ld, tot)) >= _NUMPY_MAX:
+        return None
+
+    reset = ~valid[:, 0] | ~has_last[:, 0] | ((cu[:, 0] < lu[:, 0]) & (cd[:, 0] < ld[:, 0]))
+    rows = ~reset[:, None]
+    seen = valid & rows
+    active = seen & has_last
+    dropped = active & (cu < lu) & (cd < ld)
+    counting = active & ~dropped
+    du = np.where(counting, np.maximum(cu - lu, 0), 0)
+    dd = np.where(counting, np.maximum(cd - ld, 0), 0)
+    if delta_cap > 0:
+        clamped = active & ((du + dd) > delta_cap)
+        clamp_sum = du + dd
+        du[clamped] = 0
+        dd[clamped] = 0
+    else:
+        clamped = None
+    moved = seen & ~(has_last & (cu == lu) & (cd == ld))
+    gained = (du > 0) | (dd > 0)
+    added_up, added_down = du.sum(axis=1), dd.sum(axis=1)
+
+    ch = DeltaChanges()
+    ch.resets = np.flatnonzero(reset).tolist()
+    r, c = np.nonzero(moved)
+    ch.baselines = list(zip(r.tolist(), c.tolist(), cu[r, c].tolist(), cd[r, c].tolist()))
+    r, c = np.nonzero(gained)
+    ch.node_deltas = list(zip(r.tolist(), c.tolist(), du[r, c].tolist(), dd[r, c].tolist()))
+    r, c = np.nonzero(~valid & rows)
+    ch.skipped = list(zip(r.tolist(), c.tolist()))
+    r, c = np.nonzero(dropped)
+    ch.dropped = list(zip(r.tolist(), c.tolist(), lu[r, c].tolist(), ld[r, c].tolist(),
+                          cu[r, c].tolist(), cd[r, c].tolist()))
+    if clamped is not None:
+        r, c = np.nonzero(clamped)
+        ch.clamped = list(zip(r.tolist(), c.tolist(), clamp_sum[r, c].tolist()))
+    changed = np.flatnonzero((added_up != 0) | (added_down != 0))
+    if changed.size:
+        ch.totals = list(zip(changed.tolist(), (tot[changed, 0] + added_up[changed]).tolist(),
+                             (tot[changed, 1] + added_down[changed]).tolist(),
+                             added_up[changed].tolist(), added_down[changed].tolist()))
+    return ch
@@ -0,0 +1,257 @@
+# src/ingest.py
+import re
+import json
+import codecs
+
+from . import codec, metrics
+
+# Response bytes read per step while streaming a list body
+STREAM_CHUNK = 64 * 1024
+
+_DECODER = json.JSONDecoder()
+_WS = re.compile(r"\s*")
+_DELIMITERS = frozenset(' \t\r\n,:]}')
+try:
+    # Runs up to the next brace/bracket, skipping whole strings; possessive so that
+    # a multi-megabyte settings string does not pile up backtracking state
+    _SKIP = re.compile(r'[^"{}\[\]]*+(?:"[^"\\]*+(?:\\.[^"\\]*+)*+"[^"{}\[\]]*+)*+')
+    # Body of a string up to its closing quote or the end of the buffer
+    _STRING_BODY = re.compile(r'[^"\\]*+(?:\\.[^"\\]*+)*+')
+except re.error:  # Python < 3.11
+    _SKIP = re.compile(r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*')
+    _STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*')
+
+
+def load_json_field(val):
+    """Decodes a JSON string field; None/'' -> {}, undecodable values are returned as-is."""
+    if isinstance(val, (dict, list)):
+        return val
+    if val is None or val == '':
+        return {}
+    try:
+        return codec.loads(val)
+    except Exception:
+        return val
+
+
+def apply_transform(envelope, transform):
+    """Maps a fully parsed list response's "obj" like ListParser does while streaming."""
+    obj = envelope.get("obj")
+    if transform is not None and isinstance(obj, list):
+        envelope["obj"] = [t for t in map(transform, obj) if t is not None]
+    return envelope
+
+
+def json_field(inbound, field):
+    """Decoded value of one of an inbound's JSON string fields (cached for InboundRecords)."""
+    if isinstance(inbound, InboundRecord):
+        return inbound.decoded(field)
+    return load_json_field(inbound.get(field))
+
+
+class InboundRecord(dict):
+    """
+    One inbound as the panel sent it (minus dropped fields). JSON string fields such
+    as settings are decoded on first access and cached, so the snapshot, the inbound
+    diff and the client plan share one parse per cycle. The raw strings stay in place:
+    fingerprints hash them and inbounds are pushed to nodes verbatim.
+    """
+
+    __slots__ = ("_decoded",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._decoded = {}
+
+    @classmethod
+    def from_panel(cls, inbound, drop=()):
+        """Record for one element of a panel's inbound list; None for non-objects."""
+        if not isinstance(inbound, dict):
+            return None
+        rec = cls(inbound)
+        for field in drop:
+            rec.pop(field, None)
+        return rec
+
+    def __setitem__(self, key, value):
+        self._decoded.pop(key, None)
+        super().__setitem__(key, value)
+
+    def decoded(self, field):
+        try:
+            return self._decoded[field]
+        except KeyError:
+            metrics.JSON_DECODES.inc(kind=field)
+            val = self._decoded[field] = load_json_field(self.get(field))
+            return val
+
+
+class ListParser:
+    """
+    Incremental parser for a panel list response ({"success": .., "msg": .., "obj": [..]}).
+    Bytes are fed as they arrive; each element of the "obj" array is decoded on its own
+    as soon as it is complete and passed through transform(element), whose result is
+    kept unless it is None. The body is never held as a whole, neither as text nor
+    next to its parsed form. close() returns the envelope with "obj" holding the
+    kept results.
+    """
+
+    def __init__(self, transform=None, key="obj"):
+        self._transform = transform
+        self._key = key
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._field = None
+        self._items = None
+        self._item_start = 0
+        self._item_parts = []  # scanned text of an element that spans several chunks
+        self._depth = 0
+        self._in_string = False  # element scan stopped inside a string
+        self.envelope = {}
+
+    def feed(self, data: bytes) -> None:
+        self._buf += self._text.decode(data)
+        self._run(final=False)
+
+    def close(self) -> dict:
+        self._buf += self._text.decode(b"", final=True)
+        self._run(final=True)
+        if self._state != "done":
+            raise ValueError(f"Truncated or malformed list response (state {self._state})")
+        return self.envelope
+
+    def _skip_ws(self):
+        self._pos = _WS.match(self._buf, self._pos).end()
+        return self._pos < len(self._buf)
+
+    def _expect(self, chars):
+        c = self._buf[self._pos]
+        if c not in chars:
+            raise ValueError(f"Unexpected {c!r} at offset {self._pos} of list response")
+        self._pos += 1
+        return c
+
+    def _value(self, final):
+        """Decodes a small value; None when more data is needed."""
+        try:
+            val, end = _DECODER.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise ValueError(f"Malformed value at offset {self._pos} of list response")
+            return None
+        if not final and (end == len(self._buf) or self._buf[end] not in _DELIMITERS):
+            return None  # a number may continue in the next chunk
+        self._pos = end
+        return (val,)
+
+    def _scan_item(self):
+        """Advances through an array element; True once it is complete."""
+        buf = self._buf
+        while True:
+            if self._in_string:
+                # Resume a string that ran past the previous buffer end
+                self._pos = _STRING_BODY.match(buf, self._pos).end()
+                if self._pos >= len(buf) or buf[self._pos] != '"':
+                    return False  # still open (possibly after a trailing backslash)
+                self._pos += 1
+                self._in_string = False
+            self._pos = _SKIP.match(buf, self._pos).end()
+            if self._pos >= len(buf):
+                return False
+            c = buf[self._pos]
+            if c == '"':
+                self._pos += 1
+                self._in_string = True
+                continue
+            self._depth += 1 if c in "{[" else -1
+            self._pos += 1
+            if self._depth == 0:
+                return True
+
+    def _keep(self, element):
+        if self._transform is not None:
+            element = self._transform(element)
+            if element is None:
+                return
+        self._items.append(element)
+
+    def _park_item(self):
+        # Moves the scanned part of an unfinished element out of the buffer, so that
+        # feeding a large element costs one copy per chunk instead of one per buffer
+        self._item_parts.append(self._buf[self._item_start:self._pos])
+        self._buf = self._buf[self._pos:]
+        self._pos = self._item_start = 0
+
+    def _trim(self):
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+    def _run(self, final):
+        while True:
+            st = self._state
+            if st == "item":
+                if not self._scan_item():
+                    self._park_item()
+                    return
+                text = self._buf[self._item_start:self._pos]
+                if self._item_parts:
+                    self._item_parts.append(text)
+                    text = "".join(self._item_parts)
+                    self._item_parts = []
+                self._trim()
+                metrics.JSON_DECODES.inc(kind="list_element")
+                self._keep(codec.loads(text))
+                self._state = "item_sep"
+                continue
+            if st == "done" or not self._skip_ws():
+                if st != "done":
+                    self._trim()
+                return
+            if st == "start":
+                self._expect("{")
+                self._state = "field"
+            elif st == "field":
+                if self._buf[self._pos] == "}":
+                    self._pos += 1
+                    self._state = "done"
+                    continue
+                val = self._value(final)
+                if val is None:
+                    return
+                self._field = val[0]
+                self._state = "colon"
+            elif st == "colon":
+                self._expect(":")
+                self._state = "value"
+            elif st == "value":
+                if self._field == self._key and self._buf[self._pos] == "[":
+                    self._pos += 1
+                    self._items = self.envelope[self._key] = []
+                    self._state = "element"
+                    continue
+                val = self._value(final)
+                if val is None:
+                    return
+                self.envelope[self._field] = val[0]
+                self._state = "field_sep"
+            elif st == "field_sep":
+                self._state = "field" if self._expect(",}") == "," else "done"
+            elif st == "element":
+                c = self._buf[self._pos]
+                if c == "]":
+                    self._pos += 1
+                    self._state = "field_sep"
+                elif c in "{[":
+                    self._item_start, self._depth = self._pos, 0
+                    self._state = "item"
+                else:
+                    val = self._value(final)
+                    if val is None:
+                        return
+                    self._keep(val[0])
+                    self._state = "item_sep"
+            elif st == "item_sep":
+                self._state = "element" if self._expect(",]") == "," else "field_sep"
@@ -0,0 +1,85 @@
+# src/latency.py
+import math
+import threading
+from collections import deque
+
+from . import metrics
+
+
+class _Endpoint:
+    __slots__ = ("count", "ewma", "samples", "p_high", "timeout")
+
+    def __init__(self, window, default_timeout):
+        self.count = 0
+        self.ewma = 0.0
+        self.samples = deque(maxlen=window)  # most recent latencies, seconds
+        self.p_high = 0.0
+        self.timeout = default_timeout
+
+
+class LatencyTracker:
+    """
+    Latency profile per (panel base URL, endpoint) driving adaptive request timeouts:
+    - ewma: exponentially weighted mean latency of completed calls
+    - p_high: `quantile` (default p95) over the last `window` calls
+    - timeout = multiplier * max(p_high, ewma), clamped to [min_timeout, max_timeout];
+      endpoints with fewer than min_samples calls keep the static default_timeout
+    A call that times out is recorded at its timeout and adapts the endpoint right
+    away, so an endpoint that hits its limit gets a longer one (up to max_timeout)
+    instead of failing every cycle. With enabled=False the profile is still kept, but
+    timeouts stay static.
+    """
+
+    def __init__(self, default_timeout, min_timeout=2.0, max_timeout=60.0, enabled=True,
+                 multiplier=3.0, alpha=0.2, window=100, quantile=0.95, min_samples=5):
+        self.default_timeout = float(default_timeout)
+        self.min_timeout = max(0.1, float(min_timeout))
+        self.max_timeout = max(self.min_timeout, float(max_timeout))
+        self.enabled = bool(enabled)
+        self.multiplier = float(multiplier)
+        self.alpha = float(alpha)
+        self.window = max(1, int(window))
+        self.quantile = min(1.0, max(0.0, float(quantile)))
+        self.min_samples = max(1, int(min_samples))
+        self._lock = threading.Lock()
+        self._endpoints = {}  # (base, endpoint) -> _Endpoint
+
+    def timeout(self, base, endpoint) -> float:
+        """Timeout in seconds for the next call to endpoint on base."""
+        if not self.enabled:
+            return self.default_timeout
+        ep = self._endpoints.get((base, endpoint))
+        return ep.timeout if ep is not None else self.default_timeout
+
+    def observe(self, base, endpoint, seconds, timed_out=False) -> None:
+        """Records one call's latency, or its timeout for a call that timed out."""
+        with self._lock:
+            ep = self._endpoints.get((base, endpoint))
+            if ep is None:
+                ep = self._endpoints[(base, endpoint)] = _Endpoint(self.window, self.default_timeout)
+            ep.count += 1
+            ep.ewma = seconds if ep.count == 1 else ep.ewma + self.alpha * (seconds - ep.ewma)
+            ep.samples.append(seconds)
+            ordered = sorted(ep.samples)
+            ep.p_high = ordered[max(0, math.ceil(self.quantile * len(ordered)) - 1)]
+            if timed_out or ep.count >= self.min_samples:
+                ep.timeout = min(self.max_timeout, max(self.min_timeout, self.multiplier * max(ep.p_high, ep.ewma)))
+            ewma, p_high, timeout = ep.ewma, ep.p_high, ep.timeout
+        server = metrics.server_label(base)
+        metrics.PANEL_LATENCY_EWMA.set(round(ewma, 6), server=server, endpoint=endpoint)
+        metrics.PANEL_LATENCY_HIGH.set(round(p_high, 6), server=server, endpoint=endpoint)
+        metrics.PANEL_TIMEOUT.set(round(timeout if self.enabled else self.default_timeout, 3),
+                                  server=server, endpoint=endpoint)
+
+    def profile(self) -> dict:
+        """base -> endpoint -> {"count", "ewma", "p_high", "timeout"} (seconds)."""
+        out = {}
+        with self._lock:
+            for (base, endpoint), ep in self._endpoints.items():
+                out.setdefault(base, {})[endpoint] = {
+                    "count": ep.count,
+                    "ewma": ep.ewma,
+                    "p_high": ep.p_high,
+                    "timeout": ep.timeout if self.enabled else self.default_timeout,
+                }
+        return out
@@ -1,12 +1,18 @@
 import os
 import time
 import signal
+import logging
 import shutil
+import threading
+import contextlib
 from .logging_setup import setup_logging
 from .config import ConfigManager
 from .state import TrafficStateManager
 from .api import APIManager
 from .sync import SyncManager
+from . import codec, metrics
+from .tracing import tracer, CycleProfiler
+from .scheduler import Scheduler
 
 HEARTBEAT_FILE = ".heartbeat"
 
@@ -35,6 +41,30 @@ def write_heartbeat(path):
         import logging
         logging.error(f"Failed to write heartbeat: {e}")
 
+def run_traffic_loop(sync_manager, scheduler):
+    """
+    Fast traffic loop (own thread): each run reads central and every node with one
+    bulk inbounds/list call and aggregates deltas; reconciliation stays on the main loop.
+    """
+    while scheduler.wait_due():
+        try:
+            tracer.start_cycle(shared=False)
+            with tracer.span("traffic_cycle"):
+                with tracer.span("central_snapshot") as sp:
+                    snapshot = sync_manager.fetch_central_snapshot()
+                    sp["inbounds"] = len(snapshot.inbounds) if snapshot else 0
+                if not snapshot:
+                    raise RuntimeError("central snapshot unavailable")
+                with tracer.span("traffic", emails=len(snapshot.emails)):
+                    sync_manager.sync_traffic(snapshot, bulk_only=True)
+            metrics.record_peak_rss()
+            metrics.CYCLES.inc(loop="traffic", result="ok")
+            metrics.LAST_SUCCESS.set(time.time(), loop="traffic")
+        except Exception as e:
+            metrics.CYCLES.inc(loop="traffic", result="failed")
+            logging.error(f"Traffic cycle failed: {e}")
+        scheduler.done(["traffic"])
+
 def main():
     data_dir = os.getenv("DATA_DIR", "/app/data")
     os.makedirs(data_dir, exist_ok=True)
@@ -53,12 +83,40 @@ def main():
     ]
     migrate_db_if_needed(logger, db_path, legacy_dbs)
 
+    trace_opts = config_manager.trace()
+    tracer.configure(
+        data_dir,
+        enabled=trace_opts.get("enabled", False),
+        slow_call_ms=trace_opts.get("slow_call_ms", 2000),
+    )
+    profiler = None
+    if trace_opts.get("profile"):
+        profiler = CycleProfiler(data_dir, keep=trace_opts.get("profile_keep", 5))
+        logger.info("Per-cycle cProfile enabled")
+
+    json_backend = codec.configure(config_manager.net().get("json_codec", "auto"))
+    logger.info(f"JSON codec: {json_backend}")
+
     traffic_state_manager = TrafficStateManager(
         db_file=db_path,
         db_opts=config_manager.db()
     )
-    api_manager = APIManager(net_opts=config_manager.net())
-    sync_manager = SyncManager(api_manager, config_manager, traffic_state_manager)
+    async_engine = config_manager.net().get("engine") == "asyncio"
+    if async_engine:
+        # Optional engine: aiohttp is only needed when it is selected
+        try:
+            from .async_api import AsyncAPIManager
+            from .async_sync import AsyncSyncManager
+        except ImportError as e:
+            logger.warning(f"engine=asyncio but aiohttp is not installed ({e}); using the threads engine")
+            async_engine = False
+    if async_engine:
+        logger.info("Using asyncio engine")
+        api_manager = AsyncAPIManager(net_opts=config_manager.net())
+        sync_manager = AsyncSyncManager(api_manager, config_manager, traffic_state_manager)
+    else:
+        api_manager = APIManager(net_opts=config_manager.net())
+        sync_manager = SyncManager(api_manager, config_manager, traffic_state_manager)
 
     # interval from config (or ENV override)
     interval_min_env = os.getenv("SYNC_INTERVAL_MINUTES")
@@ -70,27 +128,106 @@ def main():
     else:
         interval_sec = max(1, int(config_manager.get_interval())) * 60
 
-    stop = {"flag": False}
+    # A traffic interval of its own moves traffic sync to a separate fast loop
+    traffic_interval_sec = max(0, int(config_manager.get_traffic_interval_seconds() or 0))
+    jitter_sec = config_manager.get_schedule_jitter_seconds()
+    stop_event = threading.Event()
+    scheduler = Scheduler(stop_event)
+    scheduler.add("inbounds", interval_sec, jitter=jitter_sec)
+    traffic_thread = None
+    if traffic_interval_sec:
+        if async_engine:
+            # The asyncio engine runs on one event loop per manager, so the traffic loop
+            # gets its own manager (and panel sessions) over the shared state cache
+            traffic_sync_manager = AsyncSyncManager(
+                AsyncAPIManager(net_opts=config_manager.net()), config_manager, traffic_state_manager)
+        else:
+            traffic_sync_manager = sync_manager
+        traffic_scheduler = Scheduler(stop_event)
+        traffic_scheduler.add("traffic", traffic_interval_sec, jitter=jitter_sec)
+        traffic_thread = threading.Thread(
+            target=run_traffic_loop, args=(traffic_sync_manager, traffic_scheduler),
+            name="traffic-loop", daemon=True)
+        logger.info(f"Schedule: inbounds every {interval_sec}s; traffic loop every {traffic_interval_sec}s (jitter {jitter_sec}s)")
+    else:
+        traffic_sync_manager = sync_manager
+        scheduler.add("traffic", interval_sec, jitter=jitter_sec)
+        logger.info(f"Schedule: inbounds and traffic every {interval_sec}s (jitter {jitter_sec}s)")
+
     def _graceful(signum, frame):
         logger.info(f"Received signal {signum}; shutting down gracefully...")
-        stop["flag"] = True
+        scheduler.stop()
     signal.signal(signal.SIGINT, _graceful)
     signal.signal(signal.SIGTERM, _graceful)
 
     hb_path = os.path.join(data_dir, HEARTBEAT_FILE)
 
-    while not stop["flag"]:
+    metrics_server = None
+    metrics_opts = config_manager.metrics()
+    if metrics_opts.get("enabled"):
+        try:
+            metrics_server = metrics.MetricsServer(metrics_opts.get("host", "127.0.0.1"), metrics_opts.get("port", 9108))
+            metrics_server.start()
+        except Exception as e:
+            logger.error(f"Failed to start metrics endpoint: {e}")
+            metrics_server = None
+
+    if traffic_thread is not None:
+        traffic_thread.start()
+
+    while True:
+        due = scheduler.wait_due()
+        if not due:
+            break
         # v0.1: heartbeat is always updated (service health is independent of cycle success)
         write_heartbeat(hb_path)
         try:
-            logger.info("Starting sync cycle")
-            sync_manager.sync_inbounds_and_clients()
-            sync_manager.sync_traffic()
+            logger.info(f"Starting sync cycle ({', '.join(due)})")
+            cycle_id = tracer.start_cycle()
+            with (profiler.profile(cycle_id) if profiler else contextlib.nullcontext()), \
+                    tracer.span("cycle", jobs=",".join(due)) as cycle_span:
+                # Central inbounds are downloaded and parsed once, then shared by both phases
+                with tracer.span("central_snapshot") as sp:
+                    snapshot = sync_manager.fetch_central_snapshot()
+                    sp["inbounds"] = len(snapshot.inbounds) if snapshot else 0
+                if not snapshot:
+                    raise RuntimeError("central snapshot unavailable")
+                # Traffic first, while the snapshot's counters are current: central keeps
+                # counting during reconciliation, and traffic sync would have to re-read them
+                if "traffic" in due:
+                    with tracer.span("traffic", emails=len(snapshot.emails)):
+                        sync_manager.sync_traffic(snapshot)
+                if "inbounds" in due:
+                    with tracer.span("inbounds_and_clients", nodes=len(config_manager.get_nodes())):
+                        sync_manager.sync_inbounds_and_clients(snapshot)
+                peak_rss = metrics.record_peak_rss()
+                if peak_rss is not None:
+                    cycle_span["peak_rss_mb"] = round(peak_rss / 2**20, 1)
+            metrics.CYCLES.inc(loop="main", result="ok")
+            metrics.LAST_SUCCESS.set(time.time(), loop="main")
             logger.info("Sync cycle completed successfully")
+            for base, st in getattr(api_manager, "connection_stats", dict)().items():
+                logger.debug(
+                    f"HTTP pool {base}: requests={st['requests']} new_connections={st['new_connections']} reused={st['reused']}"
+                )
+            for base, endpoints in api_manager.latency_profile().items():
+                for endpoint, st in sorted(endpoints.items()):
+                    logger.debug(
+                        f"Latency {base} {endpoint}: calls={st['count']} ewma={st['ewma'] * 1000:.0f}ms "
+                        f"p95={st['p_high'] * 1000:.0f}ms timeout={st['timeout']:.1f}s"
+                    )
         except Exception as e:
+            metrics.CYCLES.inc(loop="main", result="failed")
             logger.error(f"Sync cycle failed: {e}")
-        time.sleep(interval_sec)
+        scheduler.done(due)
 
+    if traffic_thread is not None:
+        traffic_thread.join()
+        if traffic_sync_manager is not sync_manager:
+            traffic_sync_manager.close()
+    sync_manager.close()
+    if metrics_server is not None:
+        metrics_server.stop()
     logger.info("Exited cleanly.")
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+# src/metrics.py
+import sys
+import time
+import bisect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Panel calls: milliseconds to tens of seconds; sync phases: up to several minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PHASE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(val) -> str:
+    return str(val).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names, values, extra=None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}  # label values tuple -> value
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, val in items:
+            lines.extend(self._render_value(key, val))
+        return lines
+
+    def _render_value(self, key, val):
+        return [f"{self.name}{_fmt_labels(self.labels, key)} {val}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            st = self._values.get(key)
+            if st is None:
+                # per-bucket counts (last slot is +Inf), sum, count
+                st = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            st[0][idx] += 1
+            st[1] += value
+            st[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, val):
+        counts, total, n = val[0][:], val[1], val[2]
+        lines, cumulative = [], 0
+        for bound, c in zip(self.buckets + (float("inf"),), counts):
+            cumulative += c
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, ('le', le))} {cumulative}")
+        lines.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {total}")
+        lines.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {n}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "nodex_http_request_seconds", "Panel API request latency.", ("server", "endpoint", "method"))
+HTTP_REQUESTS = REGISTRY.counter(
+    "nodex_http_requests_total", "Panel API requests by HTTP status ('error' = no response).",
+    ("server", "endpoint", "method", "status"))
+PHASE_SECONDS = REGISTRY.histogram(
+    "nodex_phase_seconds", "Duration of sync cycle phases.", ("phase",), PHASE_BUCKETS)
+PANEL_LATENCY_EWMA = REGISTRY.gauge(
+    "nodex_panel_latency_ewma_seconds", "Exponentially weighted mean panel call latency.", ("server", "endpoint"))
+PANEL_LATENCY_HIGH = REGISTRY.gauge(
+    "nodex_panel_latency_p95_seconds", "95th percentile of recent panel call latencies.", ("server", "endpoint"))
+PANEL_TIMEOUT = REGISTRY.gauge(
+    "nodex_panel_timeout_seconds", "Request timeout currently applied to the endpoint.", ("server", "endpoint"))
+BREAKER_OPEN = REGISTRY.gauge(
+    "nodex_circuit_open", "1 while the panel's circuit breaker is open (calls fail fast).", ("server",))
+BREAKER_TRIPS = REGISTRY.counter(
+    "nodex_circuit_trips_total", "Circuit breaker openings, including failed half-open probes.", ("server",))
+CYCLES = REGISTRY.counter("nodex_cycles_total", "Sync cycles by loop (main / traffic) and result.", ("loop", "result"))
+LAST_SUCCESS = REGISTRY.gauge(
+    "nodex_last_success_timestamp_seconds", "Unix time of the last successful cycle by loop.", ("loop",))
+SCHEDULE_MISSED_TICKS = REGISTRY.counter(
+    "nodex_schedule_missed_ticks_total", "Scheduled runs skipped because the previous run overran.", ("job",))
+RECONCILE_OPS = REGISTRY.counter(
+    "nodex_reconcile_ops_total", "Planned reconciliation operations.", ("node", "kind", "op"))
+NODES_SKIPPED = REGISTRY.counter(
+    "nodex_nodes_skipped_total", "Node reconciliations skipped.", ("node", "reason"))
+TRAFFIC_READ_FAILURES = REGISTRY.counter(
+    "nodex_traffic_read_failures_total", "Per-email traffic reads that failed (server skipped for that email).",
+    ("server",))
+DELTA_CLAMPED = REGISTRY.counter(
+    "nodex_delta_clamped_total", "Traffic deltas dropped by delta_max_bytes_per_interval.", ("server",))
+DELTA_BYTES = REGISTRY.counter(
+    "nodex_traffic_delta_bytes_total", "Traffic added to totals from per-server deltas.", ("server", "direction"))
+TRAFFIC_WRITES = REGISTRY.counter(
+    "nodex_traffic_writes_total", "Traffic total write-backs by result.", ("server", "result"))
+DB_FLUSHES = REGISTRY.counter("nodex_db_flushes_total", "SQLite state flush transactions.")
+DB_ROWS = REGISTRY.counter("nodex_db_rows_written_total", "SQLite state rows written or deleted.", ("table",))
+JSON_DECODES = REGISTRY.counter(
+    "nodex_json_decodes_total", "JSON decodes of panel data: streamed list elements and inbound JSON fields.", ("kind",))
+PAYLOAD_CACHE = REGISTRY.counter(
+    "nodex_payload_cache_total", "Serialized client/inbound request bodies reused (hit) or built (miss).", ("result",))
+PEAK_RSS = REGISTRY.gauge("nodex_process_peak_rss_bytes", "Peak resident set size of the worker process.")
+
+
+@functools.lru_cache(maxsize=1024)
+def server_label(url) -> str:
+    """host:port of a panel URL; the web path is left out of labels on purpose."""
+    return urlsplit(url).netloc or str(url)
+
+
+def endpoint_label(url) -> str:
+    """Panel endpoint name without ids/emails, e.g. .../inbounds/updateClient/<id> -> updateClient."""
+    path = urlsplit(url).path.rstrip("/")
+    if path.endswith("/login"):
+        return "login"
+    parts = path.split("/inbounds/", 1)
+    if len(parts) == 2:
+        for seg in parts[1].split("/"):
+            if seg and not seg.isdigit():
+                return seg
+    return "other"
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far, or None where unavailable."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024  # KiB everywhere but macOS
+
+
+def record_peak_rss():
+    rss = peak_rss_bytes()
+    if rss is not None:
+        PEAK_RSS.set(rss)
+    return rss
+
+
+def observe_request(url, method, status, seconds) -> None:
+    server, endpoint = server_label(url), endpoint_label(url)
+    HTTP_REQUEST_SECONDS.observe(seconds, server=server, endpoint=endpoint, method=method)
+    HTTP_REQUESTS.inc(server=server, endpoint=endpoint, method=method, status=status)
+
+
+class MetricsServer:
+    """Serves REGISTRY in Prometheus text format on GET /metrics from a daemon thread."""
+
+    def __init__(self, host="127.0.0.1", port=9108, registry=REGISTRY):
+        self.host = host
+        self.port = int(port)
+        self.registry = registry
+        self._httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logging.debug(f"metrics: {fmt % args}")
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"Metrics endpoint listening on http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
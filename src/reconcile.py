@@ -0,0 +1,202 @@
+import json
+import hashlib
+
+from .ingest import json_field
+
+# Inbound fields that describe configuration (traffic counters and clientStats are excluded)
+INBOUND_CONFIG_FIELDS = (
+    'remark', 'enable', 'expiryTime', 'listen', 'port', 'protocol', 'tag', 'total',
+)
+# Inbound fields stored as JSON strings by the panel
+INBOUND_JSON_FIELDS = ('settings', 'streamSettings', 'sniffing', 'allocate')
+
+# Client fields that the panel fills in by itself and must not trigger an update
+CLIENT_VOLATILE_FIELDS = ('created_at', 'updated_at')
+CLIENT_INT_FIELDS = ('limitIp', 'totalGB', 'expiryTime', 'tgId', 'reset')
+
+
+def normalize_client(c) -> dict:
+    """
+    Returns a comparable form of a client: volatile fields and None values dropped,
+    numeric fields coerced to int.
+    """
+    if not isinstance(c, dict):
+        return {}
+    out = {}
+    for k, v in c.items():
+        if k in CLIENT_VOLATILE_FIELDS or v is None:
+            continue
+        if k in CLIENT_INT_FIELDS:
+            try:
+                v = int(v)
+            except Exception:
+                pass
+        out[k] = v
+    return out
+
+
+def normalize_inbound(ib) -> dict:
+    """
+    Returns a comparable form of an inbound's configuration.
+    JSON string fields are decoded; settings.clients is left out because clients
+    are reconciled through the client endpoints.
+    """
+    out = {}
+    for k in INBOUND_CONFIG_FIELDS:
+        if k in ib:
+            out[k] = ib.get(k)
+    for k in INBOUND_JSON_FIELDS:
+        if k not in ib:
+            continue
+        val = json_field(ib, k)
+        if k == 'settings' and isinstance(val, dict):
+            val = {sk: sv for sk, sv in val.items() if sk != 'clients'}
+        out[k] = val
+    return out
+
+
+def _sha256(obj) -> str:
+    blob = json.dumps(obj, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def inbound_fingerprint(ib) -> str:
+    """
+    Stable hash of one inbound's configuration, clients included.
+    Traffic counters and clientStats are left out, so it only changes when
+    something reconciliation cares about changes. Raw field values are hashed
+    (no JSON decoding), which keeps it cheap enough to run on every cycle.
+    """
+    row = [ib.get('id')]
+    row.extend(ib.get(k) for k in INBOUND_CONFIG_FIELDS)
+    row.extend(ib.get(k) for k in INBOUND_JSON_FIELDS)
+    return _sha256(row)
+
+
+def fingerprints(inbounds) -> dict:
+    """inbound_id -> inbound_fingerprint"""
+    return {ib.get('id'): inbound_fingerprint(ib) for ib in inbounds or []}
+
+
+def config_hash(fps) -> str:
+    """Hash of a whole panel's configuration from its per-inbound fingerprints."""
+    return _sha256(sorted(([str(k), v] for k, v in fps.items())))
+
+
+def inbound_differs(central_inbound, node_inbound) -> bool:
+    return normalize_inbound(central_inbound) != normalize_inbound(node_inbound)
+
+
+def client_differs(central_client, node_client) -> bool:
+    return normalize_client(central_client) != normalize_client(node_client)
+
+
+class ReconcilePlan:
+    """
+    Add/update/delete operations needed to bring one node in line with central.
+    Only real differences become operations; everything else is counted as skipped.
+    """
+
+    def __init__(self, node_url):
+        self.node_url = node_url
+        self.inbound_ops = []  # (op, inbound_id, inbound)
+        self.client_ops = []   # (op, inbound_id, client_key, client_id, client)
+        self.skipped_inbounds = 0
+        self.skipped_clients = 0
+        # Inbounds written with central's full settings.clients in this plan;
+        # their clients need no separate client operations
+        self.populated = set()
+
+    def plan_inbounds(self, central_inbounds, node_inbound_map, full_replace=False, visit=None):
+        """
+        central_inbounds: list of central inbound dicts
+        node_inbound_map: inbound_id -> node inbound dict
+        full_replace: rewrite every existing inbound with central's version (clients
+        included) instead of diffing, for first-time or disaster-recovery syncs
+        visit: if given, only these central inbound ids are compared; the rest are
+        known to be in line and counted as skipped
+        """
+        central_ids = set()
+        for ib in central_inbounds:
+            cid = ib['id']
+            central_ids.add(cid)
+            if visit is not None and cid not in visit:
+                self.skipped_inbounds += 1
+                continue
+            nib = node_inbound_map.get(cid)
+            if nib is None:
+                # New inbounds carry their clients embedded
+                self.inbound_ops.append(('add', cid, ib))
+                self.populated.add(cid)
+            elif full_replace:
+                self.inbound_ops.append(('update', cid, ib))
+                self.populated.add(cid)
+            elif inbound_differs(ib, nib):
+                self.inbound_ops.append(('update', cid, ib))
+            else:
+                self.skipped_inbounds += 1
+        for nid in node_inbound_map:
+            if nid not in central_ids:
+                self.inbound_ops.append(('delete', nid, None))
+
+    def plan_clients(self, inbound_id, c_client_map, n_client_map, id_fn):
+        """
+        c_client_map / n_client_map: client_key -> client dict (central / node)
+        id_fn: maps a client dict to the id used by the panel API
+        """
+        for k, ccl in c_client_map.items():
+            ncl = n_client_map.get(k)
+            if ncl is None:
+                self.client_ops.append(('add', inbound_id, k, None, ccl))
+            elif client_differs(ccl, ncl):
+                self.client_ops.append(('update', inbound_id, k, id_fn(ncl), ccl))
+            else:
+                self.skipped_clients += 1
+        for k, ncl in n_client_map.items():
+            if k in c_client_map:
+                continue
+            n_clid = id_fn(ncl)
+            if n_clid is not None:
+                self.client_ops.append(('delete', inbound_id, k, n_clid, None))
+
+    def batched_client_ops(self):
+        """
+        Yields client_ops with each inbound's adds merged into one
+        ('add', inbound_id, [client_key], None, [client]) entry ahead of that inbound's
+        updates and deletes, so adds can go out through the batched addClient call.
+        """
+        adds = {}
+        for op, inbound_id, k, client_id, client in self.client_ops:
+            if op == 'add':
+                keys, clients = adds.setdefault(inbound_id, ([], []))
+                keys.append(k)
+                clients.append(client)
+        sent = set()
+        for op in self.client_ops:
+            inbound_id = op[1]
+            if inbound_id in adds and inbound_id not in sent:
+                sent.add(inbound_id)
+                keys, clients = adds[inbound_id]
+                yield ('add', inbound_id, keys, None, clients)
+            if op[0] != 'add':
+                yield op
+
+    def touched_inbounds(self) -> set:
+        """Ids of inbounds that have at least one operation in this plan."""
+        return {op[1] for op in self.inbound_ops} | {op[1] for op in self.client_ops}
+
+    @staticmethod
+    def _count(ops):
+        counts = {'add': 0, 'update': 0, 'delete': 0}
+        for op in ops:
+            counts[op[0]] += 1
+        return counts
+
+    def summary(self) -> str:
+        ic = self._count(self.inbound_ops)
+        cc = self._count(self.client_ops)
+        return (
+            f"inbounds +{ic['add']} ~{ic['update']} -{ic['delete']} (skipped {self.skipped_inbounds}); "
+            f"clients +{cc['add']} ~{cc['update']} -{cc['delete']} (skipped {self.skipped_clients}, "
+            f"embedded in {len(self.populated)} inbound(s))"
+        )
@@ -0,0 +1,68 @@
+# src/scheduler.py
+import math
+import time
+import random
+import logging
+import threading
+
+from . import metrics
+
+
+class _Job:
+    __slots__ = ("name", "interval", "jitter", "base", "due")
+
+    def __init__(self, name, interval, jitter, now):
+        self.name = name
+        self.interval = float(interval)
+        self.jitter = min(max(0.0, float(jitter or 0)), self.interval)
+        self.base = now  # un-jittered tick this job is scheduled for
+        self.due = now   # first run happens right away
+
+
+class Scheduler:
+    """
+    Fixed-rate scheduler for the sync loop:
+    - each job ticks every `interval` seconds measured from tick to tick, not from
+      the end of the previous run, so cycle time does not add to the period
+    - ticks missed while a run overran are coalesced into the next one (and counted
+      in nodex_schedule_missed_ticks_total) instead of being run back to back
+    - optional jitter delays each tick by a random 0..jitter seconds without
+      shifting the underlying cadence; jobs whose tick has already passed are run
+      together with the first one due, so they can share the central snapshot
+    - stop() wakes a waiting wait_due() immediately
+    Runs happen on the caller's thread, so one scheduler never overlaps itself.
+    """
+
+    def __init__(self, stop_event=None, clock=time.monotonic):
+        self._stop = stop_event or threading.Event()
+        self._clock = clock
+        self._jobs = {}
+
+    def add(self, name, interval, jitter=0):
+        self._jobs[name] = _Job(name, max(1.0, float(interval)), jitter, self._clock())
+
+    def stop(self):
+        self._stop.set()
+
+    def wait_due(self):
+        """Blocks until at least one job is due; returns their names ([] once stopped)."""
+        while not self._stop.is_set():
+            now = self._clock()
+            if any(j.due <= now for j in self._jobs.values()):
+                # Jobs whose tick has passed but whose jitter has not run out join this run
+                return [j.name for j in self._jobs.values() if j.base <= now]
+            self._stop.wait(min(j.due for j in self._jobs.values()) - now)
+        return []
+
+    def done(self, names):
+        """Schedules the next tick of jobs that just ran, skipping ticks already in the past."""
+        now = self._clock()
+        for name in names:
+            job = self._jobs[name]
+            job.base += job.interval
+            if job.base <= now:
+                missed = math.floor((now - job.base) / job.interval) + 1
+                job.base += missed * job.interval
+                metrics.SCHEDULE_MISSED_TICKS.inc(missed, job=name)
+                logging.warning(f"[SCHEDULE] {name} run overran its {job.interval:.0f}s interval; skipped {missed} tick(s)")
+            job.due = job.base + (random.uniform(0, job.jitter) if job.jitter else 0)
@@ -0,0 +1,93 @@
+from .reconcile import config_hash, fingerprints
+from .ingest import json_field
+from . import codec
+
+
+class CentralSnapshot:
+    """
+    Central's inbound list for one cycle: downloaded once, parsed once, and shared
+    by inbound/client sync and traffic sync. Settings come from the inbound records'
+    decode cache, so the inbound diff reuses the same parse. The traffic counters are
+    only current until reconciliation starts (traffic_stale), so a cycle runs traffic
+    sync first; run after reconciliation, traffic sync re-reads them.
+    """
+
+    def __init__(self, inbounds, session=None, traffic=None):
+        self.session = session
+        self.inbounds = inbounds or []
+        self.settings = {}  # inbound_id -> parsed settings dict
+        self.parsed = []    # [(inbound, clients)] in central order; clients live inside settings
+        self.emails = set()
+        # email -> (up, down) from clientStats
+        self.traffic = traffic or {}
+        self.traffic_stale = False
+        # Filled once by index_clients(): inbound_id -> {client_key: client} / has fresh SAFU
+        self.client_maps = None
+        self.safu_fresh = None
+        self._replacements = {}  # inbound_id -> inbound for full_replace (see replacement_inbound)
+        self._fingerprints = None
+        self._config_hash = None
+
+        for ib in self.inbounds:
+            settings = json_field(ib, 'settings')
+            if not isinstance(settings, dict):
+                settings = {}
+            clients = settings.get('clients', []) if isinstance(settings, dict) else []
+            self.settings[ib.get('id')] = settings
+            self.parsed.append((ib, clients))
+
+            # Collect client emails from clientStats and settings
+            for st in ib.get('clientStats') or []:
+                if st and 'email' in st:
+                    self.emails.add(st['email'])
+            for c in clients:
+                e = c.get('email') if isinstance(c, dict) else None
+                if e:
+                    self.emails.add(e)
+
+    @property
+    def fingerprints(self):
+        """inbound_id -> fingerprint of central's inbound configuration (see reconcile)."""
+        if self._fingerprints is None:
+            self._fingerprints = fingerprints(self.inbounds)
+        return self._fingerprints
+
+    @property
+    def config_hash(self):
+        """Content hash of central's whole inbound configuration."""
+        if self._config_hash is None:
+            self._config_hash = config_hash(self.fingerprints)
+        return self._config_hash
+
+    def index_clients(self, client_map_fn, is_safu_fresh_fn):
+        """
+        Builds the per-inbound client maps and SAFU flags once per cycle; every node
+        plan reads them instead of re-keying central's clients.
+        client_map_fn(clients, protocol) -> {client_key: client}
+        """
+        if self.client_maps is not None:
+            return
+        client_maps, safu_fresh = {}, {}
+        for ib, clients in self.parsed:
+            protocol = (ib.get('protocol') or '').lower()
+            client_maps[ib['id']] = client_map_fn(clients, protocol)
+            safu_fresh[ib['id']] = any(is_safu_fresh_fn(c) for c in clients)
+        self.client_maps, self.safu_fresh = client_maps, safu_fresh
+
+    def replacement_inbound(self, inbound_id, inbound):
+        """
+        inbound with its settings re-encoded from self.settings, so that it carries this
+        cycle's promotions. Built once and shared by every node rewritten with it, which
+        lets the request body be encoded once too; a promotion on the inbound drops it
+        (drop_replacement). Callers serialize both with promotions.
+        """
+        rec = self._replacements.get(inbound_id)
+        if rec is None:
+            rec = self._replacements[inbound_id] = dict(inbound, settings=codec.dumps_str(self.settings[inbound_id]))
+        return rec
+
+    def drop_replacement(self, inbound_id):
+        self._replacements.pop(inbound_id, None)
+
+    def __bool__(self):
+        return bool(self.inbounds)
@@ -3,24 +3,50 @@ import threading
 import time
 import logging
 
+from . import metrics
+
 class TrafficStateManager:
     def __init__(self, db_file='traffic_state.db', db_opts=None):
         self.db_file = db_file
         self.lock = threading.Lock()
+        # In-memory cache of all three tables (see _load_cache); SQLite is written
+        # only for dirty rows, immediately or at commit_batch() when a batch is open
+        self._totals = {}       # email -> (total_up, total_down, cycle_started_at)
+        self._counters = {}     # (email, server_url) -> (last_up, last_down)
+        self._node_totals = {}  # (email, server_url) -> (up_total, down_total)
+        self._dirty_totals = set()
+        self._dirty_counters = set()
+        self._dirty_nodes = set()
+        self._node_resets = set()   # emails whose node_totals rows must be deleted
+        self._loaded = set()        # emails whose SQLite rows are in the cache (see _ensure_loaded)
+        self._deferred = False
         self.conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
         self.conn.execute("PRAGMA foreign_keys=ON;")
         # PRAGMAs
         if db_opts:
             if db_opts.get('wal', True):
                 self.conn.execute("PRAGMA journal_mode=WAL;")
-            sync_mode = db_opts.get('synchronous', 'NORMAL').upper()
-            if sync_mode not in ('FULL', 'NORMAL', 'OFF'):
-                sync_mode = 'NORMAL'
-            self.conn.execute(f"PRAGMA synchronous={sync_mode};")
+            self.conn.execute(f"PRAGMA synchronous={self._synchronous(db_opts)};")
             cache_mb = int(db_opts.get('cache_size_mb', 20))
             self.conn.execute(f"PRAGMA cache_size=-{cache_mb * 1024};")  # negative => KB
             self.conn.execute("PRAGMA temp_store=MEMORY;")
         self.init_db()
+        self._load_cache()
+        # Reconciliation state (node_sync_state / inbound_sync_state) is read and written
+        # by the inbound loop; it gets its own lock and connection so it never waits on
+        # self.lock, which the traffic loop takes for every cache access. An in-memory
+        # database cannot be opened twice, so it keeps sharing the main connection.
+        if self.db_file == ':memory:':
+            self._sync_lock, self._sync_conn = self.lock, self.conn
+        else:
+            self._sync_lock = threading.Lock()
+            self._sync_conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+            self._sync_conn.execute(f"PRAGMA synchronous={self._synchronous(db_opts)};")
+
+    @staticmethod
+    def _synchronous(db_opts) -> str:
+        sync_mode = (db_opts or {}).get('synchronous', 'NORMAL').upper()
+        return sync_mode if sync_mode in ('FULL', 'NORMAL', 'OFF') else 'NORMAL'
 
     def init_db(self):
         with self.lock, self.conn:
@@ -55,93 +81,256 @@ class TrafficStateManager:
                 )
             ''')
             c.execute("CREATE INDEX IF NOT EXISTS idx_node_totals_email ON node_totals(email)")
+            # Last reconciliation that found a node already in line with central
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS node_sync_state (
+                    node_url TEXT PRIMARY KEY,
+                    central_hash TEXT NOT NULL,
+                    node_hash TEXT NOT NULL,
+                    synced_at INTEGER NOT NULL
+                )
+            ''')
+            # Per node and inbound: fingerprints of the last state found in line
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS inbound_sync_state (
+                    node_url TEXT NOT NULL,
+                    inbound_id INTEGER NOT NULL,
+                    central_fp TEXT NOT NULL,
+                    node_fp TEXT NOT NULL,
+                    synced_at INTEGER NOT NULL,
+                    PRIMARY KEY (node_url, inbound_id)
+                )
+            ''')
+
+    # ---- cache ----
+    def _load_cache(self):
+        with self.lock:
+            self._totals = {
+                email: (up, down, started)
+                for email, up, down, started in self.conn.execute(
+                    "SELECT email,total_up,total_down,cycle_started_at FROM client_totals"
+                )
+            }
+            self._counters = {
+                (email, srv): (up, down)
+                for email, srv, up, down in self.conn.execute(
+                    "SELECT email,server_url,last_up,last_down FROM server_counters"
+                )
+            }
+            self._node_totals = {
+                (email, srv): (up, down)
+                for email, srv, up, down in self.conn.execute(
+                    "SELECT email,server_url,up_total,down_total FROM node_totals"
+                )
+            }
+            self._loaded = set(self._totals)
+            self._loaded.update(k[0] for k in self._counters)
+            self._loaded.update(k[0] for k in self._node_totals)
+        logging.info(
+            f"State cache loaded: totals={len(self._totals)} counters={len(self._counters)} node_totals={len(self._node_totals)}"
+        )
+
+    def _ensure_loaded(self, email):
+        # caller holds self.lock; loads the rows of an email seen for the first time since
+        # startup or eviction (none for a new email). Tracking loaded rather than evicted
+        # emails keeps this set bounded by the live client set.
+        if email in self._loaded:
+            return
+        self._loaded.add(email)
+        row = self.conn.execute(
+            "SELECT total_up,total_down,cycle_started_at FROM client_totals WHERE email=?", (email,)
+        ).fetchone()
+        if row:
+            self._totals[email] = (row[0], row[1], row[2])
+        for srv, up, down in self.conn.execute(
+            "SELECT server_url,last_up,last_down FROM server_counters WHERE email=?", (email,)
+        ):
+            self._counters[(email, srv)] = (up, down)
+        for srv, up, down in self.conn.execute(
+            "SELECT server_url,up_total,down_total FROM node_totals WHERE email=?", (email,)
+        ):
+            self._node_totals[(email, srv)] = (up, down)
+
+    def _ensure_loaded_many(self, emails):
+        # caller holds self.lock; _ensure_loaded for many emails with a few IN (...) queries
+        missing = [email for email in dict.fromkeys(emails) if email not in self._loaded]
+        for i in range(0, len(missing), 500):  # stays below SQLite's bound-parameter limit
+            chunk = missing[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            self._loaded.update(chunk)
+            for email, up, down, started in self.conn.execute(
+                f"SELECT email,total_up,total_down,cycle_started_at FROM client_totals WHERE email IN ({marks})", chunk
+            ):
+                self._totals[email] = (up, down, started)
+            for email, srv, up, down in self.conn.execute(
+                f"SELECT email,server_url,last_up,last_down FROM server_counters WHERE email IN ({marks})", chunk
+            ):
+                self._counters[(email, srv)] = (up, down)
+            for email, srv, up, down in self.conn.execute(
+                f"SELECT email,server_url,up_total,down_total FROM node_totals WHERE email IN ({marks})", chunk
+            ):
+                self._node_totals[(email, srv)] = (up, down)
+
+    def _changed(self):
+        # caller holds self.lock; write-through unless a batch is open
+        if not self._deferred:
+            self._flush()
+
+    def _flush(self):
+        """
+        Writes dirty rows in one transaction. On error the transaction is rolled back
+        and the rows stay dirty for the next flush.
+        """
+        # caller holds self.lock
+        if not (self._dirty_totals or self._dirty_counters or self._dirty_nodes or self._node_resets):
+            return
+        totals = [(email,) + tuple(self._totals[email]) for email in self._dirty_totals if email in self._totals]
+        counters = [key + tuple(self._counters[key]) for key in self._dirty_counters if key in self._counters]
+        nodes = [key + tuple(self._node_totals[key]) for key in self._dirty_nodes if key in self._node_totals]
+        resets = [(email,) for email in self._node_resets]
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if resets:
+                self.conn.executemany("DELETE FROM node_totals WHERE email=?", resets)
+            if totals:
+                self.conn.executemany("""
+                    INSERT INTO client_totals(email,total_up,total_down,cycle_started_at)
+                    VALUES(?,?,?,?)
+                    ON CONFLICT(email) DO UPDATE
+                    SET total_up=excluded.total_up,total_down=excluded.total_down,cycle_started_at=excluded.cycle_started_at
+                """, totals)
+            if counters:
+                self.conn.executemany("""
+                    INSERT INTO server_counters(email,server_url,last_up,last_down)
+                    VALUES(?,?,?,?)
+                    ON CONFLICT(email,server_url) DO UPDATE
+                    SET last_up=excluded.last_up,last_down=excluded.last_down
+                """, counters)
+            if nodes:
+                self.conn.executemany("""
+                    INSERT INTO node_totals(email, server_url, up_total, down_total)
+                    VALUES(?,?,?,?)
+                    ON CONFLICT(email, server_url) DO UPDATE
+                    SET up_total=excluded.up_total, down_total=excluded.down_total
+                """, nodes)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self._dirty_totals.clear()
+        self._dirty_counters.clear()
+        self._dirty_nodes.clear()
+        self._node_resets.clear()
+        metrics.DB_FLUSHES.inc()
+        for table, n in (('client_totals', len(totals)), ('server_counters', len(counters)),
+                         ('node_totals', len(nodes)), ('node_totals_reset', len(resets))):
+            if n:
+                metrics.DB_ROWS.inc(n, table=table)
+        logging.debug(
+            f"State flushed: totals={len(totals)} counters={len(counters)} "
+            f"node_totals={len(nodes)} node_resets={len(resets)}"
+        )
+
+    def evict_inactive(self, active_emails) -> int:
+        """
+        Drops cached rows of emails that are no longer on central, so memory stays
+        bounded by the live client set. Rows stay in SQLite and are reloaded if the
+        email shows up again. Returns the number of evicted emails.
+        """
+        active = set(active_emails)
+        with self.lock:
+            self._flush()
+            stale = self._loaded - active
+            if not stale:
+                return 0
+            for email in stale:
+                self._totals.pop(email, None)
+            self._counters = {k: v for k, v in self._counters.items() if k[0] not in stale}
+            self._node_totals = {k: v for k, v in self._node_totals.items() if k[0] not in stale}
+            self._loaded -= stale
+        logging.info(f"State cache: evicted {len(stale)} email(s) no longer present on central")
+        return len(stale)
 
     # ---- total getters/setters ----
     def get_total(self, email):
         with self.lock:
-            row = self.conn.execute(
-                "SELECT total_up,total_down FROM client_totals WHERE email=?", (email,)
-            ).fetchone()
+            self._ensure_loaded(email)
+            row = self._totals.get(email)
             return (row[0], row[1]) if row else (0, 0)
 
     def set_total(self, email, up, down):
         # idempotent write; only write if changed
-        with self.lock, self.conn:
-            row = self.conn.execute(
-                "SELECT total_up,total_down FROM client_totals WHERE email=?", (email,)
-            ).fetchone()
+        with self.lock:
+            self._ensure_loaded(email)
+            row = self._totals.get(email)
             if row and row[0] == up and row[1] == down:
                 return False  # no change
-            self.conn.execute("""
-                INSERT INTO client_totals(email,total_up,total_down,cycle_started_at)
-                VALUES(?,?,?,COALESCE((SELECT cycle_started_at FROM client_totals WHERE email=?), NULL))
-                ON CONFLICT(email) DO UPDATE
-                SET total_up=excluded.total_up, total_down=excluded.total_down
-            """, (email, up, down, email))
+            self._totals[email] = (up, down, row[2] if row else None)
+            self._dirty_totals.add(email)
+            self._changed()
             return True
 
     def set_cycle_started_at(self, email, ts):
-        with self.lock, self.conn:
-            self.conn.execute("""
-                INSERT INTO client_totals(email,total_up,total_down,cycle_started_at)
-                VALUES(?,?,?,?)
-                ON CONFLICT(email) DO UPDATE SET cycle_started_at=excluded.cycle_started_at
-            """, (email, 0, 0, ts))
+        with self.lock:
+            self._ensure_loaded(email)
+            row = self._totals.get(email)
+            self._totals[email] = (row[0], row[1], ts) if row else (0, 0, ts)
+            self._dirty_totals.add(email)
+            self._changed()
 
     # ---- per-server baseline getters/setters ----
     def get_last_counter(self, email, server_url):
         with self.lock:
-            row = self.conn.execute("""
-                SELECT last_up,last_down FROM server_counters
-                WHERE email=? AND server_url=?
-            """, (email, server_url)).fetchone()
-            return (row[0], row[1]) if row else None
+            self._ensure_loaded(email)
+            return self._counters.get((email, server_url))
 
     def set_last_counter(self, email, server_url, up, down):
-        with self.lock, self.conn:
+        with self.lock:
+            self._ensure_loaded(email)
             # only write if changed
-            row = self.conn.execute("""
-                SELECT last_up,last_down FROM server_counters
-                WHERE email=? AND server_url=?
-            """, (email, server_url)).fetchone()
-            if row and row[0] == up and row[1] == down:
+            key = (email, server_url)
+            if self._counters.get(key) == (up, down):
                 return False
-            self.conn.execute("""
-                INSERT INTO server_counters(email,server_url,last_up,last_down)
-                VALUES(?,?,?,?)
-                ON CONFLICT(email,server_url) DO UPDATE
-                SET last_up=excluded.last_up, last_down=excluded.last_down
-            """, (email, server_url, up, down))
+            self._counters[key] = (up, down)
+            self._dirty_counters.add(key)
+            self._changed()
             return True
 
     def set_last_counters_batch(self, email, items):
         # items: Iterable[(server_url, up, down)]
-        with self.lock, self.conn:
-            self.conn.executemany("""
-              INSERT INTO server_counters(email,server_url,last_up,last_down)
-              VALUES(?,?,?,?)
-              ON CONFLICT(email,server_url) DO UPDATE
-              SET last_up=excluded.last_up,last_down=excluded.last_down
-            """, [(email, srv, up, down) for (srv, up, down) in items])
+        with self.lock:
+            self._ensure_loaded(email)
+            for (srv, up, down) in items:
+                self._counters[(email, srv)] = (up, down)
+                self._dirty_counters.add((email, srv))
+            self._changed()
 
     # ---- per-node accumulation (جدید) ----
     def add_node_delta(self, email: str, server_url: str, du: int, dd: int) -> None:
         """انباشتن دلتاهای مصرف برای نود مشخص (از ابتدای سیکل جاری)."""
         if not du and not dd:
             return
-        with self.lock, self.conn:
-            self.conn.execute("""
-                INSERT INTO node_totals(email, server_url, up_total, down_total)
-                VALUES(?,?,?,?)
-                ON CONFLICT(email, server_url) DO UPDATE SET
-                  up_total  = node_totals.up_total  + excluded.up_total,
-                  down_total= node_totals.down_total+ excluded.down_total
-            """, (email, server_url, int(du or 0), int(dd or 0)))
+        with self.lock:
+            self._ensure_loaded(email)
+            key = (email, server_url)
+            pu, pd = self._node_totals.get(key, (0, 0))
+            self._node_totals[key] = (pu + int(du or 0), pd + int(dd or 0))
+            self._dirty_nodes.add(key)
+            self._changed()
+
+    def _clear_node_totals(self, email) -> None:
+        # caller holds self.lock
+        for key in [k for k in self._node_totals if k[0] == email]:
+            del self._node_totals[key]
+            self._dirty_nodes.discard(key)
+        self._node_resets.add(email)
 
     def reset_node_totals(self, email: str) -> None:
         """در شروع سیکل جدید، per-node مربوط به کاربر را صفر می‌کند."""
-        with self.lock, self.conn:
-            self.conn.execute("DELETE FROM node_totals WHERE email=?", (email,))
+        with self.lock:
+            self._ensure_loaded(email)
+            self._clear_node_totals(email)
+            self._changed()
 
     def reset_cycle(self, email, currents_by_server, central_url):
         """
@@ -150,23 +339,151 @@ class TrafficStateManager:
           - baseline تمام سرورها را به مقدار فعلی‌شان تنظیم می‌کند
           - و per-node را صفر می‌کند (node_totals DELETE)
         """
-        with self.lock, self.conn:
+        # Every current is unpacked before anything changes: a failed read (None) or a
+        # malformed pair raises here and leaves the email's state untouched
+        baselines = [(srv, up, down) for srv, (up, down) in currents_by_server.items()]
+        cup, cdown = currents_by_server.get(central_url, (0, 0))
+        with self.lock:
+            self._ensure_loaded(email)
             now_ts = int(time.time())
-            cup, cdown = currents_by_server.get(central_url, (0, 0))
             # صفر کردن per-node برای این کاربر
-            self.conn.execute("DELETE FROM node_totals WHERE email=?", (email,))
+            self._clear_node_totals(email)
             # ثبت total و زمان شروع سیکل
-            self.conn.execute("""
-                INSERT INTO client_totals(email,total_up,total_down,cycle_started_at)
-                VALUES(?,?,?,?)
-                ON CONFLICT(email) DO UPDATE
-                SET total_up=excluded.total_up,total_down=excluded.total_down,cycle_started_at=excluded.cycle_started_at
-            """, (email, cup, cdown, now_ts))
+            self._totals[email] = (cup, cdown, now_ts)
+            self._dirty_totals.add(email)
             # به‌روز کردن baseline همه‌ی سرورها
-            self.conn.executemany("""
-                INSERT INTO server_counters(email,server_url,last_up,last_down)
-                VALUES(?,?,?,?)
-                ON CONFLICT(email,server_url) DO UPDATE
-                SET last_up=excluded.last_up,last_down=excluded.last_down
-            """, [(email, srv, up, down) for srv, (up, down) in currents_by_server.items()])
+            for srv, up, down in baselines:
+                self._counters[(email, srv)] = (up, down)
+                self._dirty_counters.add((email, srv))
+            self._changed()
             logging.info(f"Cycle reset for {email}: total set to central ({cup},{cdown}); baselines updated; node_totals cleared.")
+
+    # ---- batch delta engine ----
+    def get_delta_inputs(self, emails, server_urls):
+        """
+        Baselines and totals for a batch delta run, read under one lock hold.
+        Returns (lasts, totals): lasts[i][j] is the (up, down) baseline of emails[i] on
+        server_urls[j] or None; totals[i] is the email's (up, down) total.
+        """
+        lasts, totals = [], []
+        with self.lock:
+            self._ensure_loaded_many(emails)
+            for email in emails:
+                lasts.append([self._counters.get((email, srv)) for srv in server_urls])
+                row = self._totals.get(email)
+                totals.append((row[0], row[1]) if row else (0, 0))
+        return lasts, totals
+
+    def apply_deltas(self, baselines, node_deltas, totals) -> None:
+        """
+        Applies a batch delta change set under one lock hold, with the same effect as
+        set_last_counter / add_node_delta / set_total called per item:
+        baselines (email, server_url, up, down), node_deltas (email, server_url, du, dd),
+        totals (email, up, down).
+        """
+        with self.lock:
+            for email, srv, up, down in baselines:
+                self._ensure_loaded(email)
+                key = (email, srv)
+                if self._counters.get(key) != (up, down):
+                    self._counters[key] = (up, down)
+                    self._dirty_counters.add(key)
+            for email, srv, du, dd in node_deltas:
+                self._ensure_loaded(email)
+                key = (email, srv)
+                pu, pd = self._node_totals.get(key, (0, 0))
+                self._node_totals[key] = (pu + int(du or 0), pd + int(dd or 0))
+                self._dirty_nodes.add(key)
+            for email, up, down in totals:
+                self._ensure_loaded(email)
+                row = self._totals.get(email)
+                if row and row[0] == up and row[1] == down:
+                    continue
+                self._totals[email] = (up, down, row[2] if row else None)
+                self._dirty_totals.add(email)
+            self._changed()
+
+    # ---- reconciliation change detection ----
+    def get_node_sync_state(self, node_url):
+        """Returns (central_hash, node_hash) of the node's last in-line sync, or None."""
+        with self._sync_lock:
+            row = self._sync_conn.execute(
+                "SELECT central_hash, node_hash FROM node_sync_state WHERE node_url=?", (node_url,)
+            ).fetchone()
+            return (row[0], row[1]) if row else None
+
+    def set_node_sync_state(self, node_url, central_hash, node_hash) -> None:
+        with self._sync_lock:
+            self._sync_conn.execute("""
+                INSERT INTO node_sync_state(node_url, central_hash, node_hash, synced_at)
+                VALUES(?,?,?,?)
+                ON CONFLICT(node_url) DO UPDATE
+                SET central_hash=excluded.central_hash, node_hash=excluded.node_hash, synced_at=excluded.synced_at
+            """, (node_url, central_hash, node_hash, int(time.time())))
+
+    def clear_node_sync_state(self, node_url) -> None:
+        with self._sync_lock:
+            self._sync_conn.execute("DELETE FROM node_sync_state WHERE node_url=?", (node_url,))
+
+    def get_inbound_acks(self, node_url) -> dict:
+        """inbound_id -> (central_fp, node_fp) the node was last found in line with."""
+        with self._sync_lock:
+            rows = self._sync_conn.execute(
+                "SELECT inbound_id, central_fp, node_fp FROM inbound_sync_state WHERE node_url=?", (node_url,)
+            ).fetchall()
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def set_inbound_acks(self, node_url, acks, cleared=()) -> None:
+        """
+        Stores acks (inbound_id -> (central_fp, node_fp)) and drops the inbound ids in
+        cleared, in one transaction.
+        """
+        now = int(time.time())
+        rows = [(node_url, iid, cfp, nfp, now) for iid, (cfp, nfp) in acks.items()]
+        gone = [(node_url, iid) for iid in cleared]
+        if not rows and not gone:
+            return
+        with self._sync_lock:
+            try:
+                self._sync_conn.execute("BEGIN IMMEDIATE")
+                if gone:
+                    self._sync_conn.executemany(
+                        "DELETE FROM inbound_sync_state WHERE node_url=? AND inbound_id=?", gone
+                    )
+                if rows:
+                    self._sync_conn.executemany("""
+                        INSERT INTO inbound_sync_state(node_url, inbound_id, central_fp, node_fp, synced_at)
+                        VALUES(?,?,?,?,?)
+                        ON CONFLICT(node_url, inbound_id) DO UPDATE
+                        SET central_fp=excluded.central_fp, node_fp=excluded.node_fp, synced_at=excluded.synced_at
+                    """, rows)
+                self._sync_conn.execute("COMMIT")
+            except Exception:
+                self._sync_conn.execute("ROLLBACK")
+                raise
+
+    # ---- cycle-scoped write batch ----
+    def begin_batch(self) -> None:
+        """
+        Defers SQLite writes until flush() or commit_batch(). Reads are always served
+        from the in-memory cache, so nothing needs to be preloaded here.
+        """
+        with self.lock:
+            self._deferred = True
+
+    def flush(self) -> None:
+        """
+        Stores every row changed so far in one transaction, also while a batch is open
+        (traffic write-back does so before its panel writes go out).
+        """
+        with self.lock:
+            self._flush()
+
+    def commit_batch(self) -> None:
+        """
+        Flushes every row changed since the last flush in a single transaction and
+        returns to write-through mode.
+        """
+        with self.lock:
+            self._deferred = False
+            self._flush()
@@ -1,13 +1,37 @@
-import json
 import logging
 import time
+import threading
+import queue
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from .reconcile import ReconcilePlan, config_hash, fingerprints
+from .snapshot import CentralSnapshot
+from .ingest import json_field
+from .breaker import CircuitOpenError
+from .delta import compute_deltas, numpy_available
+from . import metrics
+from .tracing import tracer
 
 class SyncManager:
     def __init__(self, api_manager, config_manager, traffic_state_manager):
         self.api_manager = api_manager
         self.config_manager = config_manager
         self.traffic_state_manager = traffic_state_manager
+        # Serializes central-side writes issued from concurrent node workers
+        self._central_lock = threading.Lock()
+        # Long-lived executor for traffic reads (created lazily, see _get_executor)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # server_url -> {"written", "skipped", "failed"} for the last traffic cycle
+        self.traffic_write_stats = {}
+        self._write_seconds = 0.0  # time spent in traffic write-backs this cycle
+        # Traffic writes queued during a run's delta step, sent after it (see _send_totals)
+        self._pending_writes = None
+        self._reconcile_cycles = 0
+        # Nodes whose full_replace pass succeeded; they are reconciled incrementally from then on
+        self._full_replace_done = set()
+        if self.config_manager.net().get('delta_engine') == 'numpy' and not numpy_available():
+            logging.warning("delta_engine=numpy but NumPy is not installed; using the pure-Python batch engine")
 
     @staticmethod
     def _to_int(val, default=0):
@@ -40,6 +64,15 @@ class SyncManager:
             # vmess/vless: id or email
             return c.get("id") or c.get("email")
 
+    def _client_map(self, clients, protocol: str):
+        """client_key -> client, computing each key once; clients without a key are dropped."""
+        out = {}
+        for cl in clients:
+            k = self._client_key(cl, protocol)
+            if k:
+                out[k] = cl
+        return out
+
     def _client_id_for_api(self, c, protocol: str):
         p = (protocol or "").lower()
         if not isinstance(c, dict):
@@ -74,187 +107,421 @@ class SyncManager:
     # -------------------------------
     # Inbounds & Clients synchronization
     # -------------------------------
-    def sync_inbounds_and_clients(self):
+    def fetch_central_snapshot(self):
+        """
+        Logs in to central and downloads its inbound list once for the cycle.
+        Returns None if central is unreachable or has no inbounds.
+        """
         central = self.config_manager.get_central_server()
-        nodes = self.config_manager.get_nodes()
-
         try:
             central_session = self.api_manager.login(central)
             central_inbounds = self.api_manager.get_inbounds(central, central_session)
-            if not central_inbounds:
-                logging.error("No inbounds retrieved from central server, skipping sync")
-                return
         except Exception as e:
             logging.error(f"Failed to connect to central server: {e}")
-            return
+            return None
+        if not central_inbounds:
+            logging.error("No inbounds retrieved from central server")
+            return None
+        return CentralSnapshot(
+            central_inbounds,
+            session=central_session,
+            traffic=self.api_manager.traffic_map_from_inbounds(central_inbounds),
+        )
 
-        # Parse central inbounds and extract client lists
-        parsed_central = []
-        for ib in central_inbounds:
-            settings = {}
-            try:
-                settings = json.loads(ib.get('settings') or '{}') or {}
-            except Exception:
-                pass
-            parsed_central.append((ib, settings.get('clients', [])))
+    def sync_inbounds_and_clients(self, snapshot=None):
+        central = self.config_manager.get_central_server()
+        nodes = self.config_manager.get_nodes()
 
-        for node in nodes:
-            try:
-                node_session = self.api_manager.login(node)
-                node_inbounds = self.api_manager.get_inbounds(node, node_session)
-                node_inbound_map = {inbound['id']: inbound for inbound in node_inbounds}
-
-                # Synchronize inbounds (central -> node)
-                for central_inbound, _ in parsed_central:
-                    cid = central_inbound['id']
-                    if cid not in node_inbound_map:
-                        self.api_manager.add_inbound(node, node_session, central_inbound)
-                    else:
-                        self.api_manager.update_inbound(node, node_session, cid, central_inbound)
-                        node_inbound_map.pop(cid, None)
+        if snapshot is None:
+            snapshot = self.fetch_central_snapshot()
+        if not snapshot:
+            logging.error("No central snapshot available, skipping sync")
+            return
+        # Central keeps counting while nodes are reconciled
+        snapshot.traffic_stale = True
+        # Central client maps are shared read-only by all node workers
+        snapshot.index_clients(self._client_map, self._is_safu_fresh)
+        force = self._next_reconcile_forced()
 
-                # Remove inbounds that are not present on the central server
-                for inbound_id in list(node_inbound_map.keys()):
-                    self.api_manager.delete_inbound(node, node_session, inbound_id)
+        parallel = self.config_manager.net().get('parallel_node_calls', True)
+        try:
+            if parallel and len(nodes) > 1:
+                # Nodes are reconciled concurrently; each worker isolates its own errors
+                max_workers = min(len(nodes), self.config_manager.net().get('max_workers', 8))
+                if max_workers <= 0:
+                    max_workers = 1
+                with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                    futures = {
+                        ex.submit(self._sync_node, node, central, snapshot, force): node
+                        for node in nodes
+                    }
+                    for fut in as_completed(futures):
+                        try:
+                            fut.result()
+                        except Exception as e:
+                            logging.error(f"Error syncing with node {futures[fut]['url']}: {e}")
+            else:
+                for node in nodes:
+                    self._sync_node(node, central, snapshot, force)
+        finally:
+            # Cached bodies reference this cycle's records; none is reused in the next one
+            self.api_manager.clear_payloads()
+
+    def _next_reconcile_forced(self) -> bool:
+        """
+        True on the first cycle and then every force_resync_cycles cycles: every node
+        is then reconciled even if neither side changed since its last in-line sync.
+        """
+        every = self._to_int(self.config_manager.get_force_resync_cycles(), 0)
+        forced = self._reconcile_cycles == 0 or (every > 0 and self._reconcile_cycles % every == 0)
+        self._reconcile_cycles += 1
+        return forced
+
+    def _full_replace(self, node) -> bool:
+        """full_replace is one-shot: it applies until one pass has rewritten the node's inbounds."""
+        return bool(node.get('full_replace')) and node['url'] not in self._full_replace_done
+
+    def _full_replace_applied(self, node, full_replace, inbounds_ok):
+        if full_replace and inbounds_ok:
+            self._full_replace_done.add(node['url'])
+            logging.info(f"[PLAN] {node['url']}: full replace done, later cycles reconcile incrementally")
+
+    def _node_unchanged(self, node, snapshot, node_hash, force) -> bool:
+        """Central and the node both still hash to the state of the node's last in-line sync."""
+        if force or self._full_replace(node):
+            return False
+        return self.traffic_state_manager.get_node_sync_state(node['url']) == (snapshot.config_hash, node_hash)
+
+    def _inbounds_to_visit(self, node, snapshot, node_fps, force):
+        """
+        Central inbound ids whose (central, node) fingerprints differ from the pair the
+        node was last found in line with. None means every inbound is visited.
+        """
+        if force or self._full_replace(node):
+            return None
+        acks = self.traffic_state_manager.get_inbound_acks(node['url'])
+        return {cid for cid, cfp in snapshot.fingerprints.items() if acks.get(cid) != (cfp, node_fps.get(cid))}
 
-                # Synchronize clients with SAFU-aware policy
-                now_ms = self._now_ms()
+    def _record_node_state(self, node_url, snapshot, node_fps, plan, promotions, visit=None):
+        """
+        Acks every visited inbound the plan left untouched, and drops the ack of every
+        inbound that changes now, so the next cycle confirms those with a fresh diff.
+        Called before the plan is executed: a node that fails midway keeps the acks of
+        the inbounds that were already in line.
+        """
+        touched = plan.touched_inbounds() | {p[0] for p in promotions}
+        visited = snapshot.fingerprints if visit is None else visit
+        acks = {cid: (snapshot.fingerprints[cid], node_fps[cid])
+                for cid in visited if cid not in touched and cid in node_fps}
+        self.traffic_state_manager.set_inbound_acks(node_url, acks, cleared=touched)
+        if touched:
+            self.traffic_state_manager.clear_node_sync_state(node_url)
+        else:
+            self.traffic_state_manager.set_node_sync_state(node_url, snapshot.config_hash, config_hash(node_fps))
 
-                for central_inbound, c_clients in parsed_central:
-                    cid = central_inbound['id']
+    def _decide_promotion(self, cid, k, protocol, ccl, ncl, now_ms):
+        """
+        Decides whether an active start time on a node client must be promoted to central.
+        Runs under the central lock and re-checks central's current value, so concurrent
+        node workers cannot race or produce the same promotion twice. Updates the central
+        client in place and returns (cid, k, client_id, client, old_exp, merged) to write,
+        or None.
+        """
+        with self._central_lock:
+            central_exp = self._to_int(ccl.get('expiryTime'), 0)
+            node_exp    = self._to_int(ncl.get('expiryTime'), 0)
+
+            central_started_active = central_exp > now_ms
+            node_started_active    = node_exp > now_ms
+
+            should_promote = (not central_started_active) and node_started_active
+            if not should_promote:
+                # If node is Ended (or central already started), do not promote to central
+                return None
+            # Promote start time from node to central (minimum of positive values)
+            merged = node_exp if central_exp <= 0 else min(central_exp, node_exp)
+            if merged == central_exp or merged <= now_ms:
+                return None
+            ccl['expiryTime'] = merged
+            if 'startAfterFirstUse' in ccl and ccl.get('startAfterFirstUse') is True:
+                ccl['startAfterFirstUse'] = False
+            client_id = self._client_id_for_api(ccl, protocol) or self._client_id_for_api(ncl, protocol)
+            if client_id is None:
+                logging.warning(f"[SAFU-MERGE] Missing clientId for protocol={protocol} key={k} on inbound {cid}; central update skipped.")
+                return None
+            return (cid, k, client_id, ccl, central_exp, merged)
+
+    def _promote_to_central(self, central, central_session, promotion):
+        """Writes one promotion to central; central writes are serialized."""
+        cid, k, client_id, ccl, central_exp, merged = promotion
+        with self._central_lock:
+            try:
+                self.api_manager.update_client(central, central_session, client_id, cid, ccl)
+                logging.info(f"[SAFU-MERGE] expiryTime merged to central for client {k} (inbound {cid}): {central_exp} -> {merged}")
+            except Exception as _e:
+                logging.error(f"Failed to update central client {k} after SAFU merge: {_e}")
 
-                    # Get clients from node
-                    node_inbound = next((ni for ni in node_inbounds if ni['id'] == cid), None)
+    def _plan_node(self, node_url, snapshot, node_inbounds, full_replace=False, visit=None):
+        """
+        Builds the reconciliation plan for one node from its current inbounds.
+        Pure CPU work: returns (plan, promotions) without calling any panel.
+        Inbounds that are created (or, with full_replace, rewritten) carry central's
+        clients embedded, so they get no client operations of their own.
+        visit limits inbound and client planning to those central inbound ids.
+        """
+        node_inbound_map = {inbound['id']: inbound for inbound in node_inbounds}
+        plan = ReconcilePlan(node_url)
+        promotions = []
+
+        # Synchronize inbounds (central -> node): only real differences
+        plan.plan_inbounds(snapshot.inbounds, node_inbound_map, full_replace=full_replace, visit=visit)
+
+        # Synchronize clients with SAFU-aware policy
+        now_ms = self._now_ms()
+        snapshot.index_clients(self._client_map, self._is_safu_fresh)
+
+        for central_inbound, _ in snapshot.parsed:
+            cid = central_inbound['id']
+            if visit is not None and cid not in visit:
+                continue
+            protocol = (central_inbound.get('protocol') or '').lower()
+
+            # Get clients from node
+            node_inbound = node_inbound_map.get(cid)
+            n_clients = []
+            if node_inbound:
+                try:
+                    n_clients = (json_field(node_inbound, 'settings') or {}).get('clients', [])
+                except Exception:
                     n_clients = []
-                    if node_inbound:
-                        try:
-                            n_clients = (json.loads(node_inbound.get('settings') or '{}') or {}).get('clients', [])
-                        except Exception:
-                            n_clients = []
-
-                    protocol = (central_inbound.get('protocol') or '').lower()
-
-                    # Build protocol-aware client maps
-                    n_client_map = { self._client_key(cl, protocol): cl for cl in n_clients if self._client_key(cl, protocol) }
-                    c_client_map = { self._client_key(cl, protocol): cl for cl in c_clients if self._client_key(cl, protocol) }
-
-                    # --- 1) If central has fresh SAFU clients: push them directly to node, skip merging
-                    if any(self._is_safu_fresh(ccl) for ccl in c_clients):
-                        for k, ccl in c_client_map.items():
-                            if not self._is_safu_fresh(ccl):
-                                continue  # Only process fresh SAFU clients
-                            # Push to node (restore from Ended to SAFU)
-                            if k in n_client_map:
-                                nid = self._client_id_for_api(n_client_map[k], protocol)
-                                # If exists on node, update
-                                if nid is not None:
-                                    try:
-                                        self.api_manager.update_client(node, node_session, nid, cid, ccl)
-                                    except Exception as _e:
-                                        logging.error(f"Failed to push SAFU from central to node for client {k}: {_e}")
-                            else:
-                                # If not on node, add
-                                try:
-                                    self.api_manager.add_client(node, node_session, cid, ccl)
-                                except Exception as _e:
-                                    logging.error(f"Failed to add SAFU client {k} to node: {_e}")
-
-                        # Continue to general PUSH phase (central -> node)
-                        # (In this case, merging from node to central is intentionally skipped)
 
+            # Protocol-aware client maps: central's is built once per cycle, the node's once per plan
+            n_client_map = self._client_map(n_clients, protocol)
+            c_client_map = snapshot.client_maps[cid]
+
+            # --- 1) If central has fresh SAFU clients: they are pushed to node as-is by the
+            # final PUSH below; merging from node to central is intentionally skipped.
+            if not snapshot.safu_fresh[cid]:
+                # --- 2) If central does not have fresh SAFU: only promote active start time from node to central if needed
+                for k, ccl in c_client_map.items():
+                    ncl = n_client_map.get(k)
+                    if ncl:
+                        promotion = self._decide_promotion(cid, k, protocol, ccl, ncl, now_ms)
+                        if promotion:
+                            promotions.append(promotion)
+
+            # --- 3) Final PUSH: central version (after above policy) to node, only where it differs
+            if cid not in plan.populated:
+                plan.plan_clients(cid, c_client_map, n_client_map,
+                                  lambda cl, _p=protocol: self._client_id_for_api(cl, _p))
+
+        # Rewritten inbounds must carry promoted start times, not central's original settings string
+        with self._central_lock:
+            for promotion in promotions:
+                snapshot.drop_replacement(promotion[0])
+            if full_replace:
+                plan.inbound_ops = [
+                    (op, iid, snapshot.replacement_inbound(iid, ib) if op == 'update' else ib)
+                    for op, iid, ib in plan.inbound_ops
+                ]
+
+        node_label = metrics.server_label(node_url)
+        for kind, ops in (('inbound', plan.inbound_ops), ('client', plan.client_ops)):
+            for op in ops:
+                metrics.RECONCILE_OPS.inc(node=node_label, kind=kind, op=op[0])
+        if promotions:
+            metrics.RECONCILE_OPS.inc(len(promotions), node=node_label, kind='client', op='promote')
+
+        return plan, promotions
+
+    def _sync_node(self, node, central, snapshot, force=True):
+        central_session = snapshot.session
+        node_label = metrics.server_label(node['url'])
+        if self.api_manager.circuit_open(node):
+            logging.warning(f"[BREAKER] {node['url']}: circuit open, skipping node this cycle")
+            metrics.NODES_SKIPPED.inc(node=node_label, reason='circuit_open')
+            return
+        try:
+            with tracer.span('node_fetch', node=node_label) as sp:
+                node_session = self.api_manager.login(node)
+                node_inbounds = self.api_manager.get_inbounds(node, node_session, client_stats=False)
+                sp['inbounds'] = len(node_inbounds)
+            node_fps = fingerprints(node_inbounds)
+            if self._node_unchanged(node, snapshot, config_hash(node_fps), force):
+                logging.info(f"[PLAN] {node['url']}: unchanged since last sync, skipped")
+                metrics.NODES_SKIPPED.inc(node=node_label, reason='unchanged')
+                return
+            full_replace = self._full_replace(node)
+            with tracer.span('node_plan', node=node_label) as sp:
+                visit = self._inbounds_to_visit(node, snapshot, node_fps, force)
+                plan, promotions = self._plan_node(node['url'], snapshot, node_inbounds,
+                                                   full_replace=full_replace, visit=visit)
+                self._record_node_state(node['url'], snapshot, node_fps, plan, promotions, visit)
+                sp.update(visited=len(visit) if visit is not None else len(snapshot.inbounds),
+                          inbound_ops=len(plan.inbound_ops), client_ops=len(plan.client_ops),
+                          promotions=len(promotions))
+
+            if promotions:
+                with tracer.span('node_safu_promotions', node=node_label, ops=len(promotions)):
+                    for promotion in promotions:
+                        self._promote_to_central(central, central_session, promotion)
+
+            inbounds_ok = True
+            with tracer.span('node_inbound_sync', node=node_label, ops=len(plan.inbound_ops)):
+                for op, inbound_id, inbound in plan.inbound_ops:
+                    if op == 'add':
+                        ok = self.api_manager.add_inbound(node, node_session, inbound)
+                    elif op == 'update':
+                        ok = self.api_manager.update_inbound(node, node_session, inbound_id, inbound)
                     else:
-                        # --- 2) If central does not have fresh SAFU: only promote active start time from node to central if needed
-                        for k, ccl in c_client_map.items():
-                            ncl = n_client_map.get(k)
-                            if not ncl:
-                                continue
-
-                            central_exp = self._to_int(ccl.get('expiryTime'), 0)
-                            node_exp    = self._to_int(ncl.get('expiryTime'), 0)
-
-                            central_started_active = central_exp > now_ms
-                            node_started_active    = node_exp > now_ms
-
-                            should_promote = (not central_started_active) and node_started_active
-                            if should_promote:
-                                # Promote start time from node to central (minimum of positive values)
-                                merged = node_exp if central_exp <= 0 else min(central_exp, node_exp)
-                                if merged != central_exp and merged > now_ms:
-                                    ccl['expiryTime'] = merged
-                                    if 'startAfterFirstUse' in ccl and ccl.get('startAfterFirstUse') is True:
-                                        ccl['startAfterFirstUse'] = False
-                                    try:
-                                        client_id = self._client_id_for_api(ccl, protocol) or self._client_id_for_api(ncl, protocol)
-                                        if client_id is None:
-                                            logging.warning(f"[SAFU-MERGE] Missing clientId for protocol={protocol} key={k} on inbound {cid}; central update skipped.")
-                                        else:
-                                            self.api_manager.update_client(central, central_session, client_id, cid, ccl)
-                                            logging.info(f"[SAFU-MERGE] expiryTime merged to central for client {k} (inbound {cid}): {central_exp} -> {merged}")
-                                    except Exception as _e:
-                                        logging.error(f"Failed to update central client {k} after SAFU merge: {_e}")
-                            # If node is Ended, do not promote to central
-
-                    # --- 3) Final PUSH: central version (after above policy) to node
-                    # Add or update clients
-                    for ccl in c_clients:
-                        k = self._client_key(ccl, protocol)
-                        if k in n_client_map:
-                            nid = self._client_id_for_api(n_client_map[k], protocol)
-                            try:
-                                self.api_manager.update_client(node, node_session, nid, cid, ccl)
-                            except Exception as _e:
-                                logging.error(f"Failed to update client {k} on node: {_e}")
-                            # Remove from deletion candidates
-                            n_client_map.pop(k, None)
-                        else:
-                            try:
-                                self.api_manager.add_client(node, node_session, cid, ccl)
-                            except Exception as _e:
-                                logging.error(f"Failed to add client {k} on node: {_e}")
-
-                    # Remove clients that are not present on central
-                    for k, ncl in list(n_client_map.items()):
-                        n_clid = self._client_id_for_api(ncl, protocol)
-                        if n_clid is not None:
-                            try:
-                                self.api_manager.delete_client(node, node_session, cid, n_clid)
-                            except Exception as _e:
-                                logging.error(f"Failed to delete extra client {k} on node: {_e}")
+                        # Remove inbounds that are not present on the central server
+                        ok = self.api_manager.delete_inbound(node, node_session, inbound_id)
+                    inbounds_ok = inbounds_ok and bool(ok)
 
-            except Exception as e:
-                logging.error(f"Error syncing with node {node['url']}: {e}")
+            with tracer.span('node_client_sync', node=node_label, ops=len(plan.client_ops)):
+                for op, inbound_id, k, client_id, client in plan.batched_client_ops():
+                    try:
+                        if op == 'add':
+                            # k / client are lists here: all of this inbound's new clients
+                            self.api_manager.add_clients(node, node_session, inbound_id, client)
+                        elif op == 'update':
+                            self.api_manager.update_client(node, node_session, client_id, inbound_id, client)
+                        else:
+                            # Remove clients that are not present on central
+                            self.api_manager.delete_client(node, node_session, inbound_id, client_id)
+                    except CircuitOpenError:
+                        raise
+                    except Exception as _e:
+                        logging.error(f"Failed to {op} client {k} on node: {_e}")
+
+            logging.info(f"[PLAN] {node['url']}: {plan.summary()}")
+            self._full_replace_applied(node, full_replace, inbounds_ok)
+
+        except CircuitOpenError as e:
+            # The node stopped answering mid-sync; the rest of its plan waits for the next cycle
+            logging.warning(f"[BREAKER] {node['url']}: {e}; skipping rest of node sync")
+            metrics.NODES_SKIPPED.inc(node=node_label, reason='circuit_open')
+        except Exception as e:
+            logging.error(f"Error syncing with node {node['url']}: {e}")
 
     # -------------------------------
     # Traffic synchronization (V2)
     # -------------------------------
-    def _fetch_node_traffic_parallel(self, nodes_by_url, node_sessions, email):
-        """Parallelize traffic reads (I/O-bound only). Writes remain serial."""
-        currents_by_server = {}
-        futures = {}
-        max_workers = min(len(node_sessions), self.config_manager.net().get('max_workers', 8))
-        if max_workers <= 0:
-            max_workers = 1
-
-        with ThreadPoolExecutor(max_workers=max_workers) as ex:
-            for srv_url, sess in node_sessions.items():
-                node = nodes_by_url.get(srv_url)
-                if not node or not sess:
-                    continue
-                futures[ex.submit(self.api_manager.get_client_traffic, node, sess, email)] = srv_url
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Long-lived pool for traffic reads, shared across emails and cycles."""
+        with self._executor_lock:
+            if self._executor is None:
+                max_workers = max(1, int(self.config_manager.net().get('max_workers', 8) or 1))
+                self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="traffic")
+            return self._executor
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def _stream_node_traffic(self, nodes_by_url, node_sessions, emails):
+        """
+        Pipelines per-email traffic reads for all (email, server) pairs.
+        In-flight reads are bounded globally by net.max_workers and per server by
+        net.per_server_max_inflight. Yields (email, {srv_url: (up, down) or None})
+        as soon as every server has answered for that email.
+        """
+        net_opts = self.config_manager.net()
+        global_limit = max(1, int(net_opts.get('max_workers', 8) or 1))
+        per_server_limit = max(1, int(net_opts.get('per_server_max_inflight', 4) or 1))
+
+        targets = {srv_url: (nodes_by_url.get(srv_url), sess) for srv_url, sess in node_sessions.items()}
+        targets = {srv_url: t for srv_url, t in targets.items() if t[0] and t[1]}
+        emails = list(emails)
+        if not targets:
+            for email in emails:
+                yield email, {}
+            return
 
+        ex = self._get_executor()
+        pending = {srv_url: deque(emails) for srv_url in targets}
+        inflight = {srv_url: 0 for srv_url in targets}
+        results = {}
+        done = queue.Queue()
+        total_inflight = 0
+
+        def _on_done(fut, email, srv_url):
+            done.put((email, srv_url, fut))
+
+        while True:
+            # Submit round-robin across servers while both limits allow
+            progressed = True
+            while progressed and total_inflight < global_limit:
+                progressed = False
+                for srv_url, (node, sess) in targets.items():
+                    if total_inflight >= global_limit:
+                        break
+                    if inflight[srv_url] >= per_server_limit or not pending[srv_url]:
+                        continue
+                    email = pending[srv_url].popleft()
+                    fut = ex.submit(self.api_manager.get_client_traffic, node, sess, email)
+                    fut.add_done_callback(lambda f, e=email, u=srv_url: _on_done(f, e, u))
+                    inflight[srv_url] += 1
+                    total_inflight += 1
+                    progressed = True
+
+            if total_inflight == 0:
+                break
+
+            email, srv_url, fut = done.get()
+            inflight[srv_url] -= 1
+            total_inflight -= 1
+            try:
+                n_up, n_down = fut.result()
+                value = (n_up, n_down)
+            except Exception as e:
+                logging.error(f"Traffic fetch failed for {email} on {srv_url}: {e}")
+                # مهم: روی خطا baseline لمس نشه → None برای skip در حلقه‌ی دلتا
+                value = None
+            got = results.setdefault(email, {})
+            got[srv_url] = value
+            if len(got) == len(targets):
+                yield email, results.pop(email)
+
+    def _fetch_traffic_maps(self, nodes_by_url, node_sessions, parallel=True):
+        """
+        Bulk traffic reads: one inbounds/list call per node instead of one call per email.
+        A node maps to None when its bulk read failed (per-email fallback is used).
+        """
+        maps = {}
+        targets = [(srv_url, nodes_by_url.get(srv_url), sess) for srv_url, sess in node_sessions.items()]
+        targets = [(srv_url, node, sess) for srv_url, node, sess in targets if node and sess]
+        if not targets:
+            return maps
+
+        if parallel and len(targets) > 1:
+            ex = self._get_executor()
+            futures = {ex.submit(self.api_manager.get_traffic_map, node, sess): srv_url
+                       for srv_url, node, sess in targets}
             for fut in as_completed(futures):
                 srv_url = futures[fut]
                 try:
-                    n_up, n_down = fut.result()
-                    currents_by_server[srv_url] = (n_up, n_down)
+                    maps[srv_url] = fut.result()
                 except Exception as e:
-                    logging.error(f"Traffic fetch failed for {email} on {srv_url}: {e}")
-                    # مهم: روی خطا baseline لمس نشه → None برای skip در حلقه‌ی دلتا
-                    currents_by_server[srv_url] = None
-
-        return currents_by_server
+                    logging.error(f"Bulk traffic fetch failed on {srv_url}: {e}")
+                    maps[srv_url] = None
+        else:
+            for srv_url, node, sess in targets:
+                try:
+                    maps[srv_url] = self.api_manager.get_traffic_map(node, sess)
+                except Exception as e:
+                    logging.error(f"Bulk traffic fetch failed on {srv_url}: {e}")
+                    maps[srv_url] = None
+        return maps
 
-    def sync_traffic(self):
+    def sync_traffic(self, snapshot=None, bulk_only=False):
+        """
+        One traffic aggregation run. With bulk_only (the fast traffic loop), nodes whose
+        bulk read failed are skipped for this run (baselines kept) instead of falling
+        back to one read per email.
+        """
         central = self.config_manager.get_central_server()
         nodes = self.config_manager.get_nodes()
         net_opts = self.config_manager.net()
@@ -262,213 +529,427 @@ class SyncManager:
         # دلخواه: سقف دلتا در هر اینتروال (بایت). اگر 0 یا منفی، غیرفعال.
         delta_cap = int(net_opts.get('delta_max_bytes_per_interval', 0) or 0)
 
-        # Login to central server
-        try:
-            central_sess = self.api_manager.login(central)
-        except Exception as e:
-            logging.error(f"Failed to connect to central server: {e}")
+        # Central login, inbounds and client emails come from the cycle snapshot
+        if snapshot is None:
+            snapshot = self.fetch_central_snapshot()
+        if not snapshot:
+            logging.error("No central snapshot available, skipping traffic sync")
             return
+        central_sess = snapshot.session
+        client_emails = snapshot.emails
 
-        # Get client list from central server
-        try:
-            central_inbounds = self.api_manager.get_inbounds(central, central_sess)
-            if not central_inbounds:
-                logging.error("No inbounds retrieved from central server, skipping traffic sync")
+        nodes_by_url = {node['url']: node for node in nodes}
+        parallel_reads = net_opts.get('parallel_node_calls', True)
+
+        with tracer.span('traffic_reads', nodes=len(nodes)) as sp:
+            # Login to nodes (optional)
+            node_sessions = {}
+            for node in nodes:
+                if self.api_manager.circuit_open(node):
+                    # Left out like a failed login: no reads, no writes, baselines untouched
+                    logging.warning(f"[BREAKER] {node['url']}: circuit open, skipping node this run")
+                    continue
+                try:
+                    node_sessions[node['url']] = self.api_manager.login(node)
+                except Exception as e:
+                    logging.error(f"Failed to login node {node['url']}: {e}")
+
+            # Bulk traffic snapshot: central comes from the inbounds we already hold
+            # (re-read once if reconciliation ran since), nodes from one inbounds/list
+            # call each. Emails missing from a successful snapshot read as (0, 0), same
+            # as the per-email endpoint for unknown clients.
+            central_traffic = self._central_traffic(central, snapshot)
+            if central_traffic is None:
                 return
-        except Exception as e:
-            logging.error(f"Failed to get inbounds from central server: {e}")
+            node_traffic = self._fetch_traffic_maps(nodes_by_url, node_sessions, parallel_reads)
+            # Nodes whose bulk read failed fall back to per-email getClientTraffics
+            fallback_sessions = {srv_url: sess for srv_url, sess in node_sessions.items()
+                                 if node_traffic.get(srv_url) is None}
+            sp['fallback_nodes'] = len(fallback_sessions)
+        if fallback_sessions:
+            logging.warning(f"Bulk traffic read failed for {len(fallback_sessions)} node(s); "
+                            f"{'skipping them this run' if bulk_only else 'using per-email fallback'}.")
+        # In bulk-only runs a node whose bulk read failed is left out of write-backs too
+        # (it is most likely down), so its baselines stay untouched until it answers again
+        write_sessions = node_sessions
+        if bulk_only and fallback_sessions:
+            write_sessions = {u: sess for u, sess in node_sessions.items() if u not in fallback_sessions}
+
+        # Per-server write-back counts for this cycle (see _write_totals)
+        self.traffic_write_stats = {}
+        self._write_seconds = 0.0
+
+        # All state changes of the cycle are written in one transaction at the end
+        self.traffic_state_manager.begin_batch()
+        loop_start = time.perf_counter()
+        delta_engine = self._delta_engine()
+        self._pending_writes = []
+        try:
+            if delta_engine != 'per_email' and (not fallback_sessions or bulk_only):
+                # Every current counter is known up front: one batch over all emails
+                self._sync_traffic_batch(client_emails, central, central_sess, central_traffic, node_traffic,
+                                         nodes_by_url, write_sessions, delta_cap, delta_engine == 'numpy')
+            else:
+                for email, currents_by_server in self._iter_traffic_currents(
+                    client_emails, central['url'], central_traffic, node_traffic,
+                    nodes_by_url, fallback_sessions, parallel_reads, bulk_only
+                ):
+                    self._sync_email_traffic(email, currents_by_server, central, central_sess,
+                                             nodes_by_url, write_sessions, delta_cap)
+            self._flush_pending_writes()
+        finally:
+            self._pending_writes = None
+            # Delta time excludes write-backs; with per-email fallback it includes the reads it waits on
+            loop_seconds = time.perf_counter() - loop_start
+            tracer.record('traffic_deltas', max(0.0, loop_seconds - self._write_seconds),
+                          emails=len(client_emails), fallback_nodes=len(fallback_sessions))
+            tracer.record('traffic_write_back', self._write_seconds,
+                          writes=sum(st['written'] + st['failed'] for st in self.traffic_write_stats.values()))
+            with tracer.span('db_flush'):
+                self.traffic_state_manager.commit_batch()
+        # Keep the state cache bounded by the clients that still exist on central
+        self.traffic_state_manager.evict_inactive(client_emails)
+        self._log_write_stats()
+
+    def _central_traffic(self, central, snapshot):
+        """Central's counters for this run: the snapshot's, re-read if they went stale; None on failure."""
+        if snapshot.traffic_stale:
+            traffic = self.api_manager.get_traffic_map(central, snapshot.session)
+            if traffic is None:
+                logging.error("Failed to refresh central traffic counters, skipping traffic sync")
+                return None
+            snapshot.traffic, snapshot.traffic_stale = traffic, False
+        return snapshot.traffic
+
+    def _delta_engine(self) -> str:
+        """'numpy', 'python' or 'per_email' from net.delta_engine ('auto' = NumPy when installed)."""
+        engine = self.config_manager.net().get('delta_engine', 'auto')
+        if engine in ('auto', 'numpy'):
+            return 'numpy' if numpy_available() else 'python'
+        return engine
+
+    def _sync_traffic_batch(self, client_emails, central, central_sess, central_traffic, node_traffic,
+                            nodes_by_url, node_sessions, delta_cap, use_numpy):
+        """
+        Batch delta engine for bulk reads: the emails x servers counter matrix goes through
+        delta.compute_deltas in one pass, the change set is applied to the state store
+        under one lock hold, then totals are written back. Rows that need a cycle reset
+        (first observation / central reset) go through _sync_email_traffic, so results
+        are the same as the per-email engine. Nodes whose bulk read failed read as None.
+        """
+        emails = list(client_emails)
+        if not emails:
             return
-
-        # Collect client emails from central server (including settings)
-        client_emails = set()
-        for inbound in central_inbounds:
-            for client in inbound.get('clientStats') or []:
-                if client and 'email' in client:
-                    client_emails.add(client['email'])
-            try:
-                s = json.loads(inbound.get('settings') or '{}') or {}
-                for c in s.get('clients', []):
-                    e = c.get('email')
-                    if e:
-                        client_emails.add(e)
-            except Exception:
-                pass
-
-        # Login to nodes (optional)
-        node_sessions = {}
-        for node in nodes:
+        central_url = central['url']
+        live = [(srv_url, tmap) for srv_url, tmap in node_traffic.items() if tmap is not None]
+        failed = [srv_url for srv_url, tmap in node_traffic.items() if tmap is None]
+        servers = [central_url] + [srv_url for srv_url, _ in live] + failed
+        failed_tail = [None] * len(failed)
+        currents = [
+            [central_traffic.get(email, (0, 0))] + [tmap.get(email, (0, 0)) for _, tmap in live] + failed_tail
+            for email in emails
+        ]
+
+        lasts, totals = self.traffic_state_manager.get_delta_inputs(emails, servers)
+        ch = compute_deltas(currents, lasts, totals, delta_cap, use_numpy=use_numpy)
+        self.traffic_state_manager.apply_deltas(
+            [(emails[r], servers[c], up, down) for r, c, up, down in ch.baselines],
+            [(emails[r], servers[c], du, dd) for r, c, du, dd in ch.node_deltas],
+            [(emails[r], up, down) for r, up, down, _, _ in ch.totals],
+        )
+
+        for r, c in ch.skipped:
+            logging.warning(f"[SKIP NODE] {emails[r]} @ {servers[c]}: traffic read failed; keeping previous baseline.")
+            metrics.TRAFFIC_READ_FAILURES.inc(server=metrics.server_label(servers[c]))
+        for r, c, last_up, last_down, cur_up, cur_down in ch.dropped:
+            logging.warning(
+                f"[NODE COUNTER DROP] {emails[r]} @ {servers[c]}: "
+                f"last=({last_up},{last_down}) -> cur=({cur_up},{cur_down}); treat as reset (delta=0)."
+            )
+        for r, c, total in ch.clamped:
+            logging.warning(f"[DELTA CLAMP] {emails[r]} @ {servers[c]}: (du+dd)={total} > cap={delta_cap}; clamped to 0 for this interval.")
+            metrics.DELTA_CLAMPED.inc(server=metrics.server_label(servers[c]))
+        added_by_server = {}
+        for _, c, du, dd in ch.node_deltas:
+            su, sd = added_by_server.get(c, (0, 0))
+            added_by_server[c] = (su + du, sd + dd)
+        for c, (su, sd) in added_by_server.items():
+            srv_label = metrics.server_label(servers[c])
+            metrics.DELTA_BYTES.inc(su, server=srv_label, direction='up')
+            metrics.DELTA_BYTES.inc(sd, server=srv_label, direction='down')
+
+        for r in ch.resets:
+            self._sync_email_traffic(emails[r], dict(zip(servers, currents[r])), central, central_sess,
+                                     nodes_by_url, node_sessions, delta_cap)
+
+        # Write total to central and nodes; the baseline of each successful server = total
+        for r, total_up, total_down, added_up, added_down in ch.totals:
+            email = emails[r]
             try:
-                node_sessions[node['url']] = self.api_manager.login(node)
+                self._write_back(email, total_up, total_down, dict(zip(servers, currents[r])),
+                                 central, central_sess, nodes_by_url, node_sessions, "WRITE")
+                logging.debug(f"[DELTA ADD] {email}: +({added_up},{added_down}) -> total=({total_up},{total_down})")
             except Exception as e:
-                logging.error(f"Failed to login node {node['url']}: {e}")
-
-        nodes_by_url = {node['url']: node for node in nodes}
-        parallel_reads = net_opts.get('parallel_node_calls', True)
+                logging.error(f"Error syncing traffic for {email}: {e}")
 
-        for email in client_emails:
-            try:
-                # 1) Read current traffic from all servers
-                currents_by_server = {}
-                c_up, c_down = self.api_manager.get_client_traffic(central, central_sess, email)
-                currents_by_server[central['url']] = (c_up, c_down)
-
-                if parallel_reads and node_sessions:
-                    currents_by_server.update(
-                        self._fetch_node_traffic_parallel(nodes_by_url, node_sessions, email)
-                    )
-                else:
-                    for srv_url, sess in node_sessions.items():
-                        node = nodes_by_url.get(srv_url)
-                        if not node or not sess:
-                            continue
-                        try:
-                            n_up, n_down = self.api_manager.get_client_traffic(node, sess, email)
-                            currents_by_server[srv_url] = (n_up, n_down)
-                        except Exception as e:
-                            logging.error(f"Traffic fetch failed for {email} on {srv_url}: {e}")
-                            # مهم: روی خطا baseline لمس نشه → None برای skip در حلقه‌ی دلتا
-                            currents_by_server[srv_url] = None
-
-                # 2) Detect first time or central reset
-                last_central = self.traffic_state_manager.get_last_counter(email, central['url'])
-                if last_central is None:
-                    # First observation of this user -> start cycle at central snapshot
-                    self.traffic_state_manager.reset_cycle(email, currents_by_server, central['url'])
-                    total_up, total_down = currents_by_server[central['url']]
-
-                    # Write total to central + nodes; سپس baseline هر سرور = total (اگر write موفق بود)
+    def _iter_traffic_currents(self, client_emails, central_url, central_traffic, node_traffic,
+                               nodes_by_url, fallback_sessions, parallel_reads, bulk_only=False):
+        """
+        Yields (email, currents_by_server) from bulk snapshots plus per-email fallback reads.
+        With bulk_only, fallback servers read as None (failed) instead.
+        """
+        def bulk_currents(email):
+            # 1) Current traffic from the bulk snapshots
+            currents_by_server = {central_url: central_traffic.get(email, (0, 0))}
+            for srv_url, tmap in node_traffic.items():
+                if tmap is not None:
+                    currents_by_server[srv_url] = tmap.get(email, (0, 0))
+            return currents_by_server
+
+        if not fallback_sessions:
+            for email in client_emails:
+                yield email, bulk_currents(email)
+        elif bulk_only:
+            for email in client_emails:
+                currents_by_server = bulk_currents(email)
+                currents_by_server.update((srv_url, None) for srv_url in fallback_sessions)
+                yield email, currents_by_server
+        elif parallel_reads:
+            # Per-email reads are pipelined across all (email, server) pairs on the shared
+            # executor; each email is processed as soon as its last read arrives.
+            for email, fetched in self._stream_node_traffic(nodes_by_url, fallback_sessions, client_emails):
+                currents_by_server = bulk_currents(email)
+                currents_by_server.update(fetched)
+                yield email, currents_by_server
+        else:
+            for email in client_emails:
+                currents_by_server = bulk_currents(email)
+                for srv_url, sess in fallback_sessions.items():
+                    node = nodes_by_url.get(srv_url)
+                    if not node or not sess:
+                        continue
                     try:
-                        self.api_manager.update_client_traffic(central, central_sess, email, total_up, total_down)
-                        self.traffic_state_manager.set_last_counter(email, central['url'], total_up, total_down)
+                        n_up, n_down = self.api_manager.get_client_traffic(node, sess, email)
+                        currents_by_server[srv_url] = (n_up, n_down)
                     except Exception as e:
-                        logging.error(f"[INIT] Failed to write total to central for {email}: {e}")
+                        logging.error(f"Traffic fetch failed for {email} on {srv_url}: {e}")
+                        # مهم: روی خطا baseline لمس نشه → None برای skip در حلقه‌ی دلتا
+                        currents_by_server[srv_url] = None
+                yield email, currents_by_server
+
+    def _write_back(self, email, total_up, total_down, observed_by_server,
+                    central, central_sess, nodes_by_url, node_sessions, tag):
+        """Writes an email's total to central first, then to every node with a session."""
+        targets = [(central, central_sess, observed_by_server.get(central['url']), "central")]
+        for srv_url, sess in node_sessions.items():
+            node = nodes_by_url.get(srv_url)
+            if node and sess:
+                targets.append((node, sess, observed_by_server.get(srv_url), f"node {srv_url}"))
+        self._write_totals(email, total_up, total_down, targets, tag)
+
+    def _write_totals(self, email, total_up, total_down, targets, tag):
+        """
+        Writes an email's total to each target (server, session, observed counter, label)
+        and aligns that server's baseline to it. A server whose counter observed this
+        cycle already equals the total is skipped (its baseline was set to that
+        observation by the delta step).
+        Crash safety: the baselines the writes will leave behind are stored together
+        with the new total before the first write goes out, and a failed write puts its
+        baseline back. A crash mid-cycle can then lose a delta but never count one twice.
+        """
+        sends = []
+        for server, sess, observed, label in targets:
+            srv_url = server['url']
+            stats = self.traffic_write_stats.setdefault(srv_url, {'written': 0, 'skipped': 0, 'failed': 0})
+            if observed is not None and tuple(observed) == (total_up, total_down):
+                self.traffic_state_manager.set_last_counter(email, srv_url, total_up, total_down)
+                stats['skipped'] += 1
+                continue
+            prev = self.traffic_state_manager.get_last_counter(email, srv_url)
+            if prev is not None:
+                # Without a baseline the server's next read is a first observation (delta 0) anyway
+                self.traffic_state_manager.set_last_counter(email, srv_url, total_up, total_down)
+            sends.append((server, sess, prev, label))
+        if sends:
+            self._send_totals(email, total_up, total_down, sends, tag)
+
+    def _send_totals(self, email, total_up, total_down, sends, tag):
+        """
+        Sends the writes planned by _write_totals. During a traffic run they are queued
+        and go out from _flush_pending_writes, after one flush for the whole run.
+        """
+        writes = [(server, sess, email, total_up, total_down, prev, tag, label)
+                  for server, sess, prev, label in sends]
+        if self._pending_writes is not None:
+            self._pending_writes.extend(writes)
+            return
+        self.traffic_state_manager.flush()
+        for write in writes:
+            self._send_write(*write)
 
-                    for srv_url, sess in node_sessions.items():
-                        node = nodes_by_url.get(srv_url)
-                        if node and sess:
-                            try:
-                                self.api_manager.update_client_traffic(node, sess, email, total_up, total_down)
-                                self.traffic_state_manager.set_last_counter(email, srv_url, total_up, total_down)
-                            except Exception as e:
-                                logging.error(f"[INIT] Failed to write total to node {srv_url} for {email}: {e}")
+    def _flush_pending_writes(self):
+        pending, self._pending_writes = self._pending_writes, []
+        if not pending:
+            return
+        # Totals and the baselines these writes leave behind are stored before any goes out
+        self.traffic_state_manager.flush()
+        # Central first: an unwritten central counter below its stored baseline would
+        # read as a central reset after a crash
+        central_url = self.config_manager.get_central_server()['url']
+        for write in sorted(pending, key=lambda w: w[0]['url'] != central_url):
+            self._send_write(*write)
+
+    def _send_write(self, server, sess, email, total_up, total_down, prev, tag, label):
+        start = time.perf_counter()
+        try:
+            # False: the panel refused or the call failed (already logged)
+            ok = bool(self.api_manager.update_client_traffic(server, sess, email, total_up, total_down))
+        except Exception as e:
+            ok = False
+            logging.error(f"[{tag}] Failed to write total to {label} for {email}: {e}")
+        self._write_seconds += time.perf_counter() - start
+        self._record_write(email, server['url'], total_up, total_down, prev, ok)
+
+    def _record_write(self, email, srv_url, total_up, total_down, prev, ok):
+        stats = self.traffic_write_stats[srv_url]
+        if ok:
+            # فقط اگر write موفق بود baseline را هم‌راستا کنیم
+            self.traffic_state_manager.set_last_counter(email, srv_url, total_up, total_down)
+            stats['written'] += 1
+        else:
+            if prev is not None:
+                self.traffic_state_manager.set_last_counter(email, srv_url, *prev)
+            stats['failed'] += 1
+
+    def _log_write_stats(self):
+        written = sum(st['written'] for st in self.traffic_write_stats.values())
+        skipped = sum(st['skipped'] for st in self.traffic_write_stats.values())
+        failed = sum(st['failed'] for st in self.traffic_write_stats.values())
+        logging.info(f"[TRAFFIC WRITES] written={written} skipped={skipped} failed={failed}")
+        for srv_url, st in self.traffic_write_stats.items():
+            for result in ('written', 'skipped', 'failed'):
+                if st[result]:
+                    metrics.TRAFFIC_WRITES.inc(st[result], server=metrics.server_label(srv_url), result=result)
+            logging.debug(
+                f"[TRAFFIC WRITES] {srv_url}: written={st['written']} skipped={st['skipped']} failed={st['failed']}"
+            )
 
-                    # total را در state هم بنویسیم تا پایدار باشد
-                    self.traffic_state_manager.set_total(email, total_up, total_down)
+    @staticmethod
+    def _observed(currents_by_server):
+        """Currents without the servers whose read failed (None); a cycle reset leaves their baselines alone."""
+        return {srv_url: pair for srv_url, pair in currents_by_server.items() if pair is not None}
 
-                    logging.info(f"[INIT] {email}: total set to central current ({total_up},{total_down}); baselines initialized & aligned to total; node_totals cleared.")
-                    continue
+    def _sync_email_traffic(self, email, currents_by_server, central, central_sess,
+                            nodes_by_url, node_sessions, delta_cap):
+        """Delta engine for one email, given its current counters on every server."""
+        try:
+            c_up, c_down = currents_by_server[central['url']]
 
-                last_cu, last_cd = last_central
-                # IMPORTANT: consider central reset only if BOTH counters dropped (real reset)
-                central_reset = (c_up < last_cu) and (c_down < last_cd)
-                if central_reset:
-                    # Start a new cycle (central reset) using current observations as baselines
-                    self.traffic_state_manager.reset_cycle(email, currents_by_server, central['url'])
-                    total_up, total_down = currents_by_server[central['url']]
+            # 2) Detect first time or central reset
+            last_central = self.traffic_state_manager.get_last_counter(email, central['url'])
+            if last_central is None:
+                # First observation of this user -> start cycle at central snapshot
+                observed = self._observed(currents_by_server)
+                self.traffic_state_manager.reset_cycle(email, observed, central['url'])
+                total_up, total_down = observed[central['url']]
 
-                    # Write total to central + nodes; سپس baseline هر سرور = total (اگر write موفق بود)
-                    try:
-                        self.api_manager.update_client_traffic(central, central_sess, email, total_up, total_down)
-                        self.traffic_state_manager.set_last_counter(email, central['url'], total_up, total_down)
-                    except Exception as e:
-                        logging.error(f"[CENTRAL RESET] Failed to write total to central for {email}: {e}")
+                # Write total to central + nodes; سپس baseline هر سرور = total (اگر write موفق بود)
+                self._write_back(email, total_up, total_down, observed,
+                                 central, central_sess, nodes_by_url, node_sessions, "INIT")
 
-                    for srv_url, sess in node_sessions.items():
-                        node = nodes_by_url.get(srv_url)
-                        if node and sess:
-                            try:
-                                self.api_manager.update_client_traffic(node, sess, email, total_up, total_down)
-                                self.traffic_state_manager.set_last_counter(email, srv_url, total_up, total_down)
-                            except Exception as e:
-                                logging.error(f"[CENTRAL RESET] Failed to write total to node {srv_url} for {email}: {e}")
+                # total را در state هم بنویسیم تا پایدار باشد
+                self.traffic_state_manager.set_total(email, total_up, total_down)
 
-                    # total را هم ذخیره می‌کنیم
-                    self.traffic_state_manager.set_total(email, total_up, total_down)
+                logging.info(f"[INIT] {email}: total set to central current ({total_up},{total_down}); baselines initialized & aligned to total; node_totals cleared.")
+                return
 
-                    logging.warning(
-                        f"[CENTRAL RESET] {email}: total reset to central current ({total_up},{total_down}); baselines reinitialized & aligned; node_totals cleared."
-                    )
-                    continue
+            last_cu, last_cd = last_central
+            # IMPORTANT: consider central reset only if BOTH counters dropped (real reset)
+            central_reset = (c_up < last_cu) and (c_down < last_cd)
+            if central_reset:
+                # Start a new cycle (central reset) using current observations as baselines
+                observed = self._observed(currents_by_server)
+                self.traffic_state_manager.reset_cycle(email, observed, central['url'])
+                total_up, total_down = observed[central['url']]
+
+                # Write total to central + nodes; سپس baseline هر سرور = total (اگر write موفق بود)
+                self._write_back(email, total_up, total_down, observed,
+                                 central, central_sess, nodes_by_url, node_sessions, "CENTRAL RESET")
+
+                # total را هم ذخیره می‌کنیم
+                self.traffic_state_manager.set_total(email, total_up, total_down)
+
+                logging.warning(
+                    f"[CENTRAL RESET] {email}: total reset to central current ({total_up},{total_down}); baselines reinitialized & aligned; node_totals cleared."
+                )
+                return
 
-                # 3) If no central reset: calculate per-server deltas (Scenario 1..3)
-                total_up, total_down = self.traffic_state_manager.get_total(email)
-                added_up, added_down = 0, 0
+            # 3) If no central reset: calculate per-server deltas (Scenario 1..3)
+            total_up, total_down = self.traffic_state_manager.get_total(email)
+            added_up, added_down = 0, 0
 
-                for srv_url, cur_pair in currents_by_server.items():
-                    # اگر خواندن نود fail بوده، این چرخه برای آن نود را نادیده بگیر و baseline را لمس نکن
-                    if cur_pair is None:
-                        logging.warning(f"[SKIP NODE] {email} @ {srv_url}: traffic read failed; keeping previous baseline.")
-                        continue
+            for srv_url, cur_pair in currents_by_server.items():
+                # اگر خواندن نود fail بوده، این چرخه برای آن نود را نادیده بگیر و baseline را لمس نکن
+                if cur_pair is None:
+                    logging.warning(f"[SKIP NODE] {email} @ {srv_url}: traffic read failed; keeping previous baseline.")
+                    metrics.TRAFFIC_READ_FAILURES.inc(server=metrics.server_label(srv_url))
+                    continue
 
-                    cur_up, cur_down = cur_pair
-                    last = self.traffic_state_manager.get_last_counter(email, srv_url)
-                    if last is None:
-                        # First observation from this server: baseline = current (delta 0)
-                        self.traffic_state_manager.set_last_counter(email, srv_url, cur_up, cur_down)
-                        continue
+                cur_up, cur_down = cur_pair
+                last = self.traffic_state_manager.get_last_counter(email, srv_url)
+                if last is None:
+                    # First observation from this server: baseline = current (delta 0)
+                    self.traffic_state_manager.set_last_counter(email, srv_url, cur_up, cur_down)
+                    continue
 
-                    last_up, last_down = last
+                last_up, last_down = last
 
-                    # Real reset on this node: BOTH directions dropped -> delta=0
-                    if (cur_up < last_up) and (cur_down < last_down):
+                # Real reset on this node: BOTH directions dropped -> delta=0
+                if (cur_up < last_up) and (cur_down < last_down):
+                    du = 0
+                    dd = 0
+                    logging.warning(
+                        f"[NODE COUNTER DROP] {email} @ {srv_url}: "
+                        f"last=({last_up},{last_down}) -> cur=({cur_up},{cur_down}); treat as reset (delta=0)."
+                    )
+                else:
+                    # Safe component-wise delta (no negatives)
+                    du = max(0, cur_up - last_up)
+                    dd = max(0, cur_down - last_down)
+
+                # دلتا غیرعادی را محدود کنیم (اختیاری)
+                if delta_cap > 0:
+                    if (du + dd) > delta_cap:
+                        logging.warning(f"[DELTA CLAMP] {email} @ {srv_url}: (du+dd)={(du+dd)} > cap={delta_cap}; clamped to 0 for this interval.")
+                        metrics.DELTA_CLAMPED.inc(server=metrics.server_label(srv_url))
                         du = 0
                         dd = 0
-                        logging.warning(
-                            f"[NODE COUNTER DROP] {email} @ {srv_url}: "
-                            f"last=({last_up},{last_down}) -> cur=({cur_up},{cur_down}); treat as reset (delta=0)."
-                        )
-                    else:
-                        # Safe component-wise delta (no negatives)
-                        du = max(0, cur_up - last_up)
-                        dd = max(0, cur_down - last_down)
-
-                    # دلتا غیرعادی را محدود کنیم (اختیاری)
-                    if delta_cap > 0:
-                        if (du + dd) > delta_cap:
-                            logging.warning(f"[DELTA CLAMP] {email} @ {srv_url}: (du+dd)={(du+dd)} > cap={delta_cap}; clamped to 0 for this interval.")
-                            du = 0
-                            dd = 0
-
-                    # Always update per-node baseline to the current observation
-                    self.traffic_state_manager.set_last_counter(email, srv_url, cur_up, cur_down)
 
-                    # Accumulate only positive deltas
-                    if du > 0 or dd > 0:
-                        added_up += du
-                        added_down += dd
-                        self.traffic_state_manager.add_node_delta(email, srv_url, du, dd)
-
-                # 4) Add deltas and save new total (only if changed)
-                changed = False
-                if added_up != 0 or added_down != 0:
-                    total_up += added_up
-                    total_down += added_down
-                    changed = self.traffic_state_manager.set_total(email, total_up, total_down)
-
-                # 5) Write total to central and nodes; سپس baseline سرورِ موفق = total
-                if changed:
-                    # Central first
-                    central_written = False
-                    try:
-                        self.api_manager.update_client_traffic(central, central_sess, email, total_up, total_down)
-                        self.traffic_state_manager.set_last_counter(email, central['url'], total_up, total_down)
-                        central_written = True
-                    except Exception as e:
-                        logging.error(f"[WRITE] Failed to write total to central for {email}: {e}")
+                # Always update per-node baseline to the current observation
+                self.traffic_state_manager.set_last_counter(email, srv_url, cur_up, cur_down)
 
-                    # Nodes
-                    for srv_url, sess in node_sessions.items():
-                        node = nodes_by_url.get(srv_url)
-                        if not node or not sess:
-                            continue
-                        try:
-                            self.api_manager.update_client_traffic(node, sess, email, total_up, total_down)
-                            # فقط اگر write موفق بود baseline را هم‌راستا کنیم
-                            self.traffic_state_manager.set_last_counter(email, srv_url, total_up, total_down)
-                        except Exception as e:
-                            logging.error(f"[WRITE] Failed to write total to node {srv_url} for {email}: {e}")
+                # Accumulate only positive deltas
+                if du > 0 or dd > 0:
+                    added_up += du
+                    added_down += dd
+                    self.traffic_state_manager.add_node_delta(email, srv_url, du, dd)
+                    srv_label = metrics.server_label(srv_url)
+                    metrics.DELTA_BYTES.inc(du, server=srv_label, direction='up')
+                    metrics.DELTA_BYTES.inc(dd, server=srv_label, direction='down')
 
-                    logging.debug(f"[DELTA ADD] {email}: +({added_up},{added_down}) -> total=({total_up},{total_down})")
+            # 4) Add deltas and save new total (only if changed)
+            changed = False
+            if added_up != 0 or added_down != 0:
+                total_up += added_up
+                total_down += added_down
+                changed = self.traffic_state_manager.set_total(email, total_up, total_down)
 
-            except Exception as e:
-                logging.error(f"Error syncing traffic for {email}: {e}")
+            # 5) Write total to central and nodes; سپس baseline سرورِ موفق = total
+            if changed:
+                self._write_back(email, total_up, total_down, currents_by_server,
+                                 central, central_sess, nodes_by_url, node_sessions, "WRITE")
+
+                logging.debug(f"[DELTA ADD] {email}: +({added_up},{added_down}) -> total=({total_up},{total_down})")
+
+        except Exception as e:
+            logging.error(f"Error syncing traffic for {email}: {e}")
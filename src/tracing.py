@@ -0,0 +1,161 @@
+# src/tracing.py
+import os
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+from . import metrics
+
+
+class Tracer:
+    """
+    Phase spans for the sync loop:
+    - every span feeds metrics.PHASE_SECONDS
+    - with tracing enabled, each span is also written as one JSON line
+      (ts, cycle, span, ms, attributes) to a rotating trace file in DATA_DIR
+    - panel calls slower than slow_call_seconds are logged with server,
+      endpoint and payload sizes (0 disables)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_call_seconds = 0.0
+        self.cycle_id = 0  # current cycle of the main loop
+        self._next_id = 0
+        self._local = threading.local()  # cycle of a loop running on its own thread
+        self._logger = None
+        self._lock = threading.Lock()
+
+    def configure(self, data_dir, enabled=False, file_name="trace.jsonl", slow_call_ms=0,
+                  max_bytes=10 * 1024 * 1024, backup_count=3):
+        self.slow_call_seconds = max(0, int(slow_call_ms or 0)) / 1000.0
+        self.enabled = bool(enabled)
+        if not self.enabled:
+            return
+        os.makedirs(data_dir, exist_ok=True)
+        path = os.path.join(data_dir, file_name)
+        logger = logging.getLogger("nodex.trace")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        fh = RotatingFileHandler(filename=path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        fh.setFormatter(logging.Formatter("%(message)s"))
+        logger.handlers = [fh]
+        self._logger = logger
+        logging.info(f"Tracing spans to {path}")
+
+    def start_cycle(self, shared=True) -> int:
+        """
+        Starts a cycle on the calling thread. Spans from that thread carry its id; spans
+        from other threads (e.g. node workers) carry the last shared (main loop) id.
+        """
+        with self._lock:
+            self._next_id += 1
+            cycle_id = self._next_id
+            if shared:
+                self.cycle_id = cycle_id
+        self._local.cycle_id = cycle_id
+        return cycle_id
+
+    def _current_cycle(self) -> int:
+        return getattr(self._local, "cycle_id", self.cycle_id)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Times the block as phase `name`. Yields the attrs dict so the block can add
+        counts (e.g. ops=12) that end up in the trace record.
+        """
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            self.record(name, time.perf_counter() - start, **attrs)
+
+    def record(self, name, seconds, **attrs) -> None:
+        """Records an already measured span (e.g. time summed over many write-backs)."""
+        metrics.PHASE_SECONDS.observe(seconds, phase=name)
+        if not self.enabled or self._logger is None:
+            return
+        rec = {"ts": round(time.time(), 3), "cycle": self._current_cycle(), "span": name, "ms": round(seconds * 1000, 2)}
+        rec.update(attrs)
+        self._logger.info(json.dumps(rec, default=str, ensure_ascii=False))
+
+    def is_slow(self, seconds) -> bool:
+        return bool(self.slow_call_seconds) and seconds >= self.slow_call_seconds
+
+    def slow_call(self, url, method, status, seconds, request_bytes=None, response_bytes=None) -> None:
+        """Logs one call that took longer than slow_call_seconds (check with is_slow first)."""
+        server, endpoint = metrics.server_label(url), metrics.endpoint_label(url)
+        logging.warning(
+            f"[SLOW CALL] {method} {endpoint} on {server}: {seconds * 1000:.0f} ms "
+            f"(status={status}, request_bytes={request_bytes}, response_bytes={response_bytes})"
+        )
+        if self.enabled and self._logger is not None:
+            self._logger.info(json.dumps({
+                "ts": round(time.time(), 3), "cycle": self._current_cycle(), "span": "slow_call",
+                "ms": round(seconds * 1000, 2), "server": server, "endpoint": endpoint, "method": method,
+                "status": status, "request_bytes": request_bytes, "response_bytes": response_bytes,
+            }))
+
+
+def payload_size(kwargs):
+    """Size in bytes of a request's JSON/data payload, for slow-call reports."""
+    if kwargs.get("json") is not None:
+        return len(json.dumps(kwargs["json"]).encode("utf-8"))
+    data = kwargs.get("data")
+    if data is None:
+        return 0
+    return len(data) if isinstance(data, (bytes, str)) else None
+
+
+class CycleProfiler:
+    """
+    Opt-in cProfile of whole sync cycles (PROFILE_CYCLES=1). Each cycle is dumped to
+    <data_dir>/profiles/cycle-<time>-<n>.prof plus a cumulative-time text summary; only the
+    last `keep` cycles are kept. cProfile sees the main thread only, so time spent in
+    worker pools shows up as waiting in the calls that collect their results.
+    """
+
+    def __init__(self, data_dir, keep=5, top=40):
+        self.dir = os.path.join(data_dir, "profiles")
+        self.keep = max(1, int(keep or 1))
+        self.top = top
+
+    @contextmanager
+    def profile(self, cycle_id):
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            try:
+                self._dump(prof, cycle_id)
+            except Exception as e:
+                logging.error(f"Failed to write cycle profile: {e}")
+
+    def _dump(self, prof, cycle_id):
+        os.makedirs(self.dir, exist_ok=True)
+        base = os.path.join(self.dir, f"cycle-{time.strftime('%Y%m%d-%H%M%S')}-{cycle_id}")
+        prof.dump_stats(base + ".prof")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            pstats.Stats(prof, stream=f).sort_stats("cumulative").print_stats(self.top)
+        logging.info(f"Cycle profile written to {base}.prof")
+        dumps = sorted(
+            (p for p in os.listdir(self.dir) if p.startswith("cycle-") and p.endswith(".prof")),
+            key=lambda p: os.path.getmtime(os.path.join(self.dir, p)),
+        )
+        for old in dumps[:-self.keep]:
+            for ext in (".prof", ".txt"):
+                try:
+                    os.remove(os.path.join(self.dir, old[:-len(".prof")] + ext))
+                except OSError:
+                    pass
+
+
+tracer = Tracer()
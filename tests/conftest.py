@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The worker runs as the `src` package from the repository root (python -m src.main)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
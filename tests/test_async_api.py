@@ -0,0 +1,76 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from src.async_api import AsyncAPIManager
+
+
+class _Response:
+    def __init__(self, status):
+        self.status = status
+        self.history = ()
+        self.content_length = 2
+        self.request_info = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(self.request_info, self.history, status=self.status)
+
+    async def read(self):
+        return b"{}"
+
+
+class _Session:
+    """Answers every request with the next scripted status; None drops the connection."""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        status = self.statuses.pop(0)
+        if status is None:
+            raise aiohttp.ClientConnectionError("connection reset")
+        return _Response(status)
+
+
+def _send(statuses, method="GET"):
+    api = AsyncAPIManager({"retries": 2, "retry_backoff": 0})
+    session = _Session(statuses)
+    try:
+        result = asyncio.run(api._send_attempts(session, method, "http://panel/x"))
+    except aiohttp.ClientError as e:
+        result = e
+    return result, session.calls
+
+
+@pytest.mark.parametrize("status", [400, 404, 409, 500])
+def test_get_is_not_retried_on_other_errors(status):
+    result, calls = _send([status, 200, 200])
+    assert isinstance(result, aiohttp.ClientResponseError) and result.status == status
+    assert calls == 1
+
+
+@pytest.mark.parametrize("failure", [502, 503, 504, None])
+def test_get_is_retried_on_gateway_and_connection_errors(failure):
+    result, calls = _send([failure, failure, 200])
+    assert result == (200, (), {})
+    assert calls == 3
+
+
+def test_post_is_never_retried():
+    result, calls = _send([503, 200], method="POST")
+    assert isinstance(result, aiohttp.ClientResponseError) and result.status == 503
+    assert calls == 1
+
+
+def test_auth_failure_is_returned_without_retry():
+    assert _send([401, 200]) == ((401, (), None), 1)
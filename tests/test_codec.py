@@ -0,0 +1,34 @@
+import gc
+import json
+import weakref
+
+from src import codec
+
+
+class Record(dict):
+    pass  # plain dicts cannot be weakly referenced
+
+
+def test_payload_cache_reuses_bodies_until_fields_change():
+    cache = codec.PayloadCache()
+    client = {"id": "u1", "email": "é@x", "expiryTime": 0}
+    body = cache.clients_body(3, [client])
+    assert cache.clients_body(3, [client]) is body
+    assert json.loads(json.loads(body)["settings"]) == {"clients": [client]}
+
+    client["expiryTime"] = 123  # changed in place, e.g. a SAFU promotion
+    assert json.loads(json.loads(cache.clients_body(3, [client]))["settings"])["clients"][0]["expiryTime"] == 123
+
+
+def test_payload_cache_clear_releases_records():
+    cache = codec.PayloadCache()
+    inbound = Record(id=1, settings="{}")
+    body = cache.inbound_body(inbound)
+    ref = weakref.ref(inbound)
+    cache.clear()
+    assert cache.inbound_body(inbound) == body  # rebuilt, same document
+    cache.clear()
+    del inbound
+    gc.collect()
+    assert ref() is None
+    assert cache._bytes == 0
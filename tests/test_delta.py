@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+from src.delta import DeltaChanges, compute_deltas
+
+np = pytest.importorskip("numpy")
+
+
+def _counter(rnd, last):
+    """Next counter for one (email, server) pair: read failures, resets, jumps and growth."""
+    x = rnd.random()
+    if x < 0.08:
+        return None
+    if last is None or x < 0.15:
+        return (rnd.randint(0, 50), rnd.randint(0, 50))
+    up, down = last
+    if x < 0.2:
+        return (max(0, up - rnd.randint(1, 20)), down + rnd.randint(0, 5))  # one direction drops
+    if x < 0.25:
+        return (up + rnd.randint(0, 10**6), down)
+    return (up + rnd.randint(0, 500), down + rnd.randint(0, 500))
+
+
+def _matrices(rnd, n_emails, n_servers):
+    lasts, currents, totals = [], [], []
+    for _ in range(n_emails):
+        row_last = [None if rnd.random() < 0.1 else (rnd.randint(0, 10**4), rnd.randint(0, 10**4))
+                    for _ in range(n_servers)]
+        lasts.append(row_last)
+        currents.append([_counter(rnd, last) for last in row_last])
+        totals.append((rnd.randint(0, 10**6), rnd.randint(0, 10**6)))
+    return currents, lasts, totals
+
+
+def _fields(ch):
+    return {name: list(getattr(ch, name)) for name in DeltaChanges.__slots__}
+
+
+@pytest.mark.parametrize("seed", range(40))
+@pytest.mark.parametrize("delta_cap", [0, 700])
+def test_numpy_engine_matches_python(seed, delta_cap):
+    rnd = random.Random(seed)
+    currents, lasts, totals = _matrices(rnd, rnd.randint(1, 60), rnd.randint(1, 5))
+    expected = compute_deltas(currents, lasts, totals, delta_cap, use_numpy=False)
+    assert _fields(compute_deltas(currents, lasts, totals, delta_cap, use_numpy=True)) == _fields(expected)
+
+
+def test_numpy_engine_falls_back_on_huge_counters():
+    currents = [[(1 << 63, 5), (10, 10)]]
+    lasts = [[(1 << 63, 1), (5, 5)]]
+    totals = [(0, 0)]
+    expected = compute_deltas(currents, lasts, totals, use_numpy=False)
+    got = compute_deltas(currents, lasts, totals, use_numpy=True)
+    assert _fields(got) == _fields(expected)
+    assert got.totals == [(0, 5, 9, 5, 9)]
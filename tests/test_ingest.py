@@ -0,0 +1,81 @@
+import json
+import random
+
+import pytest
+
+from src.ingest import InboundRecord, ListParser, apply_transform
+
+# Strings that stress the element scanner: quotes, backslashes, brackets and multi-byte UTF-8
+_TRICKY = ['', 'plain', 'a "quoted" word', 'back\\slash\\', '}{][,:', 'تست', '😀 emoji', '\\"', 'line\nbreak']
+
+
+def _value(rnd, depth=0):
+    x = rnd.random()
+    if depth > 2 or x < 0.3:
+        return rnd.choice([None, True, False, rnd.randint(-10**12, 10**12), rnd.random() * 1e6,
+                           rnd.choice(_TRICKY)])
+    if x < 0.65:
+        return {rnd.choice(_TRICKY) + str(i): _value(rnd, depth + 1) for i in range(rnd.randint(0, 4))}
+    return [_value(rnd, depth + 1) for _ in range(rnd.randint(0, 4))]
+
+
+def _inbound(rnd, iid):
+    clients = [{"id": f"uuid-{iid}-{i}", "email": rnd.choice(_TRICKY) + str(i)} for i in range(rnd.randint(0, 5))]
+    return {"id": iid, "remark": rnd.choice(_TRICKY), "settings": json.dumps({"clients": clients}),
+            "clientStats": [{"email": c["email"], "up": rnd.randint(0, 10**15), "down": 0} for c in clients],
+            "extra": _value(rnd)}
+
+
+def _document(rnd):
+    obj = [_inbound(rnd, i) if rnd.random() < 0.8 else _value(rnd) for i in range(rnd.randint(0, 12))]
+    doc = {"success": True, "msg": rnd.choice(_TRICKY), "obj": obj}
+    if rnd.random() < 0.3:
+        doc = {"obj": obj, "success": rnd.random() < 0.5, "meta": _value(rnd)}
+    return json.dumps(doc, ensure_ascii=rnd.random() < 0.5, indent=rnd.choice([None, 1])).encode("utf-8")
+
+
+def _parse(data, sizes, transform=None):
+    parser = ListParser(transform)
+    pos = 0
+    while pos < len(data):
+        step = sizes()
+        parser.feed(data[pos:pos + step])
+        pos += step
+    return parser.close()
+
+
+@pytest.mark.parametrize("seed", range(60))
+def test_matches_json_loads_on_random_chunks(seed):
+    rnd = random.Random(seed)
+    data = _document(rnd)
+    expected = json.loads(data)
+    assert _parse(data, lambda: rnd.randint(1, 64)) == expected
+    assert _parse(data, lambda: 1) == expected  # every byte boundary, inside strings and UTF-8 sequences too
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_transform_matches_apply_transform(seed):
+    rnd = random.Random(seed)
+    data = _document(rnd)
+    transform = InboundRecord.from_panel
+    assert _parse(data, lambda: rnd.randint(1, 32), transform) == apply_transform(json.loads(data), transform)
+
+
+@pytest.mark.parametrize("data", [b'{"success": true, "obj": [{"id": 1}', b'{"obj": [1, 2', b'{"obj": ['])
+def test_truncated_body_is_rejected(data):
+    with pytest.raises(ValueError):
+        _parse(data, lambda: 3)
+
+
+def test_large_element_is_not_rebuffered():
+    clients = [{"id": f"uuid-{i}", "email": f"user{i}@example.com", "flow": "x\\"} for i in range(40000)]
+    inbound = {"id": 1, "settings": json.dumps({"clients": clients})}
+    data = json.dumps({"success": True, "obj": [inbound, {"id": 2}]}).encode("utf-8")
+    chunk = 4096
+    parser = ListParser()
+    longest = 0
+    for pos in range(0, len(data), chunk):
+        parser.feed(data[pos:pos + chunk])
+        longest = max(longest, len(parser._buf))
+    assert parser.close() == json.loads(data)
+    assert longest <= chunk + 1  # only the unscanned tail is carried between chunks
@@ -0,0 +1,24 @@
+import json
+
+from src.snapshot import CentralSnapshot
+
+
+def _snapshot():
+    clients = [{"id": "uuid-1", "email": "a@x", "expiryTime": 0}]
+    inbound = {"id": 1, "protocol": "vless", "settings": json.dumps({"clients": clients}),
+               "clientStats": [{"email": "a@x", "up": 0, "down": 0}]}
+    return CentralSnapshot([inbound]), inbound
+
+
+def test_replacement_inbound_is_shared_until_dropped():
+    snapshot, inbound = _snapshot()
+    first = snapshot.replacement_inbound(1, inbound)
+    assert snapshot.replacement_inbound(1, inbound) is first
+    assert json.loads(first["settings"]) == json.loads(inbound["settings"])
+
+    snapshot.settings[1]["clients"][0]["expiryTime"] = 123  # promotion in place
+    assert snapshot.replacement_inbound(1, inbound) is first
+    snapshot.drop_replacement(1)
+    rebuilt = snapshot.replacement_inbound(1, inbound)
+    assert json.loads(rebuilt["settings"])["clients"][0]["expiryTime"] == 123
+    assert json.loads(inbound["settings"])["clients"][0]["expiryTime"] == 0
@@ -0,0 +1,55 @@
+import pytest
+
+from src.state import TrafficStateManager
+
+CENTRAL = "http://central"
+NODE = "http://node1"
+
+
+@pytest.fixture
+def state(tmp_path):
+    st = TrafficStateManager(str(tmp_path / "state.db"), {})
+    st.reset_cycle("a@x", {CENTRAL: (10, 20), NODE: (5, 5)}, CENTRAL)
+    st.add_node_delta("a@x", NODE, 1, 2)
+    yield st
+    st.conn.close()
+
+
+def _persisted(st):
+    return [sorted(st.conn.execute(f"SELECT * FROM {table}").fetchall())
+            for table in ("server_counters", "node_totals")] + [
+        st.conn.execute("SELECT email,total_up,total_down FROM client_totals").fetchall()]
+
+
+def test_reset_cycle_with_failed_read_changes_nothing(state):
+    before = _persisted(state)
+    with pytest.raises(TypeError):
+        state.reset_cycle("a@x", {CENTRAL: (1, 2), NODE: None}, CENTRAL)
+    state.flush()
+    assert _persisted(state) == before
+    assert state.get_total("a@x") == (10, 20)
+    assert state.get_last_counter("a@x", CENTRAL) == (10, 20)
+    assert state.get_last_counter("a@x", NODE) == (5, 5)
+
+
+def test_reset_cycle_restarts_the_cycle(state):
+    state.reset_cycle("a@x", {CENTRAL: (1, 2), NODE: (3, 4)}, CENTRAL)
+    assert state.get_total("a@x") == (1, 2)
+    assert state.get_last_counter("a@x", NODE) == (3, 4)
+    assert _persisted(state)[1] == []  # node_totals cleared
+
+
+def test_evicted_rows_are_reloaded_and_not_tracked(state):
+    for i in range(50):  # churned clients
+        state.reset_cycle(f"gone{i}@x", {CENTRAL: (i, i)}, CENTRAL)
+    state.reset_cycle("b@x", {CENTRAL: (7, 8)}, CENTRAL)
+    assert state.evict_inactive(["b@x"]) == 51
+    assert state._loaded == {"b@x"}
+
+    assert state.get_total("a@x") == (10, 20)
+    assert state.get_last_counter("a@x", NODE) == (5, 5)
+    lasts, totals = state.get_delta_inputs(["gone3@x", "new@x"], [CENTRAL, NODE])
+    assert lasts == [[(3, 3), None], [None, None]]
+    assert totals == [(3, 3), (0, 0)]
+    assert state.evict_inactive(["b@x"]) == 3
+    assert state._loaded == {"b@x"}
@@ -0,0 +1,174 @@
+import copy
+import json
+import logging
+import random
+
+import pytest
+
+from src.delta import numpy_available
+from src.state import TrafficStateManager
+from src.sync import SyncManager
+
+CENTRAL = "http://central"
+NODES = ("http://node1", "http://node2", "http://node3")
+
+
+class FakePanels:
+    """The traffic side of APIManager over in-memory panels: url -> {email: [up, down]}."""
+
+    def __init__(self, counters, failing=(), down=()):
+        self.counters = counters
+        self.failing = set(failing)  # nodes whose bulk read fails (per-email reads still work)
+        self.down = set(down)  # nodes whose every read fails
+
+    @staticmethod
+    def inbounds(counters):
+        clients = [{"id": f"uuid-{email}", "email": email} for email in sorted(counters)]
+        return [{"id": 1, "protocol": "vless", "settings": json.dumps({"clients": clients}),
+                 "clientStats": [{"email": e, "up": u, "down": d} for e, (u, d) in sorted(counters.items())]}]
+
+    @staticmethod
+    def traffic_map_from_inbounds(inbounds):
+        return {st["email"]: (st["up"], st["down"]) for ib in inbounds for st in ib["clientStats"]}
+
+    def circuit_open(self, server):
+        return False
+
+    def login(self, server):
+        return object()
+
+    def get_inbounds(self, server, session=None, client_stats=True):
+        return self.inbounds(self.counters[server["url"]])
+
+    def get_traffic_map(self, server, session=None):
+        if server["url"] in self.failing or server["url"] in self.down:
+            return None
+        return {e: tuple(pair) for e, pair in self.counters[server["url"]].items()}
+
+    def get_client_traffic(self, server, session, email):
+        if server["url"] in self.down:
+            raise ConnectionError("node down")
+        return tuple(self.counters[server["url"]].get(email, (0, 0)))
+
+    def update_client_traffic(self, server, session, email, up, down):
+        counters = self.counters[server["url"]]
+        if email not in counters or server["url"] in self.down:
+            return False
+        counters[email] = [up, down]
+        return True
+
+
+class FakeConfig:
+    def __init__(self, net):
+        self._net = net
+
+    def get_central_server(self):
+        return {"url": CENTRAL}
+
+    def get_nodes(self):
+        return [{"url": url} for url in NODES]
+
+    def net(self):
+        return self._net
+
+
+def _script(seed, cycles=10, n_emails=25):
+    """Per cycle: counter changes to apply and the nodes whose bulk read fails."""
+    rnd = random.Random(seed)
+    emails = [f"u{i}@x" for i in range(n_emails)]
+    steps = []
+    for cycle in range(cycles):
+        changes = []
+        for url in (CENTRAL,) + NODES:
+            for email in emails:
+                x = rnd.random()
+                if x < 0.5:
+                    changes.append((url, email, "add", rnd.randint(0, 3000), rnd.randint(0, 3000)))
+                elif x < 0.54:
+                    changes.append((url, email, "set", 0, 0))  # panel reset
+                elif x < 0.58:
+                    changes.append((url, email, "add", -10, 5))  # one direction drops
+        failing = {url for url in NODES if cycle >= 3 and rnd.random() < 0.2}
+        steps.append((changes, failing))
+    return emails, steps
+
+
+def _run(delta_engine, seed):
+    emails, steps = _script(seed)
+    counters = {url: {e: [0, 0] for e in emails} for url in (CENTRAL,) + NODES}
+    api = FakePanels(counters)
+    state = TrafficStateManager(":memory:", {})
+    sm = SyncManager(api, FakeConfig({"delta_engine": delta_engine, "delta_max_bytes_per_interval": 5000,
+                                      "parallel_node_calls": False}), state)
+    history = []
+    try:
+        for changes, failing in steps:
+            for url, email, op, up, down in changes:
+                pair = counters[url][email]
+                counters[url][email] = [up, down] if op == "set" else [max(0, pair[0] + up), pair[1] + down]
+            api.failing = failing
+            sm.sync_traffic()
+            history.append(copy.deepcopy(counters))
+    finally:
+        sm.close()
+    tables = [sorted(state.conn.execute(f"select * from {t}").fetchall())
+              for t in ("server_counters", "node_totals")]
+    totals = sorted(row[:3] for row in state.conn.execute("select * from client_totals"))
+    return history, tables, totals
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("engine", ["python", pytest.param("numpy", marks=pytest.mark.skipif(
+    not numpy_available(), reason="NumPy not installed"))])
+def test_batch_engine_matches_per_email(engine, seed, caplog):
+    caplog.set_level(logging.CRITICAL)
+    assert _run(engine, seed) == _run("per_email", seed)
+
+
+def test_one_state_flush_per_run(caplog):
+    caplog.set_level(logging.CRITICAL)
+    emails = [f"u{i}@x" for i in range(50)]
+    counters = {url: {e: [0, 0] for e in emails} for url in (CENTRAL,) + NODES}
+    state = TrafficStateManager(":memory:", {})
+    sm = SyncManager(FakePanels(counters), FakeConfig({"delta_engine": "python"}), state)
+    sm.sync_traffic()
+    for url in NODES:
+        for pair in counters[url].values():
+            pair[0] += 100
+    flushes = []
+    flush = state.flush
+    state.flush = lambda: (flushes.append(1), flush())
+    try:
+        sm.sync_traffic()
+    finally:
+        sm.close()
+    assert len(flushes) == 1
+    assert sm.traffic_write_stats[CENTRAL]["written"] == len(emails)
+    assert all(counters[url][e] == [300, 0] for url in (CENTRAL,) + NODES for e in emails)
+
+
+@pytest.mark.parametrize("bulk_only", [False, True])
+@pytest.mark.parametrize("engine", ["python", "per_email"])
+def test_failed_node_does_not_block_init_or_central_reset(engine, bulk_only, caplog):
+    caplog.set_level(logging.CRITICAL)
+    emails = ["a@x", "b@x"]
+    counters = {url: {e: [100, 200] for e in emails} for url in (CENTRAL,) + NODES}
+    dead = NODES[1]
+    state = TrafficStateManager(":memory:", {})
+    sm = SyncManager(FakePanels(counters, down={dead}), FakeConfig({"delta_engine": engine}), state)
+    try:
+        sm.sync_traffic(bulk_only=bulk_only)  # first observation of every email
+        for email in emails:
+            assert state.get_total(email) == (100, 200)
+            assert state.get_last_counter(email, dead) is None
+            assert all(state.get_last_counter(email, url) == (100, 200) for url in NODES if url != dead)
+
+        for email in emails:
+            counters[CENTRAL][email] = [1, 2]  # central reset
+        sm.sync_traffic(bulk_only=bulk_only)
+        for email in emails:
+            assert state.get_total(email) == (1, 2)
+            assert state.get_last_counter(email, dead) is None
+            assert all(counters[url][email] == [1, 2] for url in (CENTRAL,) + NODES if url != dead)
+    finally:
+        sm.close()